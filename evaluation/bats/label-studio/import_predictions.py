@@ -3,22 +3,30 @@ import json
 import argparse
 import os
 import re
+import sys
 
-def main(output_file):
-    objects = {}
+sys.path.append('../..')
+from labelstudio_export import TaskWriter, add_arguments
+
+def main(output_file, shard_size, shard_name):
     # read sample from json file
     with open('bats_results_sample.json', 'r') as file:
         data = json.load(file)
 
+    # group the rows by file, in order of appearance
+    rows_by_file = {}
     for row in data:
-        if row['file_id'] not in objects:
-            p = re.compile(r'(?P<nodelabel>\d{4}-\d{4})_(?P<date>\d{4}-\d{2}-\d{2})T(?P<time>\d{2}-\d{2}-\d{2})Z\.wav')
-            i = p.match(os.path.basename(row['object_name'])).groupdict()
-            objects[row['file_id']] = {
+        rows_by_file.setdefault(row['file_id'], []).append(row)
+
+    p = re.compile(r'(?P<nodelabel>\d{4}-\d{4})_(?P<date>\d{4}-\d{2}-\d{2})T(?P<time>\d{2}-\d{2}-\d{2})Z\.wav')
+    with TaskWriter(output_file, shard_size, shard_name) as writer:
+        for file_id, rows in rows_by_file.items():
+            i = p.match(os.path.basename(rows[0]['object_name'])).groupdict()
+            task = {
                 "data": {
-                    "file_id": row['file_id'],
+                    "file_id": file_id,
                     "header": f"{i['nodelabel']} {i['date'].replace('-','.')} {i['time'].replace('-',':')} UTC",
-                    "audio": f"s3://ixdm-mitwelten/{row['object_name']}"
+                    "audio": f"s3://ixdm-mitwelten/{rows[0]['object_name']}"
                 },
                 "predictions": [
                     {
@@ -27,47 +35,31 @@ def main(output_file):
                     }
                 ]
             }
-        result = {
-            "original_length": 55,
-            "value": {
-                "start": row['start_time'],
-                "end": row['end_time'],
-                "low_freq": row['low_freq'],
-                "high_freq": row['high_freq'],
-                "score": row['class_prob'],
-                "labels": [ row['class'] ]
-            },
-            "from_name": "label",
-            "to_name": "audio",
-            "type": "labels"
-        }
-        objects[row['file_id']]['predictions'][0]['result'].append(result)
-
-    # go through all objects and extract the labels from the predictions, insert them as a list into the data field
-    for obj in objects.values():
-        obj['data']['species'] = [{"value": v} for v in set([r['value']['labels'][0] for r in obj['predictions'][0]['result']])]
-
-    json_data = []
-    if len(objects) > 1000:
-        output_file = os.path.splitext(output_file)[0]
-        for i, prediction in enumerate(objects.values()):
-            if i % 1000 == 0 and i > 0:
-                step = i - 999
-                with open(f'{output_file}_{step}.json', 'w') as file:
-                    json.dump(json_data, file, indent=2)
-                json_data = []
-            json_data.append(prediction)
+            for row in rows:
+                result = {
+                    "original_length": 55,
+                    "value": {
+                        "start": row['start_time'],
+                        "end": row['end_time'],
+                        "low_freq": row['low_freq'],
+                        "high_freq": row['high_freq'],
+                        "score": row['class_prob'],
+                        "labels": [ row['class'] ]
+                    },
+                    "from_name": "label",
+                    "to_name": "audio",
+                    "type": "labels"
+                }
+                task['predictions'][0]['result'].append(result)
 
-        if len(json_data):
-            with open(f'{output_file}_last.json', 'w') as file:
-                json.dump(json_data, file, indent=2)
-    else:
-        with open(output_file, 'w') as file:
-            json.dump(list(json_data), file, indent=2)
+            # extract the labels from the predictions, insert them as a list into the data field
+            task['data']['species'] = [{"value": v} for v in set([r['value']['labels'][0] for r in task['predictions'][0]['result']])]
+            writer.write(task)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Import records from a CSV file (export from DB) and output them as JSON tasks for LabelStudio.')
     parser.add_argument('output_file', type=str, help='Output JSON file')
+    add_arguments(parser)
     args = parser.parse_args()
 
-    main(args.output_file)
+    main(args.output_file, args.shard_size, args.shard_name)
@@ -113,4 +113,5 @@ WHERE t.config_id = 1 and r.confidence >= 0.4
     'Asio otus',
     'Saxicola rubicola'
   )
+ORDER BY object_name -- rows of a file are consecutive, see import_annotations.py
 ;
@@ -0,0 +1,138 @@
+'''
+Streaming export of Label Studio tasks.
+
+The import scripts in the `label-studio` folders produce task lists for Label
+Studio. Instead of collecting all tasks in memory, they pass them to a
+`TaskWriter` as they are produced, which writes them to JSON files (one task
+per line) of at most `shard_size` tasks.
+
+If all tasks fit into one shard, the output is written to `output_file`,
+otherwise the shards are named after `shard_name`, a format string with the
+fields `stem` and `ext` (of `output_file`), `index` (of the shard, from 1) and
+`first` (number of the first task in the shard, from 1). If the export fails,
+the files written are renamed to `<file>.partial`.
+'''
+
+import json
+import os
+
+SHARD_SIZE = 1000 # tasks per file, label studio imports files up to ~250MB
+SHARD_NAME = '{stem}_{index:03d}{ext}'
+
+class TaskWriter:
+
+    def __init__(self, output_file, shard_size=SHARD_SIZE, shard_name=SHARD_NAME):
+        if shard_size < 1:
+            raise ValueError('shard_size must be at least 1')
+        self.output_file = output_file
+        self.shard_size = shard_size
+        self.shard_name = shard_name
+        self.stem, self.ext = os.path.splitext(output_file)
+        self.file = None
+        self.count = 0 # tasks written
+        self.files = [] # files written
+
+    def shard_file(self, index):
+        return self.shard_name.format(stem=self.stem, ext=self.ext, index=index, first=(index - 1) * self.shard_size + 1)
+
+    def write(self, task):
+        if self.count % self.shard_size == 0:
+            self.close_shard()
+            if self.count == 0:
+                self.files.append(self.output_file)
+            else:
+                if self.count == self.shard_size:
+                    # there is more than one shard, rename the first one
+                    os.replace(self.output_file, self.shard_file(1))
+                    self.files[0] = self.shard_file(1)
+                self.files.append(self.shard_file(len(self.files) + 1))
+                print(f'writing {self.files[-1]}, {self.count} tasks written')
+            self.file = open(self.files[-1], 'w')
+            self.file.write('[\n')
+        else:
+            self.file.write(',\n')
+        self.file.write(json.dumps(task, separators=(',', ':')))
+        self.count += 1
+
+    def close_shard(self):
+        if self.file is not None:
+            self.file.write('\n]\n')
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        '''Finish the last shard, returns the list of files written'''
+        if self.count == 0 and len(self.files) == 0:
+            # write an empty task list
+            with open(self.output_file, 'w') as file:
+                file.write('[]\n')
+            self.files.append(self.output_file)
+        self.close_shard()
+        return self.files
+
+    def abort(self):
+        '''
+        Close the last shard without finishing it, and rename the files written
+        to `<file>.partial`: an incomplete export is not imported by mistake.
+        '''
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        for i, file in enumerate(self.files):
+            if os.path.exists(file):
+                os.replace(file, file + '.partial')
+            self.files[i] = file + '.partial'
+        if len(self.files) > 0:
+            print(f'export failed, {self.count} tasks written to {", ".join(self.files)}')
+        return self.files
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def add_arguments(parser):
+    '''Add the shard options to an argument parser'''
+    parser.add_argument('--shard_size', type=int, help=f'maximum number of tasks per output file (default: {SHARD_SIZE})', default=SHARD_SIZE)
+    parser.add_argument('--shard_name', type=str, help=f'name of the output files if there is more than one, with the fields stem, ext, index and first (default: {SHARD_NAME})', default=SHARD_NAME)
+
+def group_rows(rows, key):
+    '''
+    Group consecutive rows with the same `key(row)`, yields (key, [rows]).
+
+    The rows of a task are expected to be consecutive (the input sorted by the
+    key), a ValueError is raised if a key reappears.
+    '''
+    seen = set()
+    group_key = None
+    group = []
+    for row in rows:
+        k = key(row)
+        if len(group) > 0 and k != group_key:
+            yield group_key, group
+            group = []
+        if len(group) == 0:
+            if k in seen:
+                raise ValueError(f'rows of {k} are not consecutive, sort the input by this key')
+            seen.add(k)
+            group_key = k
+        group.append(row)
+    if len(group) > 0:
+        yield group_key, group
+
+def query_rows(conn, query, params=None, server_side=False, itersize=2000):
+    '''
+    Execute `query` and iterate over the result rows.
+
+    With `server_side`, a named cursor fetches the rows from the server in
+    batches of `itersize` rows, instead of loading the whole result at once.
+    '''
+    with conn.cursor(name='labelstudio_export' if server_side else None) as cur:
+        if server_side:
+            cur.itersize = itersize
+        cur.execute(query, params)
+        yield from cur
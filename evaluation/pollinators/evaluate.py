@@ -1,8 +1,11 @@
 import argparse
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import psycopg2 as pg
 from minio import Minio
+import urllib3
 import sys
 
 from tqdm import tqdm
@@ -15,107 +18,250 @@ This script is used to compare the ground truth data (labels created manually in
 [label studio](label.mitwelten.org)) with the predictions in the database.
 '''
 
-def read_tasks_from_minio(cache_file):
-    # read all tasks from minio storage
+def read_manifest(manifest_file):
+    '''Read the manifest of the task cache: object name -> {'etag', 'last_modified', 'offset', 'size'}'''
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+def write_manifest(manifest_file, manifest):
+    # write to a temporary file first, the manifest is only replaced once complete
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+def read_tasks_from_minio(cache_file, manifest_file, workers=32):
+    '''
+    Update the task cache with the tasks in minio storage.
+
+    The cache is a JSON Lines file with one task per line, tasks are appended as
+    they are downloaded. The manifest records the etag and last modification of
+    each object in the bucket, and the offset of its task in the cache file
+    (None for objects that are not tasks of our projects). Only objects that
+    are new or have changed since the last run are downloaded, using `workers`
+    concurrent requests.
+    '''
     bucket = 'ixdm-mitwelten-labels'
     s3 = Minio(
         crd.minio.host,
         access_key=crd.minio.access_key,
         secret_key=crd.minio.secret_key,
+        http_client=urllib3.PoolManager(maxsize=workers,
+            retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]))
     )
-    object_list = s3.list_objects(bucket, recursive=False)
-    tasks = []
-    tqdm.write('reading tasks from minio storage...')
-    for obj in tqdm(object_list):
-        data = json.loads(s3.get_object(bucket, obj.object_name).read())
-        # 'file_id' is our custom field, and is the id used in files_images table in the database
-        if 'file_id' in data['task']['data']:
-            tasks.append(data)
-
-    # write tasks to json file
+    manifest = read_manifest(manifest_file)
+    if not os.path.exists(cache_file):
+        manifest = {}
+
+    tqdm.write('listing tasks in minio storage...')
+    listed = { obj.object_name: obj for obj in s3.list_objects(bucket, recursive=False) }
+    changed = [name for name, obj in listed.items() if name not in manifest or manifest[name]['etag'] != obj.etag]
+    deleted = [name for name in manifest if name not in listed]
+    for name in deleted:
+        del manifest[name]
+    tqdm.write(f'{len(listed)} objects, {len(changed)} new or changed, {len(deleted)} deleted')
+
+    def fetch(name):
+        response = s3.get_object(bucket, name)
+        try:
+            return name, json.loads(response.read())
+        finally:
+            response.close()
+            response.release_conn()
+
+    # without manifest the offsets in an existing cache file are unknown, start over
     os.makedirs(os.path.dirname(cache_file), exist_ok=True)
-    with open(cache_file, 'w') as f:
-        json.dump(tasks, f)
-
-def intersect(x1, y1, w1, h1, x2, y2, w2, h2):
-    x_left = max(x1,x2)
-    y_top = max(y1,y2)
-    x_right = min(x1+w1,x2+w2)
-    y_bottom = min(y1+h1,y2+h2)
-    if x_right < x_left or y_bottom < y_top:
-        return 0
-    return (x_right - x_left) * (y_bottom - y_top)
-
-def iou(x1, y1, w1, h1, x2, y2, w2, h2):
-    intersection = intersect(x1, y1, w1, h1, x2, y2, w2, h2)
-    union = w1 * h1 + w2 * h2 - intersection
-    return intersection / union
-
-def match_p(gt, p_rects, threshold=0.5):
+    with open(cache_file, 'ab' if len(manifest) > 0 else 'wb') as f, ThreadPoolExecutor(workers) as executor:
+        try:
+            for name, data in tqdm(executor.map(fetch, changed), total=len(changed)):
+                entry = { 'etag': listed[name].etag, 'last_modified': None, 'offset': None, 'size': 0 }
+                if listed[name].last_modified:
+                    entry['last_modified'] = listed[name].last_modified.isoformat()
+                # 'file_id' is our custom field, and is the id used in files_images table in the database
+                if 'file_id' in data['task']['data']:
+                    line = json.dumps(data, separators=(',', ':')).encode() + b'\n'
+                    entry['offset'] = f.tell()
+                    entry['size'] = len(line)
+                    f.write(line)
+                manifest[name] = entry
+        finally:
+            # keep the downloaded tasks should the update be interrupted
+            f.flush()
+            os.fsync(f.fileno())
+            write_manifest(manifest_file, manifest)
+
+    # rewrite the cache once most of it consists of replaced tasks
+    if sum(entry['size'] for entry in manifest.values()) < os.path.getsize(cache_file) / 2:
+        tqdm.write('compacting task cache...')
+        entries = sorted((e for e in manifest.values() if e['offset'] is not None), key=lambda e: e['offset'])
+        with open(cache_file, 'rb') as src, open(cache_file + '.tmp', 'wb') as dst:
+            for entry in entries:
+                src.seek(entry['offset'])
+                entry['offset'] = dst.tell()
+                dst.write(src.read(entry['size']))
+        # an interrupted compaction leaves no manifest, and the cache is rebuilt on the next run
+        os.remove(manifest_file)
+        os.replace(cache_file + '.tmp', cache_file)
+        write_manifest(manifest_file, manifest)
+
+def read_tasks(cache_file, manifest_file):
+    '''Lazily read the current tasks from the cache, ordered by object name as listed in the bucket'''
+    manifest = read_manifest(manifest_file)
+    with open(cache_file, 'rb') as f:
+        for name in sorted(manifest):
+            if manifest[name]['offset'] is not None:
+                f.seek(manifest[name]['offset'])
+                yield json.loads(f.read(manifest[name]['size']))
+
+def rect_array(rects):
     '''
-    match prediction
+    Classes and boxes of ground truth rectangles as arrays.
 
-    gt: ground truth rectangle
+    rects: ground truth rectangles (label studio values)
         {'height': 5.387647831800252,
         'rectanglelabels': ['daisy'],
         'rotation': 0,
         'width': 3.9466970119800706,
         'x': 55.352522946178254,
         'y': 65.17739816031539}
-    p_rects: prediction rectangles
-        ('daisy',
-        0.8567697,
-        Decimal('41.8814432989690722'),
-        Decimal('44.7654462242562929'),
-        Decimal('2.5987972508591065'),
-        Decimal('3.9473684210526316'))
+
+    returns classes (N,) and boxes (N, 4: x, y, width, height)
     '''
-    # 0 confidence, 1 class, 2 x, 3 y, 4 width, 5 height
-    for i, p in enumerate(p_rects):
-        # match class
-        if gt['rectanglelabels'][0] != p[0]:
-            continue
-        # match rectangle
-        if iou(
-            gt['x'], gt['y'], gt['width'], gt['height'],
-            float(p[2]), float(p[3]), float(p[4]), float(p[5])) > threshold:
-            return i
-    return None
-
-def match_gt(p, gt_rects, threshold=0.5):
-    'match ground truth'
-    # 0 confidence, 1 class, 2 x, 3 y, 4 width, 5 height
-    for i, gt in enumerate(gt_rects):
-        # match class
-        if p[0] != gt['rectanglelabels'][0]:
-            continue
-        # match rectangle
-        metric = iou(
-            gt['x'], gt['y'], gt['width'], gt['height'],
-            float(p[2]), float(p[3]), float(p[4]), float(p[5]))
-        if metric > threshold:
-            return i
-    return None
-
-def match_all(gt_rects, p_rects, threshold=0.5):
-    false_positives = [] # p_rects that are not matched
-    false_negatives = [] # gt_rects that are not matched
-    true_positives  = [] # gt_rects that are matched
-    for gt in gt_rects:
-        # match_index is the index of the matched rectangle in p_rects
-        match_index = match_p(gt, p_rects, threshold)
-        if match_index is not None:
-            true_positives.append({ 'gt': gt, 'p': p_rects[match_index] })
-        else:
-            false_negatives.append(gt)
-    # false positives are all p_rects that are not matched
-    for p in p_rects:
-        match_index = match_gt(p, gt_rects, threshold)
-        if match_index is None:
-            false_positives.append(p)
-    return (false_positives, false_negatives, true_positives)
-
-def evaluate_with_groundtruth(tasks, threshold_flowers, threshold_pollinators):
+    classes = np.array([r['rectanglelabels'][0] for r in rects], dtype=str)
+    boxes = np.array([(r['x'], r['y'], r['width'], r['height']) for r in rects], dtype=float).reshape(-1, 4)
+    return classes, boxes
+
+def fetch_predictions(file_ids, cache_file=None):
+    '''
+    Fetch the flower and pollinator predictions of all `file_ids`, in one query each.
+
+    returns a dict with the keys 'flowers' and 'pollinators', each holding a dict
+    of arrays sorted by file_id: 'file_id' (N,), 'label' (N,), 'score' (N,) and
+    'box' (N, 4: x0, y0, x1, y1 in pixels).
+
+    if `cache_file` is given, the predictions are stored in / loaded from this
+    file (NumPy .npz), the cache is used if it contains all `file_ids`.
+    '''
+    file_ids = sorted(set(file_ids))
+    columns = ('file_id', 'label', 'score', 'box')
+    if cache_file and os.path.exists(cache_file):
+        with np.load(cache_file) as cache:
+            if np.isin(file_ids, cache['file_ids']).all():
+                return { group: { c: cache[f'{group}_{c}'] for c in columns } for group in ('flowers', 'pollinators') }
+
+    predictions = {}
+    with pg.connect(host=crd.db.host, port=crd.db.port, database=crd.db.database, user=crd.db.user, password=crd.db.password) as conn:
+        tqdm.write('fetching predictions from database...')
+        for group in ('flowers', 'pollinators'):
+            with conn.cursor() as cur:
+                cur.execute('''
+                select ir.file_id, p.class, p.confidence, p.x0, p.y0, p.x1, p.y1
+                from prod.{} p
+                join prod.image_results ir on p.result_id = ir.result_id
+                where ir.result_id in (
+                    select min(result_id) from prod.image_results
+                    where file_id = any(%s)
+                    group by file_id
+                )
+                order by ir.file_id
+                '''.format(group), (file_ids,))
+                rows = cur.fetchall()
+            predictions[group] = {
+                'file_id': np.array([r[0] for r in rows], dtype=int),
+                'label': np.array([r[1] for r in rows], dtype=str),
+                'score': np.array([r[2] for r in rows], dtype=float),
+                'box': np.array([r[3:7] for r in rows], dtype=float).reshape(-1, 4),
+            }
+
+    if cache_file:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        np.savez_compressed(cache_file, file_ids=np.array(file_ids, dtype=int),
+            **{ f'{group}_{c}': predictions[group][c] for group in predictions for c in columns })
+    return predictions
+
+def predictions_for(predictions, file_id, width=None, height=None):
+    '''
+    Select the predictions of one file from a group returned by `fetch_predictions`.
+
+    returns classes (N,), scores (N,) and boxes (N, 4: x, y, width, height), in
+    percent of the image `width` and `height` if given (label studio format).
+    '''
+    start, end = np.searchsorted(predictions['file_id'], [file_id, file_id + 1])
+    classes = predictions['label'][start:end]
+    scores = predictions['score'][start:end]
+    boxes = np.zeros((end - start, 4))
+    if width and height:
+        x0, y0, x1, y1 = predictions['box'][start:end].T
+        boxes = np.stack((x0 * 100. / width, y0 * 100. / height, (x1 - x0) * 100. / width, (y1 - y0) * 100. / height), axis=1)
+    return classes, scores, boxes
+
+def iou_matrix(a, b):
+    '''IoU of all pairs of boxes in `a` (N, 4) and `b` (M, 4), boxes as x, y, width, height'''
+    x_left = np.maximum(a[:, None, 0], b[None, :, 0])
+    y_top = np.maximum(a[:, None, 1], b[None, :, 1])
+    x_right = np.minimum(a[:, None, 0] + a[:, None, 2], b[None, :, 0] + b[None, :, 2])
+    y_bottom = np.minimum(a[:, None, 1] + a[:, None, 3], b[None, :, 1] + b[None, :, 3])
+    intersection = np.clip(x_right - x_left, 0, None) * np.clip(y_bottom - y_top, 0, None)
+    union = (a[:, 2] * a[:, 3])[:, None] + (b[:, 2] * b[:, 3])[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+def match_all(gt_rects, p_rects, thresholds):
+    '''
+    Match predictions one-to-one to ground truth rectangles of the same class.
+
+    Predictions are assigned greedily in order of descending score, each to the
+    unmatched ground truth rectangle it overlaps most, if the IoU is above the
+    threshold.
+
+    p_rects: predictions as returned by `predictions_for` (classes, scores, boxes)
+
+    returns the scores of the predictions in descending order (P,) and which of
+    them are true positives for each of the IoU `thresholds` (T, P)
+    '''
+    gt_classes, gt_boxes = rect_array(gt_rects)
+    p_classes, p_scores, p_boxes = p_rects
+    order = np.argsort(-p_scores, kind='stable')
+    p_classes, p_scores, p_boxes = p_classes[order], p_scores[order], p_boxes[order]
+
+    ious = iou_matrix(p_boxes, gt_boxes)
+    ious[p_classes[:, None] != gt_classes[None, :]] = 0
+    matched = np.zeros((len(thresholds), len(p_scores)), dtype=bool)
+    if len(gt_rects) == 0:
+        return p_scores, matched
+    for t, threshold in enumerate(thresholds):
+        candidates = np.where(ious > threshold, ious, -1)
+        for i in range(len(p_scores)):
+            j = np.argmax(candidates[i])
+            if candidates[i, j] > threshold:
+                matched[t, i] = True
+                candidates[:, j] = -1 # ground truth rectangle is taken
+    return p_scores, matched
+
+def count_matches(gt_count, p_scores, matched, cutoffs):
+    '''
+    Count true positives, false positives and false negatives for all IoU
+    thresholds (rows of `matched`) and confidence `cutoffs`, returns a (3, T, C) array.
+
+    Greedy matching in order of score means the matches of the predictions
+    above a cutoff are the same as when matching only those predictions.
+    '''
+    # number of predictions with a score >= cutoff (scores are sorted descending)
+    counts = np.searchsorted(-p_scores, -np.asarray(cutoffs), side='right')
+    tp_cumulative = np.concatenate((np.zeros((matched.shape[0], 1), dtype=int), np.cumsum(matched, axis=1)), axis=1)
+    tp = tp_cumulative[:, counts]
+    fp = counts[None, :] - tp
+    fn = gt_count - tp
+    return np.stack((tp, fp, fn))
+
+def metrics(tp, fp, fn):
+    '''precision, recall and f1 score from counts (arrays of equal shape)'''
+    precision = np.divide(tp, tp + fp, out=np.ones(tp.shape), where=(tp + fp) != 0)
+    recall = np.divide(tp, tp + fn, out=np.ones(tp.shape), where=(tp + fn) != 0)
+    f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros(tp.shape), where=(precision + recall) != 0)
+    return precision, recall, f1
+
+def evaluate_with_groundtruth(tasks, thresholds_flowers, thresholds_pollinators, cutoffs, predictions_cache=None):
     '''
     # Evaluate predictions with manual labels
 
@@ -126,118 +272,67 @@ def evaluate_with_groundtruth(tasks, threshold_flowers, threshold_pollinators):
     ground truth data to evaluate the predictions inferred by our model from
     the same set of images.
 
-    the manual labels are associated to the predictions by finding the
-    prediction with the highest IoU (intersection over union) with the ground
-    truth label. if the IoU is above a certain threshold, then the prediction is
-    considered a true positive. if the IoU is below the threshold, then the
-    prediction is considered a false positive. if there is no prediction for a
-    ground truth label, then the label is considered a false negative.
+    the predictions are matched one-to-one to the manual labels of the same
+    class, in order of descending confidence, each to the label with the highest
+    IoU (intersection over union). if the IoU is above a certain threshold, then
+    the prediction is considered a true positive, otherwise a false positive. if
+    there is no prediction for a ground truth label, then the label is
+    considered a false negative.
 
     the precision, recall and f1 score are calculated for the flowers and
-    pollinators separately.
+    pollinators separately, for each IoU threshold and for the predictions
+    above each confidence cutoff.
     '''
 
     stats = {
-        'fl_fp': 0, 'fl_fn': 0, 'fl_tp': 0,
-        'po_fp': 0, 'po_fn': 0, 'po_tp': 0
+        'fl': np.zeros((3, len(thresholds_flowers), len(cutoffs)), dtype=int), # tp, fp, fn
+        'po': np.zeros((3, len(thresholds_pollinators), len(cutoffs)), dtype=int)
     }
 
-    with pg.connect(host=crd.db.host, port=crd.db.port, database=crd.db.database, user=crd.db.user, password=crd.db.password) as conn:
-        tqdm.write('comparing labels to predictions in database...')
-        for data in tqdm(tasks):
+    tasks = list(tasks)
+    predictions = fetch_predictions([int(data['task']['data']['file_id']) for data in tasks], predictions_cache)
 
-            file_id = int(data['task']['data']['file_id'])
+    tqdm.write('comparing labels to predictions...')
+    for data in tqdm(tasks):
 
-            with conn.cursor() as cur:
-                # get result id from file id
-                cur.execute('select result_id from prod.image_results where file_id = %s;', (file_id,))
-                result_id, = cur.fetchone()
-
-                if len(data['result']) > 0:
-                    w = int(data['result'][0]['original_width'])
-                    h = int(data['result'][0]['original_height'])
-                    # get flower predictions for result id
-                    cur.execute('''
-                    select
-                        f.class as label,
-                        f.confidence as score,
-                        f.x0 * 100. / %s as x,
-                        f.y0 * 100. / %s as y,
-                        (f.x1 - f.x0) * 100. / %s as width,
-                        (f.y1 - f.y0) * 100. / %s as height
-                    from prod.flowers f
-                    where f.result_id = %s
-                    and class not in ('wildemoere');
-                    ''', (w,h,w,h, result_id))
-                    p_flowers = cur.fetchall()
-
-                    # get pollinator predictions for result id
-                    cur.execute('''
-                    select
-                        p.class as label,
-                        p.confidence as score,
-                        p.x0 * 100. / %s as x,
-                        p.y0 * 100. / %s as y,
-                        (p.x1 - p.x0) * 100. / %s as width,
-                        (p.y1 - p.y0) * 100. / %s as height
-                    from prod.pollinators p
-                    where p.result_id = %s;
-                    ''', (w,h,w,h, result_id))
-                    p_pollinators = cur.fetchall()
-                else:
-                    cur.execute('''
-                    select
-                        f.class as label,
-                        f.confidence as score
-                    from prod.flowers f
-                    where f.result_id = %s;
-                    ''', (result_id,))
-                    p_flowers = cur.fetchall()
-                    cur.execute('''
-                    select
-                        f.class as label,
-                        f.confidence as score
-                    from prod.pollinators f
-                    where f.result_id = %s;
-                    ''', (result_id,))
-                    p_pollinators = cur.fetchall()
-
-            # get flower/pollinator rectangles from ground truth data
-            gt_flowers = [r['value'] for r in data['result'] if r['type'] == 'rectanglelabels' and r['from_name'] == 'flower']
-            gt_pollinators = [r['value'] for r in data['result'] if r['type'] == 'rectanglelabels' and r['from_name'] == 'pollinator']
-
-            # match ground truth rectangles with predictions
-            fl_fp, fl_fn, fl_tp = match_all(gt_flowers, p_flowers, threshold_flowers)
-            po_fp, po_fn, po_tp = match_all(gt_pollinators, p_pollinators, threshold_pollinators)
-
-            # update stats
-            stats['fl_fp'] += len(fl_fp)
-            stats['fl_fn'] += len(fl_fn)
-            stats['fl_tp'] += len(fl_tp)
-            stats['po_fp'] += len(po_fp)
-            stats['po_fn'] += len(po_fn)
-            stats['po_tp'] += len(po_tp)
+        file_id = int(data['task']['data']['file_id'])
+
+        if len(data['result']) > 0:
+            w = int(data['result'][0]['original_width'])
+            h = int(data['result'][0]['original_height'])
+            p_flowers = predictions_for(predictions['flowers'], file_id, w, h)
+            keep = p_flowers[0] != 'wildemoere'
+            p_flowers = tuple(a[keep] for a in p_flowers)
+            p_pollinators = predictions_for(predictions['pollinators'], file_id, w, h)
+        else:
+            # without labels, all predictions are false positives
+            p_flowers = predictions_for(predictions['flowers'], file_id)
+            p_pollinators = predictions_for(predictions['pollinators'], file_id)
+
+        # get flower/pollinator rectangles from ground truth data
+        gt_flowers = [r['value'] for r in data['result'] if r['type'] == 'rectanglelabels' and r['from_name'] == 'flower']
+        gt_pollinators = [r['value'] for r in data['result'] if r['type'] == 'rectanglelabels' and r['from_name'] == 'pollinator']
+
+        # match ground truth rectangles with predictions
+        stats['fl'] += count_matches(len(gt_flowers), *match_all(gt_flowers, p_flowers, thresholds_flowers), cutoffs)
+        stats['po'] += count_matches(len(gt_pollinators), *match_all(gt_pollinators, p_pollinators, thresholds_pollinators), cutoffs)
 
     # print stats
-    # flower scores
-    fl_precision = stats['fl_tp'] / (stats['fl_tp'] + stats['fl_fp']) if stats['fl_tp'] + stats['fl_fp'] != 0 else 1
-    fl_recall = stats['fl_tp'] / (stats['fl_tp'] + stats['fl_fn']) if stats['fl_tp'] + stats['fl_fn'] != 0 else 1
-    fl_f1 = 2 * (fl_precision * fl_recall) / (fl_precision + fl_recall) if fl_precision + fl_recall != 0 else 0
-    print('---')
-    print('flower scores')
-    print('precision:', fl_precision)
-    print('recall:', fl_recall)
-    print('f1 score:', fl_f1)
-
-    # pollinator scores
-    po_precision = stats['po_tp'] / (stats['po_tp'] + stats['po_fp']) if stats['po_tp'] + stats['po_fp'] != 0 else 1
-    po_recall = stats['po_tp'] / (stats['po_tp'] + stats['po_fn']) if stats['po_tp'] + stats['po_fn'] != 0 else 1
-    po_f1 = 2 * (po_precision * po_recall) / (po_precision + po_recall) if po_precision + po_recall != 0 else 0
-    print('---')
-    print('pollinator scores')
-    print('precision:', po_precision)
-    print('recall:', po_recall)
-    print('f1 score:', po_f1)
+    for group, name, thresholds in (('fl', 'flower', thresholds_flowers), ('po', 'pollinator', thresholds_pollinators)):
+        tp, fp, fn = stats[group]
+        precision, recall, f1 = metrics(tp, fp, fn)
+        print('---')
+        print(f'{name} scores')
+        if len(thresholds) == 1 and len(cutoffs) == 1:
+            print('precision:', precision[0, 0])
+            print('recall:', recall[0, 0])
+            print('f1 score:', f1[0, 0])
+            continue
+        print('iou', 'cutoff', 'tp', 'fp', 'fn', 'precision', 'recall', 'f1', sep='\t')
+        for t, threshold in enumerate(thresholds):
+            for c, cutoff in enumerate(cutoffs):
+                print(threshold, cutoff, tp[t, c], fp[t, c], fn[t, c],
+                    f'{precision[t, c]:.3f}', f'{recall[t, c]:.3f}', f'{f1[t, c]:.3f}', sep='\t')
 
 def evaluate_with_confidence(tasks):
     '''
@@ -320,47 +415,49 @@ def evaluate_with_confidence(tasks):
     for c in confidences:
         print(f'{confidences[c]:.3f}', c, sep='\t')
 
-def main(mode, project_id, user_id, threshold_flowers, threshold_pollinators):
-    # read tasks from minio storage
-    cache_file = f'ground_truth/labelstudio_tasks.json'
-    if not os.path.exists(cache_file):
-        read_tasks_from_minio(cache_file)
+def main(mode, project_id, user_id, thresholds_flowers, thresholds_pollinators, cutoffs, refresh_predictions=False, offline=False):
+    # update the tasks from minio storage
+    cache_file = f'ground_truth/labelstudio_tasks.jsonl'
+    manifest_file = f'ground_truth/labelstudio_tasks.manifest.json'
+    predictions_cache = f'ground_truth/predictions.npz'
+    if refresh_predictions and os.path.exists(predictions_cache):
+        os.remove(predictions_cache)
+    if not offline or not os.path.exists(manifest_file):
+        read_tasks_from_minio(cache_file, manifest_file)
 
     if mode == 'confidences':
         origins = ['prediction-changed', 'prediction']
     if mode == 'labels':
         origins = ['manual']
 
-    # read tasks from json file
+    # read tasks from the cache
     tasks_grouped = {}
-    with open(cache_file, 'r') as f:
-        tasks = json.load(f)
-        # there are multiple objects with the same task id those are labels by
-        # different users. group the objects by task id.
-        for t in tasks:
-            if t['task']['project'] != project_id:
-                continue
-            if t['task']['is_labeled'] == False: # tasks without targets that are completed have this set to True.
-                continue
-            if t['was_cancelled'] == True:
-                continue
-
-            task_user = t['completed_by']['id']
-            task_id = t['task']['id']
-            if task_user not in tasks_grouped:
-                tasks_grouped[task_user] = {}
-            if task_id not in tasks_grouped[task_user]:
-                tasks_grouped[task_user][task_id] = {}
-            result = [r for r in t['result'] if r['origin'] in origins and r['from_name'] in ['pollinator', 'flower']]
-            confidence = [r for r in t['result'] if r['origin'] in origins and r['from_name'] == 'confidence']
-            tasks_grouped[task_user][task_id] = { 'task': t['task'], 'result': result, 'confidence': confidence, 'project': t['project'] }
+    # there are multiple objects with the same task id those are labels by
+    # different users. group the objects by task id.
+    for t in read_tasks(cache_file, manifest_file):
+        if t['task']['project'] != project_id:
+            continue
+        if t['task']['is_labeled'] == False: # tasks without targets that are completed have this set to True.
+            continue
+        if t['was_cancelled'] == True:
+            continue
+
+        task_user = t['completed_by']['id']
+        task_id = t['task']['id']
+        if task_user not in tasks_grouped:
+            tasks_grouped[task_user] = {}
+        if task_id not in tasks_grouped[task_user]:
+            tasks_grouped[task_user][task_id] = {}
+        result = [r for r in t['result'] if r['origin'] in origins and r['from_name'] in ['pollinator', 'flower']]
+        confidence = [r for r in t['result'] if r['origin'] in origins and r['from_name'] == 'confidence']
+        tasks_grouped[task_user][task_id] = { 'task': t['task'], 'result': result, 'confidence': confidence, 'project': t['project'] }
 
     print('running mode:', mode)
     print('project id:', project_id)
     print('user id:', user_id)
     print(f'found {len(tasks_grouped[user_id])} tasks')
     if mode == 'labels':
-        print(f'thresholds: flowers = {threshold_flowers}, pollinators = {threshold_pollinators}')
+        print(f'thresholds: flowers = {thresholds_flowers}, pollinators = {thresholds_pollinators}, confidence cutoffs = {cutoffs}')
 
     # count tasks that have confidence labels
     annotated_rectangles = 0
@@ -402,15 +499,18 @@ def main(mode, project_id, user_id, threshold_flowers, threshold_pollinators):
 
     # evaluate predictions with manual labels
     if mode == 'labels':
-        evaluate_with_groundtruth(tasks_grouped[user_id].values(), threshold_flowers, threshold_pollinators)
+        evaluate_with_groundtruth(tasks_grouped[user_id].values(), thresholds_flowers, thresholds_pollinators, cutoffs, predictions_cache)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Evaluate predictions with ground truth data.')
     parser.add_argument('mode', type=str, help='Mode: Compare predictions with manual labels or manual confidences', choices=['labels', 'confidences'])
     parser.add_argument('-p', '--project_id', type=int, help='Label Studio Project ID', default=5)
     parser.add_argument('-u', '--user_id', type=int, help='Label Studio User ID', default=5)
-    parser.add_argument('-tf', '--threshold_flowers', type=float, help='IoU threshold for matching flowers (0...1)', default=0.4)
-    parser.add_argument('-tp', '--threshold_pollinators', type=float, help='IoU threshold for matching pollinators (0...1)', default=0.3)
+    parser.add_argument('-tf', '--threshold_flowers', type=float, nargs='+', help='IoU threshold(s) for matching flowers (0...1)', default=[0.4])
+    parser.add_argument('-tp', '--threshold_pollinators', type=float, nargs='+', help='IoU threshold(s) for matching pollinators (0...1)', default=[0.3])
+    parser.add_argument('-c', '--confidence_cutoffs', type=float, nargs='+', help='only evaluate predictions with a confidence >= cutoff(s) (0...1)', default=[0.])
+    parser.add_argument('--refresh_predictions', action='store_true', help='fetch the predictions from the database, ignoring the cache')
+    parser.add_argument('--offline', action='store_true', help='use the cached tasks without checking minio storage for changes')
     args = parser.parse_args()
 
     '''
@@ -423,6 +523,10 @@ if __name__ == '__main__':
 
     `python evaluate.py labels -p 5 -u 5 -tf 0.4 -tp 0.3`
 
+    Sweep IoU thresholds and confidence cutoffs
+
+    `python evaluate.py labels -p 5 -u 5 -tf 0.3 0.5 0.7 -tp 0.3 0.5 -c 0 0.25 0.5 0.75`
+
     ## Evaluate predictions with manual confidences
 
     Evaluate predictions of project 10, user 5,
@@ -431,4 +535,4 @@ if __name__ == '__main__':
     `python evaluate.py confidences -p 10 -u 5`
     '''
 
-    main(args.mode, args.project_id, args.user_id, args.threshold_flowers, args.threshold_pollinators)
+    main(args.mode, args.project_id, args.user_id, args.threshold_flowers, args.threshold_pollinators, args.confidence_cutoffs, args.refresh_predictions, args.offline)
@@ -1,108 +1,118 @@
 import csv
-import json
 import argparse
 import os
 import re
 import sys
 import psycopg2 as pg
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.append('../../..')
 import credentials as crd
 
+sys.path.append('../..')
+from labelstudio_export import TaskWriter, add_arguments
+
 labels = ('daisy', 'wildemoere', 'flockenblume')
+filename_pattern = re.compile(r'(?P<nodelabel>\d{4}-\d{4})_(?P<date>\d{4}-\d{2}-\d{2})T(?P<time>\d{2}-\d{2}-\d{2})Z')
 
 # import predictions from a csv file and output them as json for labelstudio
 
-def main(labelset, output_file):
-    objects = {}
-    with pg.connect(host=crd.db.host, port=crd.db.port, database=crd.db.database, user=crd.db.user, password=crd.db.password) as conn:
-        for csv_file in labelset:
-            # Step 1: Read the CSV file and create a list of predictions
-            task = {}
-            with open(csv_file, 'r') as file:
-                # format: class(int), x(float), y(float), width(float), height(float)
-                # i.e: 0 0.7817073170731708 0.8944805194805194 0.0475609756097561 0.06168831168831169
-                csv_reader = csv.DictReader(file, delimiter=' ', fieldnames=['class', 'x', 'y', 'width', 'height'])
-                object_key = os.path.splitext(os.path.basename(csv_file))[0]
-                p = re.compile(r'(?P<nodelabel>\d{4}-\d{4})_(?P<date>\d{4}-\d{2}-\d{2})T(?P<time>\d{2}-\d{2}-\d{2})Z')
-                i = p.match(object_key).groupdict()
-                object_name = f"{i['nodelabel']}/{i['date']}/{i['time'][0:2]}/{object_key}.jpg"
-                # check if object exists in db
-                with conn.cursor() as cur:
-                    cur.execute('select file_id, resolution from prod.files_image where object_name = %s;', (object_name,))
-                    row = cur.fetchone()
-                    if row is None:
-                        print(f'object {object_name} not found in db')
-                        continue
-                    else:
-                        # extract file_id, width and height from db
-                        i['file_id'] = row[0]
-                        i['width'] = row[1][0]
-                        i['height'] = row[1][1]
-                task = {
-                    "data": {
-                        "file_id": i['file_id'],
-                        "header": f"{i['nodelabel']} {i['date'].replace('-','.')} {i['time'].replace('-',':')} UTC",
-                        "image": f"s3://ixdm-mitwelten/{object_name}"
-                    },
-                    "predictions": [
-                        {
-                            "model_version": 'training_set',
-                            "result": []
-                        }
+def parse_filename(csv_file):
+    '''Parse node label, date and time from the name of a label file, and derive the object name of the image'''
+    object_key = os.path.splitext(os.path.basename(csv_file))[0]
+    i = filename_pattern.match(object_key).groupdict()
+    i['object_name'] = f"{i['nodelabel']}/{i['date']}/{i['time'][0:2]}/{object_key}.jpg"
+    return i
+
+def read_task(csv_file, i):
+    '''Read a label file and create the task of its image'''
+    task = {
+        "data": {
+            "file_id": i['file_id'],
+            "header": f"{i['nodelabel']} {i['date'].replace('-','.')} {i['time'].replace('-',':')} UTC",
+            "image": f"s3://ixdm-mitwelten/{i['object_name']}"
+        },
+        "predictions": [
+            {
+                "model_version": 'training_set',
+                "result": []
+            }
+        ]
+    }
+    with open(csv_file, 'r') as file:
+        # format: class(int), x(float), y(float), width(float), height(float)
+        # i.e: 0 0.7817073170731708 0.8944805194805194 0.0475609756097561 0.06168831168831169
+        csv_reader = csv.DictReader(file, delimiter=' ', fieldnames=['class', 'x', 'y', 'width', 'height'])
+        for row in csv_reader:
+            result = {
+                "original_width": int(i['width']),
+                "original_height": int(i['height']),
+                "image_rotation": 0,
+                "value": {
+                    "x": (float(row['x']) - (float(row['width']) / 2)) * 100,
+                    "y": (float(row['y']) - (float(row['height']) / 2)) * 100,
+                    "width": float(row['width']) * 100,
+                    "height": float(row['height']) * 100,
+                    "rotation": 0,
+                    "rectanglelabels": [
+                        labels[int(row['class'])]
                     ]
-                }
-                for row in csv_reader:
-                    result = {
-                        "original_width": int(i['width']),
-                        "original_height": int(i['height']),
-                        "image_rotation": 0,
-                        "value": {
-                            "x": (float(row['x']) - (float(row['width']) / 2)) * 100,
-                            "y": (float(row['y']) - (float(row['height']) / 2)) * 100,
-                            "width": float(row['width']) * 100,
-                            "height": float(row['height']) * 100,
-                            "rotation": 0,
-                            "rectanglelabels": [
-                                labels[int(row['class'])]
-                            ]
-                        },
-                        # "id": row['inference_id'],
-                        "from_name": "flower",
-                        "to_name": "image",
-                        "type": "rectanglelabels",
-                        "readonly": True
-                    }
-                    task['predictions'][0]['result'].append(result)
-                objects[object_name] = task
-    # Step 2: Split the JSON data into chunks of 1000 objects
-    json_data = []
-    pval = objects.values()
-    if len(objects) > 1000:
-        output_file = os.path.splitext(output_file)[0]
-        for i, prediction in enumerate(objects.values()):
-            if i % 1000 == 0 and i > 0:
-                print(f'processing {i} of {len(pval)}')
-                step = i - 999
-                with open(f'{output_file}_{step}.json', 'w') as file:
-                    json.dump(json_data, file, indent=2)
-                json_data = []
-            json_data.append(prediction)
+                },
+                # "id": row['inference_id'],
+                "from_name": "flower",
+                "to_name": "image",
+                "type": "rectanglelabels",
+                "readonly": True
+            }
+            task['predictions'][0]['result'].append(result)
+    return task
+
+def main(labelset, output_file, shard_size, shard_name, workers):
+    # Step 1: Parse the filenames and look up all images in the db at once
+    parsed = [parse_filename(csv_file) for csv_file in labelset]
+    with pg.connect(host=crd.db.host, port=crd.db.port, database=crd.db.database, user=crd.db.user, password=crd.db.password) as conn:
+        with conn.cursor() as cur:
+            cur.execute('select object_name, file_id, resolution from prod.files_image where object_name = any(%s);',
+                (list({i['object_name'] for i in parsed}),))
+            records = { object_name: (file_id, resolution) for object_name, file_id, resolution in cur }
+
+    # tasks of files that appear in several sets of labels are only written once:
+    # with the labels of the last set, at the position of the first
+    selected = []
+    objects = {} # object_name -> index in selected
+    for csv_file, i in zip(labelset, parsed):
+        if i['object_name'] not in records:
+            print(f"object {i['object_name']} not found in db")
+            continue
+        # extract file_id, width and height from db
+        file_id, resolution = records[i['object_name']]
+        i['file_id'] = file_id
+        i['width'] = resolution[0]
+        i['height'] = resolution[1]
+        if i['object_name'] in objects:
+            selected[objects[i['object_name']]] = (csv_file, i)
+        else:
+            objects[i['object_name']] = len(selected)
+            selected.append((csv_file, i))
 
-        if len(json_data):
-            with open(f'{output_file}_last.json', 'w') as file:
-                json.dump(json_data, file, indent=2)
-    else:
-        output_file = f'{output_file}'
-        for i, prediction in enumerate(objects.values()):
-            json_data.append(prediction)
-        with open(output_file, 'w') as file:
-            json.dump(json_data, file, indent=2)
+    # Step 2: Read the label files in parallel, write the tasks in order
+    # at most `workers * 4` files are read ahead of the writer, to bound the tasks held in memory
+    with TaskWriter(output_file, shard_size, shard_name) as writer, ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        for csv_file, i in selected:
+            if len(pending) >= workers * 4:
+                writer.write(pending.popleft().result())
+            pending.append(executor.submit(read_task, csv_file, i))
+        while pending:
+            writer.write(pending.popleft().result())
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Import training/test labels from a textfiles and output them as JSON for LabelStudio.')
     parser.add_argument('input_path', type=str, help='Input Path')
     parser.add_argument('output_path', type=str, help='Output Path')
+    parser.add_argument('--workers', type=int, help='number of label files read in parallel (default: 16)', default=16)
+    add_arguments(parser)
     args = parser.parse_args()
 
     test_labels = []
@@ -116,5 +126,5 @@ if __name__ == '__main__':
                 else:
                     training_labels.append(os.path.join(root, file))
 
-    main(test_labels, args.output_path + '/test.json')
-    main(training_labels, args.output_path + '/training.json')
+    main(test_labels, args.output_path + '/test.json', args.shard_size, args.shard_name, args.workers)
+    main(training_labels, args.output_path + '/training.json', args.shard_size, args.shard_name, args.workers)
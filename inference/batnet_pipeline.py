@@ -8,28 +8,23 @@
     - upload the detection results to postgres database
 '''
 
-# patch the SoundFile class to respond with
-# a path str to calls of os.path.basename()
-def custom_path(self):
-    return self.__file_path__
-
-from soundfile import SoundFile
-SoundFile.__fspath__ = custom_path
-
 import io
 import sys
-import time
+import argparse
 import traceback
 import psycopg2 as pg
 from psycopg2 import errors
-from minio import Minio
 
+# batdetect2 (torch), soundfile and minio are imported in main(),
+# parsing the arguments doesn't wait for the model stack
 sys.path.append('batnet_pipeline/batdetect2/')
-import batdetect2.api as api
-from batdetect2.detector.parameters import DEFAULT_MODEL_PATH
 
 sys.path.append('../')
 import credentials as crd
+import task_dispatch
+from task_telemetry import TaskTimer
+import pipeline_metrics
+from task_profiler import TaskProfiler
 
 def get_tasks():
     db_gen = pg.connect(
@@ -39,6 +34,7 @@ def get_tasks():
         user=crd.db.user,
         password=crd.db.password
     )
+    task_dispatch.listen(db_gen, 'batnet_tasks')
     while True:
         try:
             # https://www.postgresql.org/docs/current/explicit-locking.html
@@ -50,6 +46,7 @@ def get_tasks():
             where task_id in (
                 select task_id from {crd.db.schema}.batnet_tasks
                 where state = 0
+                order by task_id -- cheap with the partial index on pending tasks (task_dispatch.sql)
                 for update skip locked
                 limit 1
             )
@@ -60,12 +57,13 @@ def get_tasks():
             if task:
                 yield task
             else:
-                print('sleeping...', end='\r')
-                time.sleep(10)
+                print('waiting for tasks...', end='\r')
+                task_dispatch.wait(db_gen, 10)
         except (errors.OperationalError, errors.InterfaceError) as e:
             print(f'queuing task failed ({str(e)}), retrying.', flush=True)
             # reopen connection, recreate cursor
             db_gen = pg.connect(host=crd.db.host, port=crd.db.port, database=crd.db.database, user=crd.db.user, password=crd.db.password)
+            task_dispatch.listen(db_gen, 'batnet_tasks')
         except KeyboardInterrupt:
             break
         except GeneratorExit:
@@ -76,7 +74,18 @@ def get_tasks():
             break
     db_gen.close()
 
-def main():
+# patch the SoundFile class to respond with
+# a path str to calls of os.path.basename()
+def custom_path(self):
+    return self.__file_path__
+
+def main(metrics_port=None, profile_every=None, profile_dir='profiles'):
+    from soundfile import SoundFile
+    SoundFile.__fspath__ = custom_path
+    from minio import Minio
+    import batdetect2.api as api
+    from batdetect2.detector.parameters import DEFAULT_MODEL_PATH
+
     db = pg.connect(
         host=crd.db.host,
         port=crd.db.port,
@@ -120,12 +129,22 @@ def main():
     '''
 
     cur = db.cursor()
+    timer = TaskTimer()
+    profiler = TaskProfiler(profile_dir, profile_every, 'batnet')
+
+    metrics = None
+    if metrics_port is not None:
+        metrics = pipeline_metrics.start(metrics_port, 'batnet',
+            lambda: pg.connect(host=crd.db.host, port=crd.db.port, database=crd.db.database, user=crd.db.user, password=crd.db.password),
+            f'{crd.db.schema}.batnet_tasks')
 
     # iterate over the object names
     for task in get_tasks():
+        timer.reset()
         try:
             # pickup the task and update pickup_on
             task_id, file_id, config_id = task
+            profiler.start(task_id, config_id)
             cur.execute(start_query, (task_id,))
             db.commit()
             # print(f'starting task id {task_id}, file id {file_id}')
@@ -139,47 +158,66 @@ def main():
             # print(f'got object name {object_name}')
 
             # download the object from minio storage
-            response = s3.get_object(crd.minio.bucket, object_name)
-            bytes_buffer = io.BytesIO(response.read())
-            audio_file = SoundFile(bytes_buffer)
+            with timer.stage('download'):
+                response = s3.get_object(crd.minio.bucket, object_name)
+                bytes_buffer = io.BytesIO(response.read())
+            timer.bytes_read = bytes_buffer.getbuffer().nbytes
+            with timer.stage('decode'):
+                audio_file = SoundFile(bytes_buffer)
             audio_file.__file_path__ = str(task_id)
+            timer.audio_seconds = audio_file.frames / audio_file.samplerate
             # audio, samplerate = sf.read(bytes_buffer, dtype='float32')
             # print(f'downloaded {object_name}')
 
             # run bat call detection on the object
-            inference = api.process_file(audio_file, model=model, config=config)
+            # (batdetect2 reads the samples, computes the spectrogram and post-processes in one call)
+            with timer.stage('inference'):
+                inference = api.process_file(audio_file, model=model, config=config)
             results = inference['pred_dict']['annotation']
             # print(f'processed {object_name}, {len(results)} results')
 
             # upload the detection results to postgres database
-            if len(results) > 0:
-                for r in results:
-                    cur.execute(f'''
-                        insert into {crd.db.schema}.batnet_results
-                        (task_id, file_id, class, event, individual, class_prob, det_prob, start_time, end_time, high_freq, low_freq)
-                        values
-                        (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
-                    ''', (
-                        task_id, file_id,
-                        r['class'],
-                        r['event'],
-                        r['individual'],
-                        r['class_prob'],
-                        r['det_prob'],
-                        r['start_time'],
-                        r['end_time'],
-                        r['high_freq'],
-                        r['low_freq'],
-                    ))
-            cur.execute(finish_query, (task_id,))
-            db.commit()
+            with timer.stage('db_write'):
+                if len(results) > 0:
+                    for r in results:
+                        cur.execute(f'''
+                            insert into {crd.db.schema}.batnet_results
+                            (task_id, file_id, class, event, individual, class_prob, det_prob, start_time, end_time, high_freq, low_freq)
+                            values
+                            (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
+                        ''', (
+                            task_id, file_id,
+                            r['class'],
+                            r['event'],
+                            r['individual'],
+                            r['class_prob'],
+                            r['det_prob'],
+                            r['start_time'],
+                            r['end_time'],
+                            r['high_freq'],
+                            r['low_freq'],
+                        ))
+                cur.execute(finish_query, (task_id,))
+                db.commit()
             print(f'completed {object_name}')
+            timer.save(db, crd.db.schema, 'batnet', task_id, config_id)
+            if metrics is not None:
+                metrics.task_done(timer)
             # api.print_summary(results)
         except:
             print(traceback.format_exc())
+            if metrics is not None:
+                metrics.task_done(timer, succeeded=False)
+        finally:
+            profiler.stop()
 
     cur.close()
     db.close()
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Run the BatNET inference queue')
+    parser.add_argument('--metrics-port', type=int, metavar='PORT', help='Serve Prometheus metrics on PORT')
+    parser.add_argument('--profile-every', type=int, metavar='N', help='Profile every Nth task (cProfile), see profile_report.py')
+    parser.add_argument('--profile-dir', metavar='PATH', default='profiles', help='Write the task profiles to PATH (profiles)')
+    args = parser.parse_args()
+    main(args.metrics_port, args.profile_every, args.profile_dir)
@@ -0,0 +1,65 @@
+'''
+# Startup time of the pipeline management commands
+
+Runs the management path of the pipelines (`--help`: argument parsing, after
+all module level imports) with `python -X importtime`, reports the wall time
+and the slowest imports, and fails if a command exceeds the budget or imports
+the model stack (tensorflow, torch, librosa, ...).
+'''
+
+import os
+import re
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+COMMANDS = [
+    ['birdnet_pipeline.py', '--help'],
+    ['batnet_pipeline.py', '--help'],
+]
+
+# not to be imported for managing the queue
+HEAVY_MODULES = ('tensorflow', 'tflite_runtime', 'torch', 'torchaudio', 'librosa', 'soundfile', 'batdetect2', 'model')
+
+IMPORT_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+def run(command, cwd):
+    '''Run `command` once, return the wall time and the imports (module, cumulative s, nesting level)'''
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime', *command], cwd=cwd, capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    imports = []
+    for line in process.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            imports.append((match[4], int(match[2]) / 1e6, len(match[3]) // 2))
+    if process.returncode != 0:
+        print(process.stderr.splitlines()[-1] if process.stderr else f'exit code {process.returncode}')
+    return seconds, imports, process.returncode
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Measure the startup time of the pipeline management commands')
+    parser.add_argument('--repeat', type=int, default=5, metavar='N', help='Runs per command, the median is reported (5)')
+    parser.add_argument('--budget', type=float, default=1.0, metavar='SECONDS', help='Maximum startup time per command (1.0)')
+    parser.add_argument('--top', type=int, default=10, metavar='N', help='Number of slowest top-level imports to list (10)')
+    args = parser.parse_args()
+
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    failed = False
+    for command in COMMANDS:
+        runs = [run(command, cwd) for _ in range(args.repeat)]
+        median = statistics.median(seconds for seconds, _, _ in runs)
+        _, imports, returncode = runs[-1]
+        heavy = sorted({module for module, _, _ in imports if module.split('.')[0] in HEAVY_MODULES})
+        ok = returncode == 0 and median <= args.budget and not heavy
+        failed |= not ok
+        print(f"{' '.join(command)}: {median:.2f} s (median of {args.repeat}){'' if ok else ' FAILED'}")
+        if heavy:
+            print(f"  imports model stack: {', '.join(heavy)}")
+        for module, seconds, _ in sorted((i for i in imports if i[2] == 0), key=lambda i: -i[1])[:args.top]:
+            print(f'  {seconds:6.3f} s  {module}')
+
+    sys.exit(1 if failed else 0)
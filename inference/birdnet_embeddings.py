@@ -0,0 +1,31 @@
+import argparse
+
+from birdnet_pipeline.embedding_store import EmbeddingStore
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Search the BirdNET embedding store for similar windows')
+    parser.add_argument('store', metavar='PATH', help='Embedding store (--embeddings of birdnet_pipeline.py)')
+    parser.add_argument('--search', type=int, nargs=2, metavar=('FILE_ID', 'WINDOW'), help='Find the windows most similar to window WINDOW of file FILE_ID')
+    parser.add_argument('-k', type=int, default=10, help='Number of windows to return (10)')
+    parser.add_argument('--nprobe', type=int, metavar='N', help='Search the N closest lists of the index instead of all windows')
+    parser.add_argument('--build-index', type=int, metavar='NLIST', help='Build an inverted file index with NLIST lists (~sqrt of the number of windows)')
+    args = parser.parse_args()
+
+    store = EmbeddingStore(args.store)
+    print(f'{len(store)} windows of dimension {store.dim}')
+
+    if args.build_index is not None:
+        store.build_ivf(args.build_index)
+        print(f'built index with {args.build_index} lists')
+
+    if args.search is not None:
+        file_id, window = args.search
+        row = store.lookup(file_id, window)
+        if row is None:
+            parser.error(f'window {window} of file {file_id} is not in the store')
+        rows, similarity = store.search(store.vectors()[row], args.k, args.nprobe)
+        keys = store.keys()
+        print('similarity', 'file_id', 'window', 'time_start', 'time_end', sep='\t')
+        for r, s in zip(rows, similarity):
+            print(f'{s:.4f}', keys[r]['file_id'], keys[r]['window'], f"{keys[r]['time_start']:.1f}", f"{keys[r]['time_end']:.1f}", sep='\t')
@@ -6,14 +6,17 @@ import psycopg2 as pg
 from psycopg2 import errors
 import multiprocessing as mp
 from queue import Empty as QueueEmpty
-import time
 import os
 
 sys.path.append('../')
 sys.path.append('birdnet_pipeline/birdnet/')
 
+# only the db layer is imported for managing the queue, the model stack
+# (tensorflow, librosa, soundfile) is imported by the workers (see worker, rescore)
 from birdnet_pipeline.birdnet_batches import batches
-from birdnet_pipeline.birdnet_worker import BirdnetWorker
+import task_dispatch
+import pipeline_metrics
+from task_profiler import TaskProfiler
 
 import credentials as crd
 
@@ -36,8 +39,10 @@ class BirdnetConfig(object):
         }
         # self.result_type = 'audacity'
         self.model_version = 'BirdNET_GLOBAL_2K_V2.1_Model_FP32'
-        # MIN_CONFIDENCE threshold is read from birdnet config.py (0.1)
-        # SIGMOID_SENSITIVITY is read from birdnet config.py (1.0)
+        # MIN_CONFIDENCE threshold is read from birdnet config.py (0.1),
+        # override with self.min_confidence
+        # SIGMOID_SENSITIVITY is read from birdnet config.py (1.0),
+        # override with self.sigmoid_sensitivity
 
 
 
@@ -80,6 +85,15 @@ class Runner(object):
             print('Error storing configuration to db.')
             raise
 
+    def add_config(self, path: str) -> int:
+        '''Store a config read from a JSON file, settings missing in the file are taken from the default config'''
+        config = BirdnetConfig()
+        with open(path, 'r') as f:
+            config.__dict__.update(json.load(f))
+        config_id = self.store_config(config, f'from {os.path.basename(path)}')
+        print(f'configuration ID {config_id}')
+        return config_id
+
     def get_config(self, config_id: int) -> dict:
         '''Read config from DB'''
         query = 'select config from {}.birdnet_configs where config_id = %s'.format(crd.db.schema)
@@ -105,6 +119,7 @@ class Runner(object):
     def get_tasks(self):
         # run on dedicated connection
         connection = pg.connect(host=crd.db.host, port=crd.db.port, database=crd.db.database, user=crd.db.user, password=crd.db.password)
+        task_dispatch.listen(connection, 'birdnet_tasks')
         while True:
             try:
                 # https://www.postgresql.org/docs/current/explicit-locking.html
@@ -116,7 +131,7 @@ class Runner(object):
                 where task_id in (
                     select task_id from {crd.db.schema}.birdnet_tasks
                     where state = 0
-                    -- order by task_id -- this is very expensive
+                    order by task_id -- cheap with the partial index on pending tasks (task_dispatch.sql)
                     for update skip locked
                     limit 1
                 )
@@ -127,12 +142,13 @@ class Runner(object):
                 if task:
                     yield task
                 else:
-                    print('sleeping...', end='\r')
-                    time.sleep(10)
+                    print('waiting for tasks...', end='\r')
+                    task_dispatch.wait(connection, 10)
             except (errors.OperationalError, errors.InterfaceError) as e:
                 print(f'queuing task failed ({str(e)}), retrying.', flush=True)
                 # reopen connection, recreate cursor
                 connection = pg.connect(host=crd.db.host, port=crd.db.port, database=crd.db.database, user=crd.db.user, password=crd.db.password)
+                task_dispatch.listen(connection, 'birdnet_tasks')
             except KeyboardInterrupt:
                 break
             except GeneratorExit:
@@ -144,17 +160,93 @@ class Runner(object):
         connection.close()
 
 
-    def queue_batch(self, config_id, batch_id = 0):
-        '''Select a batch of files and insert them as tasks into queue'''
+    def queue_batch(self, config_id, batch_id = 0, dedup = None):
+        '''
+        Select a batch of files and insert them as tasks into queue
+
+        With `dedup`, files with the same content (sha256) as a file that
+        already has a task with this config, or as another file of the batch,
+        are not queued. With dedup = 'clone', the results of completed tasks
+        are copied to tasks of their duplicates instead.
+        '''
         state = 0
-        query = '''
-        insert into {}.birdnet_tasks(file_id, config_id, state, scheduled_on, batch_id)
-        select file_id, %s, %s, NOW(), %s from ({}) as batch
+        if dedup is None:
+            query = '''
+            insert into {}.birdnet_tasks(file_id, config_id, state, scheduled_on, batch_id)
+            select file_id, %s, %s, NOW(), %s from ({}) as batch
+            on conflict do nothing -- skip duplicate tasks
+            '''.format(crd.db.schema, batches[batch_id]['query'])
+            self.cursor.execute(query, (config_id, state, batch_id))
+            queued = self.cursor.rowcount
+            task_dispatch.notify(self.cursor, 'birdnet_tasks')
+            self.connection.commit()
+            print(f'added {queued} tasks for batch "{batches[batch_id]["comment"]}" to queue')
+            return
+
+        # files of the batch, and a task of another file with the same content for each duplicate
+        self.cursor.execute('''
+        create temporary table dedup_batch on commit drop as
+        select b.file_id, f.sha256, f.duration,
+            b.file_id <> min(b.file_id) over (partition by f.sha256) as batch_duplicate
+        from ({batch}) as b
+        join {schema}.files_audio f on f.file_id = b.file_id;
+
+        create temporary table dedup_source on commit drop as
+        select distinct on (d.file_id) d.file_id, d.duration, t.task_id as source_task_id, t.state as source_state
+        from dedup_batch d
+        join {schema}.files_audio f on f.sha256 = d.sha256 and f.file_id <> d.file_id
+        join {schema}.birdnet_tasks t on t.file_id = f.file_id and t.config_id = %s and t.state <> 3
+        order by d.file_id, t.state = 2 desc, t.task_id;
+        '''.format(schema=crd.db.schema, batch=batches[batch_id]['query']), (config_id,))
+
+        self.cursor.execute('''
+        insert into {schema}.birdnet_tasks(file_id, config_id, state, scheduled_on, batch_id)
+        select d.file_id, %s, %s, NOW(), %s from dedup_batch d
+        where d.sha256 is null or (
+            not d.batch_duplicate and
+            not exists (select 1 from dedup_source s where s.file_id = d.file_id))
         on conflict do nothing -- skip duplicate tasks
-        '''.format(crd.db.schema, batches[batch_id]['query'])
-        self.cursor.execute(query, (config_id, state, batch_id))
+        '''.format(schema=crd.db.schema), (config_id, state, batch_id))
+        queued = self.cursor.rowcount
+
+        cloned_tasks, cloned_results, cloned_duration = 0, 0, 0
+        if dedup == 'clone':
+            self.cursor.execute('''
+            with cloned as (
+                insert into {schema}.birdnet_tasks(file_id, config_id, state, scheduled_on, pickup_on, end_on, batch_id)
+                select s.file_id, %s, 2, NOW(), NOW(), NOW(), %s from dedup_source s
+                where s.source_state = 2
+                on conflict do nothing
+                returning task_id, file_id
+            ), copied as (
+                insert into {schema}.birdnet_results(task_id, file_id, time_start, time_end, confidence, species)
+                select c.task_id, c.file_id, r.time_start, r.time_end, r.confidence, r.species
+                from cloned c
+                join dedup_source s on s.file_id = c.file_id
+                join {schema}.birdnet_results r on r.task_id = s.source_task_id
+                returning 1
+            )
+            select (select count(*) from cloned), (select count(*) from copied),
+                (select coalesce(sum(s.duration), 0) from cloned c join dedup_source s on s.file_id = c.file_id)
+            '''.format(schema=crd.db.schema), (config_id, batch_id))
+            cloned_tasks, cloned_results, cloned_duration = self.cursor.fetchone()
+
+        # duplicates without a task of their own: skipped, or cloned
+        self.cursor.execute('''
+        select count(*), coalesce(sum(d.duration), 0)
+        from dedup_batch d
+        where d.sha256 is not null
+        and (d.batch_duplicate or exists (select 1 from dedup_source s where s.file_id = d.file_id))
+        and not exists (select 1 from {schema}.birdnet_tasks t where t.file_id = d.file_id and t.config_id = %s)
+        '''.format(schema=crd.db.schema), (config_id,))
+        skipped, skipped_duration = self.cursor.fetchone()
+        task_dispatch.notify(self.cursor, 'birdnet_tasks')
         self.connection.commit()
-        print(f'added {self.cursor.rowcount} tasks for batch "{batches[batch_id]["comment"]}" to queue')
+
+        print(f'added {queued} tasks for batch "{batches[batch_id]["comment"]}" to queue')
+        print(f'skipped {skipped} duplicate files ({float(skipped_duration) / 3600:.1f} h of audio)')
+        if dedup == 'clone':
+            print(f'cloned {cloned_tasks} tasks with {cloned_results} results ({float(cloned_duration) / 3600:.1f} h of audio)')
 
     def reset_queue(self):
         '''
@@ -164,28 +256,34 @@ class Runner(object):
         '''
         self.cursor.execute(f'''
         delete from {crd.db.schema}.birdnet_results
-            where task_id in (select task_id from {crd.db.schema}.birdnet_tasks where state = 3);
+            where task_id in (select task_id from {crd.db.schema}.birdnet_tasks where state not in (1, 2));
+        delete from {crd.db.schema}.birdnet_prefilter
+            where task_id in (select task_id from {crd.db.schema}.birdnet_tasks where state not in (1, 2));
         delete from {crd.db.schema}.birdnet_tasks where state not in (1, 2);
         ''')
         self.connection.commit()
 
     def reset_failed(self):
         '''
-        Set failed tasks back to pending, deleting associated result
+        Set failed tasks back to pending, keeping the results up to their checkpoint:
+        the tasks resume after the last committed block
         '''
         self.cursor.execute(f'''
-        delete from {crd.db.schema}.birdnet_results
-            where task_id in (select task_id from {crd.db.schema}.birdnet_tasks where state = 3);
         update {crd.db.schema}.birdnet_tasks set state = 0 where state = 3;
         ''')
         print(f'reset to pending on {self.cursor.rowcount} tasks')
+        task_dispatch.notify(self.cursor, 'birdnet_tasks')
         self.connection.commit()
 
 def worker(queue, localcfg):
     '''Read tasks from queue and process them using BirdnetWorker'''
 
+    from birdnet_pipeline.birdnet_worker import BirdnetWorker
+
     connection = pg.connect(host=crd.db.host, port=crd.db.port, database=crd.db.database, user=crd.db.user, password=crd.db.password)
     birdnet = BirdnetWorker(connection)
+    metrics = pipeline_metrics.attach('birdnet') if localcfg.get('metrics_port') else None
+    profiler = TaskProfiler(localcfg.get('profile_dir'), localcfg.get('profile_every'), 'birdnet')
 
     start_query = f'''
     update {crd.db.schema}.birdnet_tasks
@@ -210,16 +308,17 @@ def worker(queue, localcfg):
         if task == None:
             break
 
+        succeeded = False
         try:
             connection.cursor().execute(start_query, (task[0],))
             connection.commit()
-            birdnet.configure(task[0], localcfg)
-            birdnet.load_species_list()
-            birdnet.analyse()
+            with profiler.profile(task[0], task[2]):
+                birdnet.configure(task[0], localcfg)
+                birdnet.load_species_list()
+                birdnet.analyse()
         except KeyboardInterrupt:
             # let the task fail.
-            # at this point some results may have been written to db,
-            # those also may have already been deleted
+            # results up to the checkpoint are kept, the task resumes from there when reset
             connection.cursor().execute(finish_query, (3, task[0],))
             break
         except (errors.OperationalError, errors.InterfaceError) as e:
@@ -234,8 +333,108 @@ def worker(queue, localcfg):
         else:
             print(f'task {task[0]} succeeded')
             connection.cursor().execute(finish_query, (2, task[0],))
+            succeeded = True
         finally:
             connection.commit()
+        if birdnet.timer.audio_seconds > 0:
+            birdnet.timer.save(connection, crd.db.schema, 'birdnet', task[0], task[2])
+        if metrics is not None:
+            metrics.task_done(birdnet.timer, succeeded)
+
+    if metrics is not None:
+        metrics.process_exit()
+
+def rescore(config_id, localcfg):
+    '''
+    Complete the pending tasks of config `config_id` from cached logits.
+
+    Tasks of files without cached logits (for the model version and overlap of
+    the config) stay pending, to be completed with `--run`.
+    '''
+    from birdnet_pipeline.birdnet_worker import BirdnetWorker, signal_overlap
+    from birdnet_pipeline.logit_cache import LogitCache
+
+    connection = pg.connect(host=crd.db.host, port=crd.db.port, database=crd.db.database, user=crd.db.user, password=crd.db.password)
+    birdnet = BirdnetWorker(connection)
+    birdnet.logit_cache = LogitCache(localcfg['logit_cache'])
+    cursor = connection.cursor()
+
+    cursor.execute(f'select config from {crd.db.schema}.birdnet_configs where config_id = %s', (config_id,))
+    config = cursor.fetchone()
+    if config is None:
+        print(f'config {config_id} not found')
+        connection.close()
+        return
+    config = config[0]
+
+    # pending tasks with cached logits, the others are not touched
+    cursor.execute(f'''
+    select t.task_id, f.sha256
+    from {crd.db.schema}.birdnet_tasks t
+    left join {crd.db.schema}.files_audio f on f.file_id = t.file_id
+    where t.state = 0 and t.config_id = %s
+    order by t.task_id
+    ''', (config_id,))
+    pending = cursor.fetchall()
+    connection.commit()
+    worklist = [task_id for task_id, sha256 in pending
+        if birdnet.logit_cache.contains(sha256, config['model_version'], signal_overlap(config), config.get('prefilter'))]
+    not_cached = len(pending) - len(worklist)
+    print(f'{len(worklist)} of {len(pending)} pending tasks with cached logits')
+
+    claim_query = f'''
+    update {crd.db.schema}.birdnet_tasks
+    set state = 1, pickup_on = now()
+    where task_id = %s and state = 0
+    returning task_id
+    '''
+
+    finish_query = f'''
+    update {crd.db.schema}.birdnet_tasks
+    set state = %s, end_on = now()
+    where task_id = %s
+    '''
+
+    reset_query = f'''
+    update {crd.db.schema}.birdnet_tasks
+    set state = 0, pickup_on = null
+    where task_id = %s
+    '''
+
+    scored = 0
+    for task_id in worklist:
+        # skip tasks picked up by a runner in the meantime
+        cursor.execute(claim_query, (task_id,))
+        connection.commit()
+        if cursor.fetchone() is None:
+            continue
+        try:
+            birdnet.configure(task_id, localcfg)
+            birdnet.load_species_list()
+            cached = birdnet.rescore()
+        except KeyboardInterrupt:
+            cursor.execute(reset_query, (task_id,))
+            connection.commit()
+            break
+        except:
+            print(f'task {task_id} failed')
+            print(traceback.format_exc(), flush=True)
+            connection.rollback()
+            cursor.execute(finish_query, (3, task_id,))
+        else:
+            if cached:
+                scored += 1
+                cursor.execute(finish_query, (2, task_id,))
+            else:
+                # cache entry removed since building the worklist
+                not_cached += 1
+                cursor.execute(reset_query, (task_id,))
+        finally:
+            connection.commit()
+        print(f'rescored {scored} tasks', end='\r', flush=True)
+
+    print(f'rescored {scored} tasks, {not_cached} without cached logits (left pending)')
+    connection.close()
 
 def is_readable_dir(arg):
     try:
@@ -254,13 +453,22 @@ if __name__ == '__main__':
 
     p_manage = parser.add_argument_group('Manage Task Queue')
     p_manage.add_argument('--reset-queue', action='store_true', default=False, help='Clear pending and failed tasks')
-    p_manage.add_argument('--reset-failed', action='store_true', default=False, help='Reset failed tasks to pending, clearing results')
+    p_manage.add_argument('--reset-failed', action='store_true', default=False, help='Reset failed tasks to pending, they resume after their checkpoint (results up to it are kept)')
     p_manage.add_argument('--add-batch', type=int, metavar='ID', help='Queue files defined by batch of ID')
+    p_manage.add_argument('--add-config', metavar='FILE', help='Store the configuration in JSON file FILE')
+    p_manage.add_argument('--dedup', choices=['skip', 'clone'], help='Don\'t queue files with the same content as files with a task (skip), or copy their results (clone)')
+    p_manage.add_argument('--config', type=int, metavar='ID', help='Queue batch with configuration of ID instead of the default configuration')
 
     p_run = parser.add_argument_group('Run Pipeline')
     p_run.add_argument('--run', action='store_true', default=False, help='Work on tasks in queue')
     p_run.add_argument('--tf-gpu', action='store_true', default=False, help='Run on GPU, using protobuf model')
     p_run.add_argument('--source', metavar='PATH', type=lambda x: is_readable_dir(x), help='Read input from disk at PATH instead of S3')
+    p_run.add_argument('--logit-cache', metavar='LOCATION', help='Store raw logits in directory or S3 location (s3://bucket/prefix) LOCATION')
+    p_run.add_argument('--embeddings', metavar='PATH', help='Store the embeddings of all windows in the embedding store at PATH')
+    p_run.add_argument('--metrics-port', type=int, metavar='PORT', help='Serve Prometheus metrics of the runner and its workers on PORT')
+    p_run.add_argument('--profile-every', type=int, metavar='N', help='Profile every Nth task of each worker (cProfile), see profile_report.py')
+    p_run.add_argument('--profile-dir', metavar='PATH', default='profiles', help='Write the task profiles to PATH (profiles)')
+    p_run.add_argument('--rescore', type=int, metavar='ID', help='Complete pending tasks of configuration ID from the logit cache')
 
     args = parser.parse_args()
 
@@ -272,15 +480,32 @@ if __name__ == '__main__':
     if args.reset_failed:
         runner.reset_failed()
 
+    if args.add_config is not None:
+        runner.add_config(args.add_config)
+
     if args.add_batch is not None:
-        config_id = runner.set_default_config()
-        runner.queue_batch(config_id, args.add_batch)
+        config_id = runner.set_default_config() if args.config is None else args.config
+        runner.queue_batch(config_id, args.add_batch, args.dedup)
+
+    if args.rescore is not None:
+        if args.logit_cache is None:
+            parser.error('--rescore requires --logit-cache')
+        rescore(args.rescore, { 'TF_GPU': args.tf_gpu, 'source_path': args.source, 'logit_cache': args.logit_cache })
 
     if args.run:
+        if args.embeddings is not None and args.tf_gpu:
+            parser.error('--embeddings requires the tflite model (without --tf-gpu)')
         connection = pg.connect(host=crd.db.host, port=crd.db.port, database=crd.db.database, user=crd.db.user, password=crd.db.password)
         ncpus = 1 if args.tf_gpu else os.cpu_count()
         queue = mp.Queue(maxsize=ncpus)
-        localcfg = { 'TF_GPU': args.tf_gpu, 'source_path': args.source }
+        localcfg = { 'TF_GPU': args.tf_gpu, 'source_path': args.source, 'logit_cache': args.logit_cache, 'embeddings': args.embeddings,
+            'metrics_port': args.metrics_port, 'profile_every': args.profile_every, 'profile_dir': args.profile_dir }
+
+        if args.metrics_port is not None:
+            # before starting the pool, the workers report to the runner
+            pipeline_metrics.start(args.metrics_port, 'birdnet',
+                lambda: pg.connect(host=crd.db.host, port=crd.db.port, database=crd.db.database, user=crd.db.user, password=crd.db.password),
+                f'{crd.db.schema}.birdnet_tasks')
 
         try:
             pool = mp.Pool(ncpus, initializer=worker, initargs=(queue, localcfg))
@@ -2,6 +2,11 @@
 # - configure environment with options from BirdnetConfig
 # - birdnet loading sequence
 # - analyze file
+# - or score the file from cached logits (see logit_cache.py)
+# - optionally extract embeddings (see embedding_store.py)
+# - optionally skip quiet windows (see prefilter.py)
+# - resume interrupted tasks from the last committed block (checkpoint)
+# - measure the time spent per stage (see task_telemetry.py)
 
 import sys
 import os
@@ -17,13 +22,44 @@ import config as cfg
 import model
 
 import credentials as crd
+from task_telemetry import TaskTimer
+import pipeline_metrics
 
 from .lib import audio
+from .logit_cache import LogitCache
+from .embedding_store import EmbeddingStore
+from .prefilter import active_windows
 from .birdnet.analyze import loadCodes, loadLabels, predictSpeciesList, loadSpeciesList
 
 SCHEMA = crd.db.schema
 PDEBUG = False
 
+def predict_with_embeddings(data):
+    '''
+    Logits and embeddings of a batch in one invocation of the tflite model.
+    The embeddings are the output of the layer before the class layer
+    (output tensor index - 1, as in model.embeddings).
+    '''
+    if not cfg.MODEL_PATH.endswith('.tflite'):
+        raise ValueError('embeddings are only extracted with the tflite model')
+    if model.INTERPRETER is None:
+        model.loadModel()
+    interpreter = model.INTERPRETER
+    interpreter.resize_tensor_input(model.INPUT_LAYER_INDEX, [len(data), *data[0].shape])
+    interpreter.allocate_tensors()
+    interpreter.set_tensor(model.INPUT_LAYER_INDEX, data)
+    interpreter.invoke()
+    prediction = interpreter.get_tensor(model.OUTPUT_LAYER_INDEX)
+    embeddings = interpreter.get_tensor(model.OUTPUT_LAYER_INDEX - 1)
+    if embeddings.shape[-1] == len(cfg.LABELS):
+        # OUTPUT_LAYER_INDEX already pointed to the embeddings (loadModel(False))
+        raise ValueError(f'embeddings of dimension {embeddings.shape[-1]}, the number of labels')
+    return prediction, embeddings
+
+def signal_overlap(config):
+    '''Overlap of the windows of a config, as used by the model and in the logit cache key'''
+    return max(0.0, min(2.9, float(config['overlap'])))
+
 class BirdnetWorker(object):
 
     def __init__(self, connection):
@@ -36,22 +72,37 @@ class BirdnetWorker(object):
         self.timestamp = None
         self.config = None
         self.source_path = None
+        self.sha256 = None
+        self.checkpoint = None
+        self.logit_cache = None
+        self.embedding_store = None
+        self.timer = TaskTimer()
+
+        # defaults of the settings that can be overridden per config
+        self.defaults = { 'min_confidence': cfg.MIN_CONFIDENCE, 'sigmoid_sensitivity': cfg.SIGMOID_SENSITIVITY }
 
         cfg.CODES_FILE = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), 'birdnet', cfg.CODES_FILE)
 
     def configure(self, task_id, localcfg):
         self.task_id = task_id
+        self.timer.reset()
         self.source_path = localcfg['source_path']
+        if localcfg.get('logit_cache') and (self.logit_cache is None or self.logit_cache.location != localcfg['logit_cache']):
+            self.logit_cache = LogitCache(localcfg['logit_cache'])
+        if localcfg.get('embeddings') and (self.embedding_store is None or self.embedding_store.path != localcfg['embeddings']):
+            self.embedding_store = EmbeddingStore(localcfg['embeddings'])
         cursor = self.connection.cursor()
         cursor.execute(f'''
         select t.file_id, i.object_name, i.time, c.config,
-        floor((extract(doy from time) - 1)/(365/48.))::integer + 1 as week
+        floor((extract(doy from i.time) - 1)/(365/48.))::integer + 1 as week,
+        f.sha256, t.checkpoint
         from {SCHEMA}.birdnet_tasks t
         left join {SCHEMA}.birdnet_configs c on c.config_id = t.config_id
         left join {SCHEMA}.birdnet_input i on i.file_id = t.file_id
+        left join {SCHEMA}.files_audio f on f.file_id = t.file_id
         where t.task_id = %s
         ''', (self.task_id,))
-        self.file_id, self.object_name, self.timestamp, self.config, self.week = cursor.fetchone()
+        self.file_id, self.object_name, self.timestamp, self.config, self.week, self.sha256, self.checkpoint = cursor.fetchone()
 
         # db config format:     BirdNET_GLOBAL_2K_V2.1_Model_FP32
         # protobuf (tf gpu):    checkpoints/V2.1/BirdNET_GLOBAL_2K_V2.1_Model
@@ -98,7 +149,11 @@ class BirdnetWorker(object):
         cfg.TRANSLATED_LABELS = cfg.LABELS
 
         # Set overlap
-        cfg.SIG_OVERLAP = max(0.0, min(2.9, float(self.config['overlap'])))
+        cfg.SIG_OVERLAP = signal_overlap(self.config)
+
+        # Set scoring, optional in config
+        cfg.MIN_CONFIDENCE = float(self.config.get('min_confidence', self.defaults['min_confidence']))
+        cfg.SIGMOID_SENSITIVITY = float(self.config.get('sigmoid_sensitivity', self.defaults['sigmoid_sensitivity']))
 
     def load_species_list(self):
         if 'auto' in self.config['species_list']:
@@ -124,12 +179,21 @@ class BirdnetWorker(object):
         # (with 3 tasks it's already confirmed to be isolated)
         temp_dir = tempfile.TemporaryDirectory()
         file = None
+        committed = self.checkpoint or 0 # blocks with committed results
 
         try:
             start, end = 0, cfg.SIG_LENGTH
             results = {}
             samples = []
             timestamps = []
+            windows = [] # block numbers of the windows in the batch
+            cached_logits = []
+            cached_timestamps = []
+            embeddings = []
+            embedding_windows = []
+            embedding_timestamps = []
+            skipped = [] # (start, level) of windows skipped by the prefilter
+            prefilter = self.config.get('prefilter')
 
             file = None
             if self.source_path == None:
@@ -140,94 +204,163 @@ class BirdnetWorker(object):
                 )
                 # TODO: load directly to numpy array
                 tmppath = os.path.join(temp_dir.name, os.path.basename(self.object_name))
-                client.fget_object(crd.minio.bucket, self.object_name, tmppath)
-                file = sf.SoundFile(tmppath)
+                with self.timer.stage('download'):
+                    client.fget_object(crd.minio.bucket, self.object_name, tmppath)
             else:
-                file = sf.SoundFile(os.path.join(self.source_path, self.object_name))
+                tmppath = os.path.join(self.source_path, self.object_name)
+            with self.timer.stage('decode'):
+                file = sf.SoundFile(tmppath)
+            self.timer.bytes_read = os.path.getsize(tmppath)
 
 
             block_size = int(cfg.SIG_LENGTH * cfg.SAMPLE_RATE)
             overlap_seek = int(-cfg.SIG_OVERLAP * cfg.SAMPLE_RATE)
             last_block = False
             block_count = 0
+            start_frame = 0
+
+            # resume after the last block with committed results
+            if self.checkpoint:
+                print(f'task {self.task_id}: resuming at block {self.checkpoint}')
+                start_frame = min(self.checkpoint * block_size, file.frames)
+                file.seek(start_frame)
+                block_count = self.checkpoint
+                start = self.checkpoint * (cfg.SIG_LENGTH - cfg.SIG_OVERLAP)
+                end = start + cfg.SIG_LENGTH
+                if prefilter is not None:
+                    skipped = self.loadPrefilterFromDb()
 
             while file.tell() < file.frames:
                 block_count += 1
                 if PDEBUG: print('--begin analysis loop. currently at {:.2f}% ({}s, block {})'.format(file.tell() / file.frames * 100., start, block_count), end='\n')
 
-                if (file.tell() + block_size) > file.frames:
-                    # remaining samples < block size, pad with noise
-                    l = file.frames - file.tell()
-                    split = file.read(l)
-                    sig = np.hstack((split, audio.noise(split, (block_size - len(split)), 0.23)))
-                    last_block = True
-                else:
-                    # read samples from file
-                    sig = file.read(block_size)
-                    if file.tell() == file.frames:
+                # read and prepare the window (decode)
+                with self.timer.stage('decode'):
+                    if (file.tell() + block_size) > file.frames:
+                        # remaining samples < block size, pad with noise
+                        l = file.frames - file.tell()
+                        split = file.read(l)
+                        sig = np.hstack((split, audio.noise(split, (block_size - len(split)), 0.23)))
                         last_block = True
-
-                # Add to batch
-                samples.append(sig)
-                timestamps.append([start, end])
+                    else:
+                        # read samples from file
+                        sig = file.read(block_size)
+                        if file.tell() == file.frames:
+                            last_block = True
+
+                    # Skip quiet windows, or add to batch
+                    active = True
+                    if prefilter is not None:
+                        active, level = active_windows(sig[np.newaxis, :], cfg.SAMPLE_RATE, **prefilter)
+                        active = bool(active[0])
+                        if not active:
+                            skipped.append((start, float(level[0])))
+                    if active:
+                        samples.append(sig)
+                        timestamps.append([start, end])
+                        windows.append(block_count - 1)
 
                 # Advance start and end
                 start += cfg.SIG_LENGTH - cfg.SIG_OVERLAP
                 end = start + cfg.SIG_LENGTH
 
-                # Check if batch is full or last block
-                if len(samples) < cfg.BATCH_SIZE and not last_block:
+                # Check if batch is full, results are due or last block
+                if len(samples) < cfg.BATCH_SIZE and block_count % 1200 != 0 and not last_block:
                     continue
 
-                # Predict
-                data = np.array(samples, dtype='float32')
-                prediction = model.predict(data)
-
-                # Logits or sigmoid activations?
-                if cfg.APPLY_SIGMOID:
-                    prediction = model.flat_sigmoid(np.array(prediction), sensitivity=-cfg.SIGMOID_SENSITIVITY)
-
-                # Add to results
-                for i in range(len(samples)):
-
-                    # Get timestamp
-                    s_start, s_end = timestamps[i]
-
-                    # Get prediction
-                    pred = prediction[i]
-
-                    # Assign scores to labels
-                    p_labels = dict(zip(cfg.LABELS, pred))
-
-                    # Store results
-                    results[str(s_start) + '-' + str(s_end)] = p_labels.items()
+                if len(samples) > 0:
+                    # Predict
+                    data = np.array(samples, dtype='float32')
+                    with self.timer.stage('inference'):
+                        if self.embedding_store is not None:
+                            # one pass of the model for the logits and the embeddings
+                            prediction, batch_embeddings = predict_with_embeddings(data)
+                        else:
+                            prediction = model.predict(data)
+                    if pipeline_metrics.metrics is not None:
+                        pipeline_metrics.metrics.batch(len(samples), cfg.BATCH_SIZE)
+
+                    # Keep the raw logits for re-scoring
+                    if self.logit_cache is not None:
+                        cached_logits.append(np.array(prediction, dtype='float16'))
+                        cached_timestamps.extend(timestamps)
+
+                    # Keep the embeddings (penultimate layer)
+                    if self.embedding_store is not None:
+                        embeddings.append(np.array(batch_embeddings, dtype='float16'))
+                        embedding_windows.extend(windows)
+                        embedding_timestamps.extend(timestamps)
+
+                    with self.timer.stage('postprocess'):
+                        # Logits or sigmoid activations?
+                        if cfg.APPLY_SIGMOID:
+                            prediction = model.flat_sigmoid(np.array(prediction), sensitivity=-cfg.SIGMOID_SENSITIVITY)
+
+                        # Add to results
+                        for i in range(len(samples)):
+
+                            # Get timestamp
+                            s_start, s_end = timestamps[i]
+
+                            # Get prediction
+                            pred = prediction[i]
+
+                            # Assign scores to labels
+                            p_labels = dict(zip(cfg.LABELS, pred))
+
+                            # Store results
+                            results[str(s_start) + '-' + str(s_end)] = p_labels.items()
 
                 # store and clear results after a fixed number of blocks or last block
                 # 1200: fits 60min of (non-overlapping) blocks in one go
                 if block_count % 1200 == 0 or last_block:
                     if PDEBUG: print(f'storing results at block {block_count}')
                     if PDEBUG: print('storing results for', self.object_name)
-                    self.saveResultsToDb(results)
+                    with self.timer.stage('postprocess'):
+                        if self.embedding_store is not None and len(embeddings) > 0:
+                            # appended before the checkpoint: windows of an attempt interrupted before
+                            # its commit are appended again by the retry, the last row of a window counts
+                            self.embedding_store.append(self.file_id, embedding_windows, embedding_timestamps, np.concatenate(embeddings))
+                            embeddings = []
+                            embedding_windows = []
+                            embedding_timestamps = []
+                        if prefilter is not None:
+                            self.savePrefilterToDb(block_count, skipped)
+                        # results, skipped windows and checkpoint are committed together
+                        self.saveResultsToDb(results, block_count)
+                    committed = block_count
                     results = {}
                 # Clear batch
                 samples = []
                 timestamps = []
+                windows = []
+
+            self.timer.audio_seconds = (file.tell() - start_frame) / file.samplerate
+
+            if prefilter is not None:
+                print(f'task {self.task_id}: skipped {len(skipped)} of {block_count} windows ({len(skipped) / max(1, block_count):.1%})')
+
+            if self.logit_cache is not None and self.checkpoint:
+                # the logits of the blocks before the checkpoint are lost
+                print(f'task {self.task_id}: resumed, logits not cached')
+            elif self.logit_cache is not None:
+                try:
+                    with self.timer.stage('postprocess'):
+                        self.logit_cache.put(self.sha256, self.config['model_version'], cfg.SIG_OVERLAP, prefilter,
+                            cached_timestamps, np.concatenate(cached_logits) if len(cached_logits) else np.zeros((0, len(cfg.LABELS))))
+                except Exception as e:
+                    # the results are stored, the task succeeds without cache entry
+                    print(f'caching logits failed for task {self.task_id}: {e}')
         except:
-            # delete results from db
-            print(f'error/interrupt occurred during prediction, deleting results for task {self.task_id}')
-            self.connection.cursor().execute(f'delete from {SCHEMA}.birdnet_results where task_id = %s', (self.task_id,))
-            self.connection.commit()
+            # results up to the checkpoint are kept, a retry resumes from there
+            print(f'error/interrupt occurred during prediction, task {self.task_id} stopped at block {committed}')
+            self.connection.rollback()
             raise
         finally:
             file.close()
             temp_dir.cleanup()
 
-    def saveResultsToDb(self, results):
-        insert_query = f'''
-        insert into {SCHEMA}.birdnet_results
-        (task_id, file_id, time_start, time_end, confidence, species)
-        values %s
-        '''
+    def saveResultsToDb(self, results, checkpoint=None):
         data = []
         if PDEBUG: print('count of results:', len(results))
         for timestamp in sorted(results):
@@ -243,9 +376,77 @@ class BirdnetWorker(object):
                         float(c[1]),
                         label.split('_')[0]))
         if PDEBUG: print('count of results after filtering:', len(data))
-        try:
-            execute_values(self.connection.cursor(), insert_query, data, template=None, page_size=100)
-            self.connection.commit()
-        except:
-            self.connection.rollback()
-            raise
+        self.insertResults(data, checkpoint)
+
+    def rescore(self):
+        '''
+        Derive the results of the task from the cached logits of the file, instead of running the model.
+
+        Returns False if the logits are not cached (for this model version and overlap).
+        '''
+        cached = None
+        if self.logit_cache is not None:
+            cached = self.logit_cache.get(self.sha256, self.config['model_version'], cfg.SIG_OVERLAP, self.config.get('prefilter'))
+        if cached is None:
+            return False
+        timestamps, scores = cached
+
+        # Logits or sigmoid activations?
+        if cfg.APPLY_SIGMOID:
+            scores = model.flat_sigmoid(scores, sensitivity=-cfg.SIGMOID_SENSITIVITY)
+
+        # same filter as in saveResultsToDb, for all windows and labels at once
+        selected = np.array([l in cfg.CODES and (l in cfg.SPECIES_LIST or len(cfg.SPECIES_LIST) == 0) for l in cfg.LABELS], dtype=bool)
+        species = [l.split('_')[0] for l in cfg.TRANSLATED_LABELS]
+        windows, labels = np.nonzero((scores > cfg.MIN_CONFIDENCE) & selected)
+        data = [(self.task_id, self.file_id, float(timestamps[w, 0]), float(timestamps[w, 1]), float(scores[w, l]), species[l])
+            for w, l in zip(windows, labels)]
+        if PDEBUG: print('count of rescored results:', len(data))
+        # replace the results of an interrupted analysis of the task
+        cursor = self.connection.cursor()
+        cursor.execute(f'delete from {SCHEMA}.birdnet_results where task_id = %s', (self.task_id,))
+        cursor.execute(f'update {SCHEMA}.birdnet_tasks set checkpoint = null where task_id = %s', (self.task_id,))
+        self.insertResults(data)
+        return True
+
+    def savePrefilterToDb(self, window_count, skipped):
+        '''
+        Record the windows skipped by the prefilter (start time and level) so far, for auditing.
+        Not committed, the record is committed with the results of the windows (see insertResults).
+        '''
+        with self.timer.stage('db_write'):
+            self.connection.cursor().execute(f'''
+            insert into {SCHEMA}.birdnet_prefilter (task_id, windows, skipped, time_start, level)
+            values (%s, %s, %s, %s, %s)
+            on conflict (task_id) do update set windows = excluded.windows, skipped = excluded.skipped,
+                time_start = excluded.time_start, level = excluded.level
+            ''', (self.task_id, window_count, len(skipped), [s[0] for s in skipped], [s[1] for s in skipped]))
+
+    def loadPrefilterFromDb(self):
+        '''Return the windows skipped by the prefilter up to the checkpoint, as (start, level)'''
+        cursor = self.connection.cursor()
+        cursor.execute(f'select time_start, level from {SCHEMA}.birdnet_prefilter where task_id = %s', (self.task_id,))
+        row = cursor.fetchone()
+        return [] if row is None else list(zip(row[0], row[1]))
+
+    def insertResults(self, data, checkpoint=None):
+        '''
+        Insert and commit the results. With `checkpoint`, the number of blocks
+        analysed is stored with the task in the same transaction: the results
+        of a block are committed exactly once, a retry resumes after them.
+        '''
+        insert_query = f'''
+        insert into {SCHEMA}.birdnet_results
+        (task_id, file_id, time_start, time_end, confidence, species)
+        values %s
+        '''
+        with self.timer.stage('db_write'):
+            try:
+                cursor = self.connection.cursor()
+                execute_values(cursor, insert_query, data, template=None, page_size=100)
+                if checkpoint is not None:
+                    cursor.execute(f'update {SCHEMA}.birdnet_tasks set checkpoint = %s where task_id = %s', (checkpoint, self.task_id))
+                self.connection.commit()
+            except:
+                self.connection.rollback()
+                raise
@@ -0,0 +1,189 @@
+# BirdNET embedding store
+# - embeddings (penultimate layer of the model) per window, appended by the workers
+# - memory-mapped, append-only arrays in a directory:
+#   - keys.bin: (file_id, window, time_start, time_end) per row
+#   - embeddings.bin: float16 vectors of `dim` values per row
+#   - ivf.npz: optional inverted file index (see build_ivf)
+# - nearest neighbour search by cosine similarity, brute force in blocks or with the index
+
+import os
+import json
+import fcntl
+
+import numpy as np
+
+KEY_DTYPE = np.dtype([('file_id', '<i8'), ('window', '<i4'), ('time_start', '<f4'), ('time_end', '<f4')])
+VECTOR_DTYPE = np.dtype('<f2')
+BLOCK_SIZE = 65536 # rows per block in brute force search
+
+class EmbeddingStore(object):
+
+    def __init__(self, path, dim=None):
+        self.path = path
+        self.keys_file = os.path.join(path, 'keys.bin')
+        self.vectors_file = os.path.join(path, 'embeddings.bin')
+        self.meta_file = os.path.join(path, 'meta.json')
+        self.ivf_file = os.path.join(path, 'ivf.npz')
+        os.makedirs(path, exist_ok=True)
+        self.dim = None
+        self.set_dim(dim)
+
+    def set_dim(self, dim):
+        '''Read the dimension of the embeddings from the store, or set it for a new store'''
+        with self.lock():
+            if os.path.exists(self.meta_file):
+                with open(self.meta_file, 'r') as f:
+                    self.dim = json.load(f)['dim']
+                if dim is not None and dim != self.dim:
+                    raise ValueError(f'store {self.path} holds embeddings of dimension {self.dim}, not {dim}')
+            elif dim is not None:
+                self.dim = dim
+                with open(self.meta_file, 'w') as f:
+                    json.dump({ 'dim': dim, 'dtype': VECTOR_DTYPE.str }, f)
+
+    def lock(self):
+        '''Exclusive lock on the store, appends of several processes are serialized'''
+        return FileLock(os.path.join(self.path, '.lock'))
+
+    def __len__(self):
+        # the keys are written last, they define the number of complete rows
+        if not os.path.exists(self.keys_file):
+            return 0
+        return os.path.getsize(self.keys_file) // KEY_DTYPE.itemsize
+
+    def append(self, file_id, windows, timestamps, embeddings):
+        '''
+        Append the embeddings (windows, dim) of a file, with the numbers of the
+        windows and their timestamps (windows, [start, end]).
+        '''
+        embeddings = np.asarray(embeddings, dtype=VECTOR_DTYPE)
+        if self.dim is None:
+            self.set_dim(embeddings.shape[1])
+        if embeddings.shape[1] != self.dim:
+            raise ValueError(f'embeddings of dimension {embeddings.shape[1]}, store holds {self.dim}')
+        keys = np.zeros(len(embeddings), dtype=KEY_DTYPE)
+        keys['file_id'] = file_id
+        keys['window'] = windows
+        keys['time_start'], keys['time_end'] = np.asarray(timestamps, dtype='float32').reshape(-1, 2).T
+        with self.lock():
+            rows = len(self)
+            with open(self.vectors_file, 'ab') as f:
+                # drop vectors of an append interrupted before its keys were written
+                f.truncate(rows * self.dim * VECTOR_DTYPE.itemsize)
+                f.write(embeddings.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.keys_file, 'ab') as f:
+                f.write(keys.tobytes())
+
+    def keys(self):
+        if len(self) == 0:
+            return np.zeros(0, dtype=KEY_DTYPE)
+        return np.memmap(self.keys_file, dtype=KEY_DTYPE, mode='r', shape=(len(self),))
+
+    def vectors(self):
+        if len(self) == 0:
+            return np.zeros((0, self.dim or 0), dtype=VECTOR_DTYPE)
+        return np.memmap(self.vectors_file, dtype=VECTOR_DTYPE, mode='r', shape=(len(self), self.dim))
+
+    def lookup(self, file_id, window):
+        '''Return the row of window `window` of file `file_id`, None if not stored'''
+        keys = self.keys()
+        rows = np.flatnonzero((keys['file_id'] == file_id) & (keys['window'] == window))
+        return int(rows[-1]) if len(rows) else None
+
+    def current(self):
+        '''
+        Mask of the rows holding the last appended embedding of their window:
+        a retried task or another config appends the windows of a file again.
+        '''
+        keys = self.keys()
+        current = np.zeros(len(keys), dtype=bool)
+        if len(keys) == 0:
+            return current
+        # by file and window, the last row of each first
+        order = np.lexsort((-np.arange(len(keys)), keys['window'], keys['file_id']))
+        file_ids, windows = keys['file_id'][order], keys['window'][order]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = (file_ids[1:] != file_ids[:-1]) | (windows[1:] != windows[:-1])
+        current[order[first]] = True
+        return current
+
+    def search(self, query, k=10, nprobe=None):
+        '''
+        Find the `k` rows most similar (cosine) to the vector `query`.
+
+        Without `nprobe`, all rows are compared (block by block). With
+        `nprobe`, only the rows of the `nprobe` inverted lists closest to the
+        query are compared (requires `build_ivf`), and the rows appended since
+        the index was built. Superseded rows of a window are skipped (see
+        `current`). Returns the rows and their similarity, most similar first.
+        '''
+        query = np.asarray(query, dtype='float32')
+        query = query / max(np.linalg.norm(query), 1e-12)
+        # rows appended by the workers in the meantime are not looked at
+        current = self.current()
+        vectors = self.vectors()
+        if nprobe is None:
+            selected = np.flatnonzero(current)
+        else:
+            with np.load(self.ivf_file) as ivf:
+                centroids, offsets, rows, indexed = ivf['centroids'], ivf['offsets'], ivf['rows'], int(ivf['count'])
+            lists = np.argsort(-(centroids @ query))[:nprobe]
+            selected = np.sort(np.concatenate([rows[offsets[l]:offsets[l + 1]] for l in lists] + [np.arange(indexed, len(current))]))
+            selected = selected[current[selected]]
+        candidates = [selected[start:start + BLOCK_SIZE] for start in range(0, len(selected), BLOCK_SIZE)]
+        best_rows = np.zeros(0, dtype=int)
+        best_scores = np.zeros(0, dtype='float32')
+        for block in candidates:
+            scores = normalize(vectors[block]) @ query
+            best_rows = np.concatenate((best_rows, block))
+            best_scores = np.concatenate((best_scores, scores))
+            if len(best_scores) > k:
+                top = np.argpartition(-best_scores, k)[:k]
+                best_rows, best_scores = best_rows[top], best_scores[top]
+        order = np.argsort(-best_scores)
+        return best_rows[order], best_scores[order]
+
+    def build_ivf(self, nlist, iterations=10, sample_size=100000, seed=42):
+        '''
+        Build an inverted file index: cluster the embeddings into `nlist` lists
+        (k-means on a sample), and assign every current row to the list of its closest centroid.
+        '''
+        current = self.current()
+        vectors = self.vectors()
+        indexed = np.flatnonzero(current)
+        rng = np.random.default_rng(seed)
+        sample = normalize(vectors[np.sort(rng.choice(indexed, min(sample_size, len(indexed)), replace=False))])
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for l in range(nlist):
+                members = sample[assignment == l]
+                if len(members):
+                    centroids[l] = members.mean(axis=0)
+            centroids = normalize(centroids)
+        assignment = np.concatenate([np.argmax(normalize(vectors[indexed[start:start + BLOCK_SIZE]]) @ centroids.T, axis=1)
+            for start in range(0, len(indexed), BLOCK_SIZE)])
+        rows = indexed[np.argsort(assignment, kind='stable')]
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=nlist))))
+        np.savez(self.ivf_file, centroids=centroids, offsets=offsets, rows=rows, count=len(current))
+
+class FileLock(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'w')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype='float32')
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
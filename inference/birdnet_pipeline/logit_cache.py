@@ -0,0 +1,98 @@
+# BirdNET logit cache
+# - raw model output (logits) per window of a file, before sigmoid and filtering
+# - content-addressed by file sha256, model version and overlap (window layout),
+#   and the prefilter settings if windows were skipped (see prefilter.py)
+# - files without sha256 are not cached
+# - stored as compressed float16 arrays, in a local directory or S3 (s3://bucket/prefix)
+
+import os
+import json
+import hashlib
+from io import BytesIO
+
+import numpy as np
+from minio import Minio
+from minio.error import S3Error
+
+import credentials as crd
+
+class LogitCache(object):
+
+    def __init__(self, location):
+        self.location = location
+        self.client = None
+        self.bucket = None
+        self.prefix = location
+        if location.startswith('s3://'):
+            self.bucket, _, self.prefix = location[len('s3://'):].partition('/')
+            self.client = Minio(
+                crd.minio.host,
+                access_key=crd.minio.access_key,
+                secret_key=crd.minio.secret_key,
+            )
+
+    def key(self, sha256, model_version, overlap, prefilter=None):
+        variant = f'overlap-{float(overlap)}'
+        if prefilter is not None:
+            variant += '-prefilter-' + hashlib.sha1(json.dumps(prefilter, sort_keys=True).encode()).hexdigest()[:12]
+        return '/'.join(p for p in (self.prefix.rstrip('/'), model_version, variant, sha256[:2], f'{sha256}.npz') if p)
+
+    def put(self, sha256, model_version, overlap, prefilter, timestamps, logits):
+        '''Store the logits (windows, labels) and timestamps (windows, [start, end]) of a file'''
+        if sha256 is None:
+            # no checksum recorded for the file, nothing to address the entry by
+            return
+        buffer = BytesIO()
+        np.savez_compressed(buffer,
+            timestamps=np.asarray(timestamps, dtype='float64').reshape(-1, 2),
+            logits=np.asarray(logits, dtype='float16'))
+        key = self.key(sha256, model_version, overlap, prefilter)
+        if self.client is None:
+            os.makedirs(os.path.dirname(key), exist_ok=True)
+            # write to a temporary file first, readers only see complete entries
+            with open(key + '.tmp', 'wb') as f:
+                f.write(buffer.getbuffer())
+            os.replace(key + '.tmp', key)
+        else:
+            buffer.seek(0)
+            self.client.put_object(self.bucket, key, buffer, buffer.getbuffer().nbytes,
+                content_type='application/octet-stream')
+
+    def contains(self, sha256, model_version, overlap, prefilter=None):
+        '''Whether the logits of a file are cached, without reading them'''
+        if sha256 is None:
+            return False
+        key = self.key(sha256, model_version, overlap, prefilter)
+        if self.client is None:
+            return os.path.exists(key)
+        try:
+            self.client.stat_object(self.bucket, key)
+        except S3Error as e:
+            if e.code == 'NoSuchKey':
+                return False
+            raise
+        return True
+
+    def get(self, sha256, model_version, overlap, prefilter=None):
+        '''Return the timestamps and logits (float32) of a file, None if they are not cached'''
+        if sha256 is None:
+            return None
+        key = self.key(sha256, model_version, overlap, prefilter)
+        if self.client is None:
+            if not os.path.exists(key):
+                return None
+            source = key
+        else:
+            try:
+                response = self.client.get_object(self.bucket, key)
+            except S3Error as e:
+                if e.code == 'NoSuchKey':
+                    return None
+                raise
+            try:
+                source = BytesIO(response.read())
+            finally:
+                response.close()
+                response.release_conn()
+        with np.load(source) as data:
+            return data['timestamps'], data['logits'].astype('float32')
@@ -0,0 +1,42 @@
+# Energy prefilter
+# - band-limited RMS level (dBFS) and spectral flux of a batch of windows, vectorized
+# - windows below the thresholds are skipped, they are not passed to the model
+
+import numpy as np
+
+FRAME_LENGTH = 1024 # samples per frame for the spectral flux
+
+def window_levels(samples, sample_rate, band):
+    '''Return the RMS level (dBFS) of the windows `samples` (windows, samples) in the frequency `band` (low, high)'''
+    spectrum = np.fft.rfft(samples, axis=1)
+    freqs = np.fft.rfftfreq(samples.shape[1], 1. / sample_rate)
+    in_band = (freqs >= band[0]) & (freqs <= band[1])
+    # mean square of the band-limited signal (Parseval, one-sided spectrum)
+    power = np.sum(np.abs(spectrum[:, in_band]) ** 2, axis=1) * 2 / samples.shape[1] ** 2
+    return 10 * np.log10(np.maximum(power, 1e-12))
+
+def window_flux(samples, sample_rate, band):
+    '''Return the mean spectral flux between frames of the windows `samples` (windows, samples) in the frequency `band`'''
+    frames = samples.shape[1] // FRAME_LENGTH
+    framed = samples[:, :frames * FRAME_LENGTH].reshape(len(samples), frames, FRAME_LENGTH) * np.hanning(FRAME_LENGTH)
+    freqs = np.fft.rfftfreq(FRAME_LENGTH, 1. / sample_rate)
+    in_band = (freqs >= band[0]) & (freqs <= band[1])
+    magnitude = np.abs(np.fft.rfft(framed, axis=2)[:, :, in_band]) / FRAME_LENGTH
+    if frames < 2:
+        return np.zeros(len(samples))
+    return np.mean(np.sum(np.maximum(np.diff(magnitude, axis=1), 0), axis=2), axis=1)
+
+def active_windows(samples, sample_rate, threshold=-60., band=(150, 15000), flux_threshold=None):
+    '''
+    Select the windows to pass to the model.
+
+    A window is active if its band-limited RMS level reaches `threshold`
+    (dBFS), or if `flux_threshold` is set, its spectral flux reaches it.
+    Returns the mask of active windows and the levels.
+    '''
+    samples = np.asarray(samples, dtype='float32')
+    level = window_levels(samples, sample_rate, band)
+    active = level >= threshold
+    if flux_threshold is not None:
+        active |= window_flux(samples, sample_rate, band) >= flux_threshold
+    return active, level
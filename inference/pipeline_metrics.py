@@ -0,0 +1,153 @@
+'''
+# Prometheus metrics of the inference pipelines
+
+Served by the runner process on `/metrics`, aggregated over the processes of
+the worker pool (multiprocess mode of prometheus_client: the workers write
+their values to files in a shared directory, the runner sums them up on scrape).
+
+- `inference_queue_tasks`: tasks per state (pending, running), queried on scrape
+- `inference_tasks_total`: completed tasks per state (succeeded, failed),
+  `rate()` gives tasks/s
+- `inference_audio_seconds_total`: audio processed, `rate()` gives audio-seconds/s
+- `inference_bytes_read_total`: input read
+- `inference_stage_seconds`: histogram of the time per task and stage (see task_telemetry.py)
+- `inference_batch_fill_ratio`: histogram of the windows per model batch / batch size
+- `inference_worker_rss_bytes`: resident memory of the runner and its workers (sum of live processes)
+'''
+
+import os
+import glob
+import atexit
+import shutil
+import resource
+import tempfile
+
+from task_telemetry import STAGES
+
+STAGE_BUCKETS = (.01, .05, .1, .5, 1, 5, 10, 30, 60, 120, 300, 600, 1800)
+FILL_BUCKETS = (.1, .25, .5, .75, .9, 1)
+
+metrics = None # set by start() in the runner, inherited by the forked workers
+
+class PipelineMetrics(object):
+
+    def __init__(self, pipeline):
+        # prometheus_client chooses the multiprocess mode on import
+        from prometheus_client import Counter, Gauge, Histogram
+
+        self.pipeline = pipeline
+        self.tasks = Counter('inference_tasks', 'Completed tasks', ['pipeline', 'state'])
+        self.audio_seconds = Counter('inference_audio_seconds', 'Audio processed', ['pipeline'])
+        self.bytes_read = Counter('inference_bytes_read', 'Input read', ['pipeline'])
+        self.stage_seconds = Histogram('inference_stage_seconds', 'Time per task and stage', ['pipeline', 'stage'], buckets=STAGE_BUCKETS)
+        self.batch_fill = Histogram('inference_batch_fill_ratio', 'Windows per model batch / batch size', ['pipeline'], buckets=FILL_BUCKETS)
+        self.rss = Gauge('inference_worker_rss_bytes', 'Resident memory', ['pipeline'], multiprocess_mode='livesum')
+
+    def task_done(self, timer, succeeded=True):
+        '''Record a task and its measurements (TaskTimer)'''
+        self.tasks.labels(self.pipeline, 'succeeded' if succeeded else 'failed').inc()
+        if succeeded:
+            self.audio_seconds.labels(self.pipeline).inc(timer.audio_seconds)
+            self.bytes_read.labels(self.pipeline).inc(timer.bytes_read)
+            for stage in STAGES:
+                self.stage_seconds.labels(self.pipeline, stage).observe(timer.seconds[stage])
+        self.update_rss()
+
+    def batch(self, windows, batch_size):
+        self.batch_fill.labels(self.pipeline).observe(windows / batch_size)
+
+    def update_rss(self):
+        self.rss.labels(self.pipeline).set(rss())
+
+    def process_exit(self):
+        '''Drop the live gauges of a worker leaving the pool'''
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(os.getpid())
+
+class QueueCollector(object):
+    '''Count the pending and running tasks of `table` on scrape'''
+
+    def __init__(self, connect, table, pipeline):
+        self.connect = connect
+        self.table = table
+        self.pipeline = pipeline
+        self.connection = None
+
+    def family(self):
+        from prometheus_client.core import GaugeMetricFamily
+        return GaugeMetricFamily('inference_queue_tasks', 'Tasks in queue', labels=['pipeline', 'state'])
+
+    def describe(self):
+        # the registry doesn't call collect() on registering (no db query before the first scrape)
+        return [self.family()]
+
+    def collect(self):
+        family = self.family()
+        try:
+            if self.connection is None or self.connection.closed:
+                self.connection = self.connect()
+            cursor = self.connection.cursor()
+            # counted through the partial index on pending tasks (task_dispatch.sql)
+            cursor.execute(f'select count(*) filter (where state = 0), count(*) filter (where state = 1) from {self.table} where state in (0, 1)')
+            pending, running = cursor.fetchone()
+            self.connection.rollback()
+        except Exception as e:
+            print(f'counting tasks for metrics failed: {e}', flush=True)
+            self.connection = None
+            return
+        family.add_metric([self.pipeline, 'pending'], pending)
+        family.add_metric([self.pipeline, 'running'], running)
+        yield family
+
+def rss():
+    '''Resident set size of the process in bytes (peak size where /proc is not available)'''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def attach(pipeline):
+    '''Metrics of a worker process, workers started with spawn don't inherit them from the runner'''
+    global metrics
+    if metrics is None:
+        metrics = PipelineMetrics(pipeline)
+    return metrics
+
+def remove_directory(directory, pid):
+    '''Remove the value files of the run when the runner exits (not in forked workers)'''
+    if os.getpid() == pid:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def remove_stale_directories(pipeline):
+    '''Remove the directories of runners that were killed before their exit handler ran'''
+    for directory in glob.glob(os.path.join(tempfile.gettempdir(), f'{pipeline}-metrics-*-*')):
+        try:
+            os.kill(int(os.path.basename(directory).split('-')[2]), 0)
+        except ValueError:
+            continue
+        except ProcessLookupError:
+            shutil.rmtree(directory, ignore_errors=True)
+        except PermissionError:
+            continue # running as another user
+
+def start(port, pipeline, connect, table):
+    '''
+    Serve the metrics on `port`, before the worker pool is started.
+    `connect` opens a db connection for counting the tasks in `table`.
+    '''
+    global metrics
+    # a fresh directory per run, the values of an earlier run are not carried over
+    remove_stale_directories(pipeline)
+    directory = tempfile.mkdtemp(prefix=f'{pipeline}-metrics-{os.getpid()}-')
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = directory
+    atexit.register(remove_directory, directory, os.getpid())
+    from prometheus_client import CollectorRegistry, multiprocess, start_http_server
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(QueueCollector(connect, table, pipeline))
+    start_http_server(port, registry=registry)
+    metrics = PipelineMetrics(pipeline)
+    metrics.update_rss()
+    return metrics
@@ -0,0 +1,81 @@
+'''
+# Merge task profiles into a hotspot report
+
+Aggregates the profiles written by the workers with `--profile-every`
+(see task_profiler.py): time per package, and the functions with the most
+time spent in them (tottime) or below them (cumulative).
+'''
+
+import os
+import re
+import glob
+import pstats
+import argparse
+from collections import defaultdict
+
+FILE_PATTERN = re.compile(r'(?P<pipeline>\w+?)_task-(?P<task_id>\d+)_config-(?P<config_id>[^_]+)_.*\.prof$')
+
+def select_profiles(directory, pipeline=None, config_id=None):
+    '''Profile files in `directory`, of `pipeline` and `config_id` if set'''
+    files = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.prof'))):
+        match = FILE_PATTERN.match(os.path.basename(path))
+        if match is None:
+            continue
+        if pipeline is not None and match['pipeline'] != pipeline:
+            continue
+        if config_id is not None and match['config_id'] != str(config_id):
+            continue
+        files.append(path)
+    return files
+
+def package_of(filename, function):
+    '''Group functions by installed package, or by module for the pipeline code'''
+    if filename == '~':
+        # C functions: "<method 'invoke' of 'module.Type' objects>", "<built-in method module.function>"
+        match = re.search(r"of '(\w+)\.[\w.]+' objects", function) or re.match(r'<built-in method (\w+)\.[\w.]+>', function)
+        return match[1] if match else 'builtins'
+    parts = filename.replace('\\', '/').split('/')
+    for marker in ('site-packages', 'dist-packages'):
+        if marker in parts[:-1]:
+            return parts[parts.index(marker) + 1].split('.')[0]
+    if filename.startswith('<frozen') or re.search(r'/lib/python3[.\d]*/', filename):
+        return 'stdlib'
+    return os.path.basename(filename)
+
+def package_times(stats):
+    '''Total time spent in the functions of each package'''
+    totals = defaultdict(float)
+    for (filename, line, function), (cc, nc, tt, ct, callers) in stats.stats.items():
+        totals[package_of(filename, function)] += tt
+    return sorted(totals.items(), key=lambda item: -item[1])
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Merge the task profiles of the inference workers into a hotspot report')
+    parser.add_argument('directory', metavar='DIR', help='Directory with the profiles (--profile-dir of the pipelines)')
+    parser.add_argument('--pipeline', choices=['birdnet', 'batnet'], help='Only merge profiles of this pipeline')
+    parser.add_argument('--config', type=int, metavar='ID', help='Only merge profiles of tasks with configuration ID')
+    parser.add_argument('--sort', choices=['tottime', 'cumulative', 'ncalls'], default='tottime', help='Order of the functions (tottime)')
+    parser.add_argument('--limit', type=int, default=30, metavar='N', help='Number of functions to list (30)')
+    parser.add_argument('--output', metavar='FILE', help='Write the merged profile to FILE (for snakeviz etc.)')
+    args = parser.parse_args()
+
+    files = select_profiles(args.directory, args.pipeline, args.config)
+    if len(files) == 0:
+        parser.error(f'no profiles found in {args.directory}')
+
+    stats = pstats.Stats(*files)
+    print(f'merged {len(files)} task profiles, {stats.total_tt:.1f} s total\n')
+
+    print('time per package')
+    for package, seconds in package_times(stats):
+        if seconds / stats.total_tt < 0.001:
+            break
+        print(f'{seconds:10.1f} s {seconds / stats.total_tt:6.1%}  {package}')
+    print()
+
+    if args.output is not None:
+        stats.dump_stats(args.output)
+
+    stats.strip_dirs().sort_stats(args.sort).print_stats(args.limit)
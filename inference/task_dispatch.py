@@ -0,0 +1,35 @@
+'''
+# Task dispatch with LISTEN/NOTIFY
+
+Idle runners wait for a notification on the channel of their task table
+(`birdnet_tasks`, `batnet_tasks`), sent by the triggers in `task_dispatch.sql`
+and by `queue_batch`, instead of sleeping for a fixed interval. The wait times
+out after `timeout` seconds, so tasks are still picked up (by polling) if the
+triggers are not installed.
+'''
+
+import select
+
+def listen(connection, channel):
+    '''Subscribe the connection to notifications on `channel`'''
+    cursor = connection.cursor()
+    cursor.execute(f'listen {channel}')
+    connection.commit()
+
+def notify(cursor, channel):
+    '''Wake the runners listening on `channel`, on commit of the current transaction'''
+    cursor.execute(f'notify {channel}')
+
+def wait(connection, timeout=10):
+    '''
+    Wait for a notification on the channels the connection listens to.
+    Returns True if notified, False on timeout.
+    '''
+    # notifications received with the results of earlier queries
+    if not connection.notifies:
+        if select.select([connection], [], [], timeout) == ([], [], []):
+            return False
+        connection.poll()
+    notified = len(connection.notifies) > 0
+    connection.notifies.clear()
+    return notified
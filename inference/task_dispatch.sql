@@ -0,0 +1,39 @@
+-- Task dispatch for the BirdNET and BatNET pipelines (see task_dispatch.py)
+-- run in the schema of the pipelines: PGOPTIONS='-c search_path=prod' psql -f task_dispatch.sql
+
+-- pending tasks are claimed through partial indexes, their size depends on the
+-- number of pending tasks only, not on the completed tasks accumulating
+create index if not exists birdnet_tasks_pending_idx on birdnet_tasks (task_id) where state = 0;
+create index if not exists batnet_tasks_pending_idx on batnet_tasks (task_id) where state = 0;
+
+-- notify the runners listening on the channel named after the table,
+-- once per statement inserting or updating pending tasks
+create or replace function notify_pending_tasks() returns trigger language plpgsql as $$
+begin
+    if exists (select 1 from pending_tasks where state = 0) then
+        perform pg_notify(TG_TABLE_NAME, '');
+    end if;
+    return null;
+end;
+$$;
+
+-- transition tables are only allowed on triggers with a single event
+drop trigger if exists birdnet_tasks_notify_insert on birdnet_tasks;
+create trigger birdnet_tasks_notify_insert after insert on birdnet_tasks
+    referencing new table as pending_tasks
+    for each statement execute function notify_pending_tasks();
+
+drop trigger if exists birdnet_tasks_notify_update on birdnet_tasks;
+create trigger birdnet_tasks_notify_update after update on birdnet_tasks
+    referencing new table as pending_tasks
+    for each statement execute function notify_pending_tasks();
+
+drop trigger if exists batnet_tasks_notify_insert on batnet_tasks;
+create trigger batnet_tasks_notify_insert after insert on batnet_tasks
+    referencing new table as pending_tasks
+    for each statement execute function notify_pending_tasks();
+
+drop trigger if exists batnet_tasks_notify_update on batnet_tasks;
+create trigger batnet_tasks_notify_update after update on batnet_tasks
+    referencing new table as pending_tasks
+    for each statement execute function notify_pending_tasks();
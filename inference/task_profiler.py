@@ -0,0 +1,58 @@
+'''
+# Task profiler
+
+Profile every Nth task of a worker with cProfile, and write the profile of each
+task to `{pipeline}_task-{task_id}_config-{config_id}_{node}_{pid}.prof`,
+to be merged into a hotspot report with `profile_report.py`.
+'''
+
+import os
+import socket
+import cProfile
+from contextlib import contextmanager
+
+class TaskProfiler(object):
+
+    def __init__(self, directory, every, pipeline):
+        self.directory = directory
+        self.every = every
+        self.pipeline = pipeline
+        self.count = 0 # tasks of this process
+        self.profiler = None
+        self.task = None
+        if every:
+            os.makedirs(directory, exist_ok=True)
+
+    def file_name(self, task_id, config_id):
+        return os.path.join(self.directory,
+            f'{self.pipeline}_task-{task_id}_config-{config_id}_{socket.gethostname()}_{os.getpid()}.prof')
+
+    def start(self, task_id, config_id):
+        '''Start profiling if this is the Nth task of the process'''
+        self.count += 1
+        self.profiler = None
+        if self.every and self.count % self.every == 0:
+            self.task = (task_id, config_id)
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop(self):
+        '''Stop profiling and write the profile of the task'''
+        if self.profiler is None:
+            return
+        self.profiler.disable()
+        task_id, config_id = self.task
+        try:
+            self.profiler.dump_stats(self.file_name(task_id, config_id))
+        except OSError as e:
+            print(f'writing profile of task {task_id} failed: {e}', flush=True)
+        self.profiler = None
+
+    @contextmanager
+    def profile(self, task_id, config_id):
+        '''Profile the block if it runs the Nth task of the process'''
+        self.start(task_id, config_id)
+        try:
+            yield
+        finally:
+            self.stop()
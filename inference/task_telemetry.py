@@ -0,0 +1,63 @@
+'''
+# Task telemetry
+
+Time spent per stage of an inference task, the audio processed and the bytes
+read, stored per task in `task_timings` (see README), for `telemetry_report.py`.
+'''
+
+import socket
+import time
+from contextlib import contextmanager
+
+STAGES = ('download', 'decode', 'inference', 'postprocess', 'db_write')
+
+class TaskTimer(object):
+
+    def __init__(self):
+        self.node = socket.gethostname()
+        self.reset()
+
+    def reset(self):
+        '''Start measuring a new task'''
+        self.seconds = dict.fromkeys(STAGES, 0.)
+        self.audio_seconds = 0.
+        self.bytes_read = 0
+        self.active = []
+        self.started = None
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Measure the time spent in the block as stage `name`. Stages are exclusive:
+        the time of a nested stage is not counted in the enclosing stage.
+        '''
+        now = time.perf_counter()
+        if self.active:
+            self.seconds[self.active[-1]] += now - self.started
+        self.active.append(name)
+        self.started = now
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.seconds[self.active.pop()] += now - self.started
+            self.started = now
+
+    def save(self, connection, schema, pipeline, task_id, config_id):
+        '''
+        Store the measurements of the task, replacing those of an earlier attempt.
+        Failing to store them doesn't fail the task.
+        '''
+        try:
+            connection.cursor().execute(f'''
+            insert into {schema}.task_timings (pipeline, task_id, config_id, node,
+                {', '.join(STAGES)}, audio_seconds, bytes_read, recorded_on)
+            values (%s, %s, %s, %s, {', '.join(['%s'] * len(STAGES))}, %s, %s, now())
+            on conflict (pipeline, task_id) do update set config_id = excluded.config_id, node = excluded.node,
+                {', '.join(f'{s} = excluded.{s}' for s in STAGES)},
+                audio_seconds = excluded.audio_seconds, bytes_read = excluded.bytes_read, recorded_on = excluded.recorded_on
+            ''', (pipeline, task_id, config_id, self.node, *[self.seconds[s] for s in STAGES], self.audio_seconds, self.bytes_read))
+            connection.commit()
+        except Exception as e:
+            connection.rollback()
+            print(f'storing timings of task {task_id} failed: {e}', flush=True)
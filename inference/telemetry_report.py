@@ -0,0 +1,104 @@
+'''
+# Report on the task telemetry of the inference pipelines
+
+Throughput per node, configuration and hour, and the time spent per stage,
+from the measurements stored by the workers in `task_timings` (see task_telemetry.py).
+'''
+
+import sys
+import argparse
+import psycopg2 as pg
+
+sys.path.append('../')
+import credentials as crd
+
+from task_telemetry import STAGES
+
+GROUPS = {
+    'node': 'node',
+    'config': 'config_id',
+    'hour': "date_trunc('hour', recorded_on)",
+}
+
+def print_table(header, rows):
+    widths = [max(len(str(v)) for v in column) for column in zip(header, *rows)]
+    for row in [header] + rows:
+        print('  '.join(str(v).rjust(w) for v, w in zip(row, widths)))
+    print()
+
+def throughput(cursor, group, where, params):
+    '''Tasks, audio processed and realtime factor (audio time / processing time) per group'''
+    cursor.execute(f'''
+    select {GROUPS[group]} as key, count(*), sum(audio_seconds) / 3600, sum(bytes_read) / 1e9,
+        sum(audio_seconds) / nullif(sum({' + '.join(STAGES)}), 0),
+        {', '.join(f'sum({s}) / nullif(sum({" + ".join(STAGES)}), 0)' for s in STAGES)}
+    from {crd.db.schema}.task_timings
+    where {where}
+    group by key
+    order by key
+    ''', params)
+    rows = [[key, tasks, f'{hours:.1f}', f'{gb:.1f}', f'{factor or 0:.1f}x', *[f'{share or 0:.0%}' for share in shares]]
+        for key, tasks, hours, gb, factor, *shares in cursor.fetchall()]
+    print_table([group, 'tasks', 'audio h', 'read GB', 'realtime', *STAGES], rows)
+
+def stages(cursor, where, params):
+    '''Total, median and 95th percentile time per stage'''
+    cursor.execute(f'''
+    select s.stage, sum(s.seconds) / 3600,
+        percentile_cont(0.5) within group (order by s.seconds),
+        percentile_cont(0.95) within group (order by s.seconds)
+    from {crd.db.schema}.task_timings t
+    cross join lateral (values {', '.join(f"('{s}', t.{s})" for s in STAGES)}) as s(stage, seconds)
+    where {where}
+    group by s.stage
+    order by 2 desc
+    ''', params)
+    rows = [[stage, f'{hours:.2f}', f'{p50:.2f}', f'{p95:.2f}'] for stage, hours, p50, p95 in cursor.fetchall()]
+    print_table(['stage', 'total h', 'p50 s', 'p95 s'], rows)
+
+def slowest(cursor, limit, where, params):
+    '''Tasks with the lowest realtime factor, and their slowest stage'''
+    cursor.execute(f'''
+    select pipeline, task_id, node, config_id, audio_seconds, {', '.join(STAGES)}
+    from {crd.db.schema}.task_timings
+    where {where} and audio_seconds > 0
+    order by ({' + '.join(STAGES)}) / audio_seconds desc
+    limit %s
+    ''', (*params, limit))
+    rows = []
+    for pipeline, task_id, node, config_id, audio_seconds, *seconds in cursor.fetchall():
+        total = sum(seconds)
+        stage = STAGES[seconds.index(max(seconds))]
+        rows.append([pipeline, task_id, node, config_id, f'{audio_seconds:.0f}', f'{total:.1f}', f'{stage} ({max(seconds) / max(total, 1e-9):.0%})'])
+    print_table(['pipeline', 'task', 'node', 'config', 'audio s', 'total s', 'slowest stage'], rows)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Report throughput and time per stage of the inference pipelines')
+    parser.add_argument('--pipeline', choices=['birdnet', 'batnet'], help='Only report on tasks of this pipeline')
+    parser.add_argument('--since', default='7 days', metavar='INTERVAL', help='Report on tasks completed within INTERVAL (7 days)')
+    parser.add_argument('--by', nargs='+', choices=list(GROUPS), default=list(GROUPS), help='Throughput per node, config and/or hour (all)')
+    parser.add_argument('--slowest', type=int, default=10, metavar='N', help='List the N slowest tasks relative to their audio duration (10)')
+    args = parser.parse_args()
+
+    where = 'recorded_on > now() - %s::interval'
+    params = (args.since,)
+    if args.pipeline is not None:
+        where += ' and pipeline = %s'
+        params += (args.pipeline,)
+
+    connection = pg.connect(host=crd.db.host, port=crd.db.port, database=crd.db.database, user=crd.db.user, password=crd.db.password)
+    cursor = connection.cursor()
+
+    for group in args.by:
+        print(f'throughput per {group}')
+        throughput(cursor, group, where, params)
+
+    print('time per stage')
+    stages(cursor, where, params)
+
+    if args.slowest > 0:
+        print(f'{args.slowest} slowest tasks')
+        slowest(cursor, args.slowest, where, params)
+
+    connection.close()
@@ -1,36 +1,30 @@
+import os
 import re
 import mimetypes
-import hashlib
 import argparse
-import audio_metadata
 
 import psycopg2 as pg
 
 import sys
 sys.path.append('../../')
+sys.path.append('../uploader')
 import credentials as crd
+import audiomoth
+import blockdevice
 
-from datetime import datetime, timezone, timedelta, date
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
 from os.path import basename, getsize
 from tqdm.auto import tqdm
 from psycopg2.extras import execute_values
 
-BS = 65536
-
 class FormatNotAudio(Exception):
     pass
 
 class PathParseError(Exception):
     pass
 
-rec_nok_str = {
-    'microphone change': 'MICROPHONE_CHANGED',
-    'change of switch position': 'SWITCH_CHANGED',
-    'switch position change': 'SWITCH_CHANGED',
-    'low voltage': 'SUPPLY_VOLTAGE_LOW',
-    'magnetic switch': 'MAGNETIC_SWITCH',
-    'file size limit': 'FILE_SIZE_LIMITED'
-}
 
 def extract_meta(path):
     info = {}
@@ -43,109 +37,22 @@ def extract_meta(path):
     if file_size == 0:
         raise FormatNotAudio('File is empty', 'empty')
 
-    # create SHA256 hash
-    file_hash = hashlib.sha256()
-    with open(path, 'rb') as f:
-        fb = f.read(BS)
-        while len(fb) > 0:
-            file_hash.update(fb)
-            fb = f.read(BS)
-    info['sha256'] = file_hash.hexdigest()
-
+    # create SHA256 hash and read the RIFF header in one sequential pass
     # TODO: find sensible defaults if audiofile doesn't contain AudioMoth Data
-    meta = audio_metadata.load(path)
-    comment = meta.tags.comment[0]
-
-    info['original_file_name'] = basename(meta.filepath)
-    info['filesize'] = meta.filesize
-    info['audio_format'] = meta.streaminfo.audio_format
-    info['bit_depth'] = meta.streaminfo.bit_depth
-    info['channels'] = meta.streaminfo.channels
-    info['duration'] = meta.streaminfo.duration
-    info['sample_rate'] = meta.streaminfo.sample_rate
-
-    # Read the time and timezone from the header
-    ts = re.search(r"(\d\d:\d\d:\d\d \d\d/\d\d/\d\d\d\d)", comment)[1]
-    tz = re.search(r"\(UTC([-|+]\d+)?:?(\d\d)?\)", comment)
-    hrs = 0 if tz[1] is None else int(tz[1])
-    mins = 0 if tz[2] is None else -int(tz[2]) if hrs < 0 else int(tz[2])
-
-    info['serial_number'] = re.search(r"by AudioMoth ([^ ]+)", comment)[1]
-
-    extmic = re.search(r'using external microphone', comment)
-    if extmic != None:
-        info['source'] = 'external'
-    else:
-        info['source'] = 'internal'
-
-    info['gain'] = re.search(r"at ([a-z-]+) gain", comment)[1]
-
-    # - Band-pass filter with frequencies of 1.0kHz and 192.0kHz applied.
-    # LOW_PASS_FILTER x, BAND_PASS_FILTER x y, HIGH_PASS_FILTER x
-    bpf = re.search(r"Band-pass filter with frequencies of (\d+\.\d+)kHz and (\d+\.\d+)kHz applied\.", comment)
-    lpf = re.search(r"Low-pass filter with frequency of (\d+\.\d+)kHz applied\.", comment)
-    hpf = re.search(r"High-pass filter with frequency of (\d+\.\d+)kHz applied\.", comment)
-
-    if bpf != None:
-        info['filter'] = f'BAND_PASS_FILTER {bpf[1]} {bpf[2]}'
-    elif lpf != None:
-        info['filter'] = f'LOW_PASS_FILTER {lpf[1]}'
-    elif hpf != None:
-        info['filter'] = f'HIGH_PASS_FILTER {hpf[1]}'
-    else:
-        info['filter'] = 'NO_FILTER'
+    meta = audiomoth.read_wav(path)
+    comment = meta['comment']
 
-    timestamp = datetime.strptime(ts, "%H:%M:%S %d/%m/%Y")
-    info['time_start'] = timestamp.replace(tzinfo=timezone(timedelta(hours=hrs, minutes=mins)))
+    info['sha256'] = meta['sha256']
+    info['original_file_name'] = basename(path)
+    info['filesize'] = meta['filesize']
+    info['audio_format'] = meta['audio_format']
+    info['bit_depth'] = meta['bit_depth']
+    info['channels'] = meta['channels']
+    info['duration'] = meta['duration']
+    info['sample_rate'] = meta['sample_rate']
 
-    amp_res = re.search(r'Amplitude threshold was ([^ ]+) with ([^ ]+)s minimum trigger duration\.', comment)
-    if amp_res != None:
-        info['amp_thresh'], info['amp_trig'] = amp_res.groups()
-    else:
-        info['amp_thresh'], info['amp_trig'] = None, None # for postgres
-
-    # Read the battery voltage and temperature from the header
-    info['battery'] = re.search(r"(\d\.\d)V", comment)[1]
-    info['temperature'] = re.search(r"(-?\d+\.\d)C", comment)[1]
-
-    # read the remaining comment:
-    #
-    # !RECORDING_OKAY and ever only one more condition
-    #
-    # the AM recordings contain comments from several firmware versions!
-    # the syntax differs (see test.py for unit tests of the expression):
-    # - [old]     Recording cancelled before completion due to
-    # - [...]     Recording stopped due to
-    # - [current] Recording stopped
-    #
-    # MICROPHONE_CHANGED
-    # - microphone change.
-    # - due to microphone change.
-    #
-    # SWITCH_CHANGED
-    # - change of switch position.
-    # - switch position change.
-    # - due to switch position change.
-    #
-    # MAGNETIC_SWITCH
-    # - by magnetic switch.
-    #
-    # SUPPLY_VOLTAGE_LOW
-    # - low voltage.
-    # - due to low voltage.
-    #
-    # FILE_SIZE_LIMITED
-    # - file size limit.
-    # - due to file size limit.
-    #
-    # - Recording stopped due to switch position change.
-    # - Recording cancelled before completion due to low voltage.
-    #
-    rec_nok = re.search(r" Recording (?:cancelled before completion|stopped) (?:by|due to) (magnetic switch|microphone change|change of switch position|switch position change|low voltage|file size limit)\.", comment)
-    if rec_nok != None:
-        info['rec_end_status'] = rec_nok_str[rec_nok[1]]
-    else:
-        info['rec_end_status'] = 'RECORDING_OKAY'
+    # parse the AudioMoth comment (time, timezone, device settings, recording status)
+    info.update(audiomoth.parse_comment(comment))
 
     return info
 
@@ -237,6 +144,112 @@ def extract_pathinfo(path, pattern_id):
 
         return (kw, device_id, base_filename, comment)
 
+def process_record(item):
+    '''
+    Extract path and file information of a record, runs in a worker process.
+
+    Returns (file_id, state, values, message): `state` selects the update
+    written to the record (see `state_updates`), None if the record can't be
+    processed now and should be retried. Unexpected errors mark the record
+    as 'invalid format' for inspection, instead of ending the run.
+    '''
+    file_id, disk_filepath, pattern_id = item
+    try:
+        return extract_record(file_id, disk_filepath, pattern_id)
+    except Exception as err:
+        return file_id, 'invalid format', None, f'{disk_filepath}: {type(err).__name__}: {err}'
+
+def extract_record(file_id, disk_filepath, pattern_id):
+    # extract information from file path
+    try:
+        kw, device_id, base_filename, comment = extract_pathinfo(disk_filepath, pattern_id)
+    except PathParseError as err:
+        # mark the record for inspection
+        return file_id, 'invalid path', None, str(err)
+
+    # extract metadata from file
+    try:
+        info = extract_meta(disk_filepath)
+        info['kw'] = kw
+        info['device_id'] = device_id
+        info['comment'] = comment
+        return file_id, 'updated', info, f'--- {kw} {device_id} {base_filename} --- {disk_filepath}'
+    except audiomoth.UnsupportedFormat as err:
+        return file_id, 'invalid format', None, f'{disk_filepath}: {err}'
+    except FormatNotAudio as err:
+        if err.args[1] == 'text/plain' and base_filename is not None and re.search('config.txt', base_filename, re.IGNORECASE):
+            return file_id, 'config', {'kw': kw, 'device_id': device_id}, f'adding config file: {disk_filepath}'
+        elif err.args[1] == 'application/zip':
+            return file_id, 'zip', None, f'invalid format: {err.args[1]}'
+        elif err.args[1] == 'empty':
+            return file_id, 'empty', None, 'invalid format: empty file'
+        else:
+            return file_id, 'invalid format', None, f'invalid format: {err.args[1]}'
+    except OSError as err:
+        return file_id, None, None, f'{disk_filepath}: {err}'
+
+# bulk updates per state of processed records: (SET clause, VALUES columns, VALUES template)
+state_updates = {
+    'updated': ('''
+        action = 'rename',
+        state = 'updated',
+        sha256 = data.sha256,
+        time_start = data.time_start,
+        file_size = data.file_size,
+        format = data.format,
+        sample_rate = data.sample_rate,
+        bit_depth = data.bit_depth,
+        channels = data.channels,
+        week = data.week,
+        device_id = data.device_id,
+        serial_number = data.serial_number,
+        battery = data.battery,
+        temperature = data.temperature,
+        duration = data.duration,
+        gain = data.gain,
+        filter = data.filter,
+        source = data.source,
+        rec_end_status = data.rec_end_status,
+        comment = data.comment''',
+        ('file_id', 'sha256', 'time_start', 'file_size', 'format', 'sample_rate', 'bit_depth', 'channels', 'week',
+            'device_id', 'serial_number', 'battery', 'temperature', 'duration', 'gain', 'filter', 'source', 'rec_end_status', 'comment'),
+        '''(%(file_id)s, %(sha256)s, %(time_start)s::timestamptz, %(filesize)s::integer, %(audio_format)s::varchar,
+            %(sample_rate)s::integer, %(bit_depth)s::smallint, %(channels)s::smallint, %(kw)s::varchar, %(device_id)s::varchar,
+            %(serial_number)s, %(battery)s::real, %(temperature)s::real, %(duration)s::double precision, %(gain)s,
+            %(filter)s, %(source)s, %(rec_end_status)s, %(comment)s::varchar)'''),
+    'config': (
+        "action = 'rename', state = 'updated', format = 'text', week = data.week, device_id = data.device_id",
+        ('file_id', 'week', 'device_id'),
+        '(%(file_id)s, %(kw)s::varchar, %(device_id)s::varchar)'),
+    'invalid path': ("action = 'inspect', state = 'invalid path'", ('file_id',), '(%(file_id)s)'),
+    'invalid format': ("action = 'inspect', state = 'invalid format'", ('file_id',), '(%(file_id)s)'),
+    'zip': ("action = 'inspect', state = 'invalid format', format = 'zip'", ('file_id',), '(%(file_id)s)'),
+    'empty': ("action = 'ignore', state = 'empty audio', file_size = 0", ('file_id',), '(%(file_id)s)'),
+}
+
+# states the default fileset query selects again, to be retried (i.e. with another --pattern):
+# not recorded in the checkpoint, the record is only skipped once its state is final
+retry_states = {'invalid path'}
+
+def write_updates(cursor, updates):
+    '''Write the processed records in `updates` (state -> list of values) with one UPDATE per state'''
+    for state, values in updates.items():
+        if len(values) == 0:
+            continue
+        set_clause, columns, template = state_updates[state]
+        execute_values(cursor, '''
+            UPDATE files SET {}, updated_at = now()
+            FROM (VALUES %s) AS data ({})
+            WHERE files.file_id = data.file_id'''.format(set_clause, ', '.join(columns)),
+        values, template=template, page_size=len(values))
+
+def read_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r') as f:
+        return {int(line) for line in f if line.strip().isdigit()}
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Extract data from audio files created by AudioMoth')
     parser.add_argument('--disk', help='disk name selector for files in DB', required=True)
@@ -245,6 +258,10 @@ if __name__ == '__main__':
     parser.add_argument('--opath', help='original path selector for files in DB')
     parser.add_argument('--update_raw', action='store_true', help='1. update the raw file recordings (containing only original file path and disk information)')
     parser.add_argument('--check_empty', action='store_true', help='2. for files with invalid format, check if they are empty')
+    parser.add_argument('--workers', type=int, help='number of worker processes for --update_raw (default: 1 on rotational disks, number of CPUs otherwise)')
+    parser.add_argument('--batchsize', type=int, default=500, help='number of records per bulk update / checkpoint for --update_raw')
+    parser.add_argument('--checkpoint', help='file recording the processed records for --update_raw, except those to be retried (invalid path) (default: <disk>-update_raw.checkpoint)')
+    parser.add_argument('--dry_run', action='store_true', help='print the extracted information, don\'t update records')
     args = parser.parse_args()
 
     # configure the targets
@@ -285,115 +302,68 @@ if __name__ == '__main__':
     # - extract audio metadata from disk
     # - update record
     if args.update_raw:
+        # resume: skip the records processed in a previous run
+        checkpointfile = args.checkpoint if args.checkpoint else f'{disk}-update_raw.checkpoint'
+        processed = read_checkpoint(checkpointfile)
+        if len(processed) > 0:
+            print(f'resuming from {checkpointfile}: skipping {len(processed)} processed records.')
+        items = [(file_id, mountpoint + path_prefix + filepath, args.pattern) for file_id, filepath in fileset if file_id not in processed]
+
+        # random read is very slow on rotational disks: read the files one by one, in the order they are stored on disk
+        workers = args.workers
+        if blockdevice.is_rotational(mountpoint) != False:
+            items_by_path = {item[1]: item for item in items}
+            items = [items_by_path[path] for path in blockdevice.physical_order(items_by_path.keys())]
+            if workers is None:
+                workers = 1
+        if workers is None:
+            workers = os.cpu_count()
+
         count = 0
-        progress = tqdm(total=files_count)
-        for file_id, filepath in fileset:
-            disk_filepath = mountpoint + path_prefix + filepath
-            # extract information from file path
-            try:
-                kw, device_id, base_filename, comment = extract_pathinfo(disk_filepath, args.pattern)
-                progress.write(f'--- {kw} {device_id} {base_filename} --- {disk_filepath}')
-            except PathParseError as err:
-                progress.write(err.__str__())
-                # mark the record for inspection
-                query = '''UPDATE files SET action = 'inspect', state = 'invalid path', updated_at = now() WHERE file_id = %s'''
-                #cursor.execute(query, (file_id,))
-                count += 1
-                if count % 100 == 0:
-                    progress.write(f'count: {count}, committing 100 records')
-                    #pg_server.commit()
-                progress.update(1)
-                continue
-
-            # extract metadata from file and write it to record
-            try:
-                info = extract_meta(disk_filepath)
-                info['kw'] = kw
-                info['device_id'] = device_id
-                info['comment'] = comment
-                query = '''UPDATE files SET
-                        action = 'rename',
-                        state = 'updated',
-                        sha256 = %s,
-                        time_start = %s,
-                        file_size = %s,
-                        format = %s,
-                        sample_rate = %s,
-                        bit_depth = %s,
-                        channels = %s,
-                        week = %s,
-                        device_id = %s,
-                        serial_number = %s,
-                        battery = %s,
-                        temperature = %s,
-                        duration = %s,
-                        gain = %s,
-                        filter = %s,
-                        source = %s,
-                        rec_end_status = %s,
-                        comment = %s,
-                        updated_at = now()
-                    WHERE file_id = %s
-                '''
-                # cursor.execute(query,
-                #     (
-                #         info['sha256'],
-                #         info['time_start'],
-                #         info['filesize'],
-                #         info['audio_format'],
-                #         info['sample_rate'],
-                #         info['bit_depth'],
-                #         info['channels'],
-                #         info['kw'],
-                #         info['device_id'],
-                #         info['serial_number'],
-                #         info['battery'],
-                #         info['temperature'],
-                #         info['duration'],
-                #         info['gain'],
-                #         info['filter'],
-                #         info['source'],
-                #         info['rec_end_status'],
-                #         info['comment'],
-                #         file_id
-                #     )
-                # )
-                progress.write(info.__str__())
-
-            except audio_metadata.exceptions.UnsupportedFormat as err:
-                query = '''UPDATE files SET action = 'inspect', state = 'invalid format', updated_at = now() WHERE file_id = %s'''
-                #cursor.execute(query, (file_id,))
-                progress.write(f'{disk_filepath}: {err}')
-
-            except FormatNotAudio as err:
-                if err.args[1] == 'text/plain' and re.search('config.txt', base_filename, re.IGNORECASE):
-                    progress.write(f'adding config file: {filepath}')
-                    query = '''UPDATE files SET
-                        action = 'rename', state = 'updated', format = 'text', updated_at = now()
-                        week = %s,
-                        device_id = %s,
-                    WHERE file_id = %s'''
-                    #cursor.execute(query, (kw, device_id, file_id))
-                else:
-                    if err.args[1] == 'application/zip':
-                        progress.write(f'invalid format: {err.args[1]}')
-                        query = '''UPDATE files SET action = 'inspect', state = 'invalid format', format = 'zip', updated_at = now() WHERE file_id = %s'''
-                    elif err.args[1] == 'empty':
-                        progress.write(f'invalid format: empty file')
-                        query = '''UPDATE files SET action = 'ignore', state = 'empty audio', file_size = 0, updated_at = now() WHERE file_id = %s'''
-                    else:
-                        progress.write(f'invalid format: {err.args[1]}')
-                        query = '''UPDATE files SET action = 'inspect', state = 'invalid format', updated_at = now() WHERE file_id = %s'''
-                    #cursor.execute(query, (file_id,))
-
-            finally:
-                count += 1
-                if count % 100 == 0:
-                    progress.write('\n=========== committing 100 records ===========\n')
-                    #pg_server.commit()
+        updates = {state: [] for state in state_updates}
+        batch_ids = []
+        checkpoint_ids = []
+        progress = tqdm(total=len(items))
+
+        def commit_batch():
+            global count, updates, batch_ids, checkpoint_ids
+            count += len(batch_ids)
+            if not args.dry_run:
+                write_updates(cursor, updates)
+                pg_server.commit()
+                checkpoint.write(''.join(f'{file_id}\n' for file_id in checkpoint_ids))
+                checkpoint.flush()
+                progress.write(f'count: {count}, committed {len(batch_ids)} records')
+            updates = {state: [] for state in state_updates}
+            batch_ids = []
+            checkpoint_ids = []
+
+        def results(executor, window):
+            '''Results of process_record in order, with at most `window` records submitted ahead'''
+            pending = deque()
+            for item in items:
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(process_record, item))
+            while pending:
+                yield pending.popleft().result()
+
+        with ProcessPoolExecutor(max(1, workers)) as executor, open(checkpointfile, 'a') as checkpoint:
+            for file_id, state, values, message in results(executor, max(1, workers) * 16):
+                if state != 'updated' or args.dry_run:
+                    progress.write(message)
+                if args.dry_run and values is not None:
+                    progress.write(values.__str__())
+                if state is not None:
+                    updates[state].append({**(values or {}), 'file_id': file_id})
+                    batch_ids.append(file_id)
+                    if state not in retry_states:
+                        checkpoint_ids.append(file_id)
                 progress.update(1)
-        progress.write(f'count: {count}, committing remaining records')
-        #pg_server.commit()
+                if len(batch_ids) >= args.batchsize:
+                    commit_batch()
+            if len(batch_ids) > 0:
+                commit_batch()
         progress.close()
 
     if args.check_empty:
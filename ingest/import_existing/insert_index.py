@@ -1,7 +1,8 @@
 import argparse
+import os
 from os.path import exists
 import psycopg2 as pg
-from psycopg2.extras import execute_values
+from tqdm.auto import tqdm
 
 import sys
 sys.path.append('../../')
@@ -14,6 +15,38 @@ def is_readable_file(parser, arg):
   except IOError:
     raise argparse.ArgumentTypeError(f'Can\'t read file {arg}')
 
+class IndexStream:
+    '''
+    Read-only file object passing the lines of an index file to COPY (text format).
+
+    The index file is read lazily, one line at a time: blank lines are skipped,
+    characters with special meaning in the COPY text format are escaped.
+    '''
+
+    def __init__(self, indexfile, progress):
+        self.indexfile = indexfile
+        self.progress = progress
+        self.buffer = ''
+        self.count = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            line = self.indexfile.readline()
+            if line == '':
+                break
+            self.progress.update(len(line.encode()))
+            filepath = line.strip()
+            if len(filepath) == 0:
+                continue
+            self.buffer += filepath.replace('\\', '\\\\').replace('\t', '\\t').replace('\r', '\\r') + '\n'
+            self.count += 1
+        if size < 0:
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+    readline = read
+
 def main():
     parser = argparse.ArgumentParser(description='Insert file paths into DB')
     parser.add_argument('--disk', help='disk name selector for files in DB', required=True)
@@ -29,23 +62,29 @@ def main():
         password=crd.db.password
     )
     cursor = pg_server.cursor()
-    query = '''INSERT INTO files(original_file_path, disk, created_at, updated_at) VALUES %s'''
-    count = 0
-    data = []
+
+    # stream the paths into a staging table, then insert the ones not yet recorded for this disk
+    cursor.execute('CREATE TEMPORARY TABLE index_staging (original_file_path text) ON COMMIT DROP')
+    progress = tqdm(total=os.path.getsize(args.indexfile[0]), unit='B', unit_scale=True)
     with open(args.indexfile[0], 'r') as filelist:
-        files = filelist.readlines()
-        for file in files:
-            filepath = file.strip()
-            data.append((filepath, args.disk))
-            count += 1
-            if count % 1000 == 0:
-                print(f'count: {count}, committing 1000 records')
-                execute_values(cursor, query, data, template='(%s, %s, now(), now())', page_size=100)
-                pg_server.commit()
-                data = []
-    print(f'count: {count}, committing remaining records')
-    execute_values(cursor, query, data, template='(%s, %s, now(), now())', page_size=100)
+        stream = IndexStream(filelist, progress)
+        cursor.copy_expert('COPY index_staging (original_file_path) FROM STDIN', stream)
+    progress.close()
+    print(f'count: {stream.count}, checking for existing records')
+
+    cursor.execute('ANALYZE index_staging')
+    query = '''
+    INSERT INTO files(original_file_path, disk, created_at, updated_at)
+    SELECT DISTINCT s.original_file_path, %s, now(), now()
+    FROM index_staging s
+    WHERE NOT EXISTS (
+        SELECT 1 FROM files f WHERE f.disk = %s AND f.original_file_path = s.original_file_path
+    )
+    '''
+    cursor.execute(query, (args.disk, args.disk))
+    inserted = cursor.rowcount
     pg_server.commit()
+    print(f'inserted {inserted} records, skipped {stream.count - inserted} existing or duplicate paths')
     cursor.close()
     pg_server.close()
 
@@ -1,21 +1,23 @@
 import sys
+import os
 import argparse
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import psycopg2 as pg
-from psycopg2 import pool
 
+import urllib3
 from minio import Minio
 from minio.commonconfig import Tags
 
 from tqdm.auto import tqdm
-from tqdm.contrib.concurrent import thread_map
 
 sys.path.append('../../')
 import credentials as crd
 
-dbConnectionPool = None
+db = None
 storage = None
 logger = None
 
@@ -28,51 +30,117 @@ source_disk = {
 def uploadFile(item):
     file_id, disk, original_file_path, file_path, file_name, sample_rate, device_id, serial_number, temperature, duration, spec_class = item
 
-    db = dbConnectionPool.getconn()
+    metadata = { 'file_id': file_id }
+
+    tags = Tags(for_object=True)
+    tags['serial_number'] = str(serial_number)
+    tags['device_id'] = str(device_id)
+    tags['sample_rate'] = str(sample_rate)
+    tags['duration'] = str(duration)
+    if spec_class:
+        tags['class'] = spec_class
+
+    source = f'{source_disk[disk]}/{original_file_path}'
+    target = f'{file_path}{file_name}'
+
+    # upload file
+    return storage.fput_object(crd.minio.bucket, target, source,
+        content_type='audio/x-wav', metadata=metadata, tags=tags)
+
+def read_journal(path):
+    '''Read the state of all file_ids recorded in the journal, later entries win'''
+    states = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2: # ignore a partially written last line
+                    states[int(parts[0])] = parts[1]
+    return states
+
+def write_states(states):
+    '''Bulk update the state of the records in the dict `states` (file_id -> state)'''
+    uploaded = [file_id for file_id, state in states.items() if state == 'uploaded']
+    failed = [file_id for file_id, state in states.items() if state == 'upload_error']
     cursor = db.cursor()
-
     try:
-        metadata = { 'file_id': file_id }
-
-        tags = Tags(for_object=True)
-        tags['serial_number'] = str(serial_number)
-        tags['device_id'] = str(device_id)
-        tags['sample_rate'] = str(sample_rate)
-        tags['duration'] = str(duration)
-        if spec_class:
-            tags['class'] = spec_class
-
-        source = f'{source_disk[disk]}/{original_file_path}'
-        target = f'{file_path}{file_name}'
-
-        # upload file
-        result = storage.fput_object(crd.minio.bucket, target, source,
-            content_type='audio/x-wav', metadata=metadata, tags=tags)
         # update db: state = 'uploaded', action = null
-        query = '''UPDATE files SET action = null, state = 'uploaded', updated_at = now() WHERE file_id = %s'''
-        cursor.execute(query, (file_id,))
-        db.commit()
-        # report
-        logger.info(f'created {result.object_name}; file_id: {file_id}, etag: {result.etag}')
-    except KeyboardInterrupt:
-        cursor.close()
-        print('Interrupt requested, what to do now?')
-        # sys.exit(0)
-    except BaseException as exc:
+        query = '''UPDATE files SET action = null, state = 'uploaded', updated_at = now() WHERE file_id = ANY(%s)'''
+        cursor.execute(query, (uploaded,))
         # update db: state = 'upload_error'
-        query = '''UPDATE files SET state = 'upload_error', updated_at = now() WHERE file_id = %s'''
-        cursor.execute(query, (file_id,))
+        query = '''UPDATE files SET state = 'upload_error', updated_at = now() WHERE file_id = ANY(%s)'''
+        cursor.execute(query, (failed,))
         db.commit()
-        # report
-        logger.error(f"error occurred for file_id: {file_id}: {exc}")
+    except:
+        # the states are kept in the journal, the next batch can still be written
+        db.rollback()
+        raise
     finally:
         cursor.close()
-        dbConnectionPool.putconn(db)
+
+async def upload_all(fileset, journal, concurrency, flush_every):
+    '''
+    Upload files with up to `concurrency` uploads in flight.
+
+    Every finished upload is appended to the journal. Every `flush_every`
+    completions the journal is synced to disk and the states are written to the
+    database in bulk, the journal is the record of completed file_ids should
+    the process be interrupted before.
+    '''
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    upload_executor = ThreadPoolExecutor(concurrency) # minio is blocking, uploads run in threads
+    db_executor = ThreadPoolExecutor(1) # status updates are written one batch after the other
+    pending = {}
+    writes = []
+    progress = tqdm(total=len(fileset), ascii=True)
+
+    def flush():
+        journal.flush()
+        os.fsync(journal.fileno())
+        writes.append(loop.run_in_executor(db_executor, write_states, dict(pending)))
+        pending.clear()
+
+    async def upload(item):
+        file_id = item[0]
+        try:
+            result = await loop.run_in_executor(upload_executor, uploadFile, item)
+        except Exception as exc:
+            state = 'upload_error'
+            logger.error(f"error occurred for file_id: {file_id}: {exc}")
+        else:
+            state = 'uploaded'
+            logger.info(f'created {result.object_name}; file_id: {file_id}, etag: {result.etag}')
+        finally:
+            semaphore.release()
+        journal.write(f'{file_id}\t{state}\n')
+        pending[file_id] = state
+        progress.update(1)
+        if len(pending) >= flush_every:
+            flush()
+
+    # only create tasks for uploads about to start, the fileset can be large
+    tasks = set()
+    try:
+        for item in fileset:
+            await semaphore.acquire()
+            task = asyncio.create_task(upload(item))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+    finally:
+        flush()
+        await asyncio.gather(*writes)
+        progress.close()
+        upload_executor.shutdown(cancel_futures=True)
+        db_executor.shutdown()
 
 def main():
     parser = argparse.ArgumentParser(description='Upload audiofiles defined in DB to minIO')
     parser.add_argument('--disk', help='disk name selector for files in DB', required=True)
-    parser.add_argument('--threads', help='number of threads to spawn', default=4)
+    parser.add_argument('--concurrency', help='number of uploads in flight', type=int, default=128)
+    parser.add_argument('--flush_every', help='number of completed uploads per status update in DB', type=int, default=500)
+    parser.add_argument('--journal', help='journal of completed uploads (default: <disk>-upload.journal)')
     args = parser.parse_args()
 
     # file selection criteria
@@ -85,24 +153,23 @@ def main():
     '''
 
     # connect to DB
-    global dbConnectionPool
-    dbConnectionPool = pg.pool.ThreadedConnectionPool(
-        5, 20,
+    global db
+    db = pg.connect(
         host=crd.db.host,
         port=crd.db.port,
         database=crd.db.database,
         user=crd.db.user,
         password=crd.db.password
     )
-    if not dbConnectionPool:
-        raise Exception(f'Connection to DB failed (ConnectionPool).')
 
-    # connect to S3 storage
+    # connect to S3 storage, with one connection per upload in flight
     global storage
     storage = Minio(
         crd.minio.host,
         access_key=crd.minio.access_key,
         secret_key=crd.minio.secret_key,
+        http_client=urllib3.PoolManager(maxsize=args.concurrency,
+            retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]))
     )
     bucket_exists = storage.bucket_exists(crd.minio.bucket)
     if not bucket_exists:
@@ -117,18 +184,32 @@ def main():
     global logger
     logger = logging.getLogger()
 
-    db = dbConnectionPool.getconn()
+    # resume: write states of a previous, interrupted run to db (uploaded files
+    # are no longer selected), the journal then only records the current run
+    journalfile = args.journal if args.journal else f'{args.disk}-upload.journal'
+    journaled = read_journal(journalfile)
+    if len(journaled) > 0:
+        print(f'Resuming from {journalfile}: {len(journaled)} files recorded.')
+        write_states(journaled)
+
     cursor = db.cursor()
     cursor.execute(fileset_query, (args.disk,))
     fileset = cursor.fetchall()
     cursor.close()
-    dbConnectionPool.putconn(db)
 
     print(f'Starting for {len(fileset)} items.')
-    r = thread_map(uploadFile, fileset, max_workers=args.threads, ascii=True)
-
-    # close connections in pool
-    dbConnectionPool.closeall()
+    completed = False
+    with open(journalfile, 'w') as journal:
+        try:
+            asyncio.run(upload_all(fileset, journal, max(1, args.concurrency), max(1, args.flush_every)))
+            completed = True
+        except KeyboardInterrupt:
+            print('Interrupted, run again to resume.')
+    if completed:
+        # all states are committed, the journal of a finished run is not replayed
+        os.remove(journalfile)
+
+    db.close()
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,290 @@
+'''
+Metadata extraction for WAV files recorded by AudioMoth devices.
+
+The file is read once, sequentially, in large blocks: every block is fed to the
+SHA256 hash, and the RIFF header (chunks `fmt `, `LIST`/`INFO`/`ICMT`) is parsed
+from the leading blocks. This replaces hashing the file and then loading it a
+second time with `audio_metadata`, which doubles the I/O on USB HDDs.
+
+The comment (`ICMT`) written by the AudioMoth firmware is parsed with one
+precompiled grammar per firmware variant, see `firmware_formats`.
+'''
+
+import hashlib
+import os
+import re
+import struct
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+BS = 4194304 # 4 MiB, large sequential reads
+HEADER_LIMIT = 8388608 # 8 MiB, the chunks preceding `data` are buffered up to this size
+
+class UnsupportedFormat(Exception):
+    pass
+
+def read_wav(path, block_size=BS, header_limit=HEADER_LIMIT):
+    '''
+    Hash the file and parse its RIFF header in a single pass.
+
+    Returns a dict with the keys `sha256`, `filesize`, `audio_format`,
+    `bit_depth`, `channels`, `duration`, `sample_rate` and `comment` (the text
+    of the `ICMT` chunk, None if missing). Raises UnsupportedFormat if no
+    `data` chunk is found within the first `header_limit` bytes (truncated
+    file, corrupt chunk size).
+    '''
+    file_hash = hashlib.sha256()
+    header = bytearray()
+    meta = None
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        filesize = os.fstat(f.fileno()).st_size
+        n = f.readinto(buf)
+        while n > 0:
+            file_hash.update(view[:n])
+            if meta is None:
+                header += view[:n]
+                meta = parse_header(header)
+                if meta is None and len(header) >= header_limit:
+                    raise UnsupportedFormat(f'No data chunk within the first {header_limit} bytes')
+            n = f.readinto(buf)
+    view.release()
+    if meta is None:
+        meta = parse_header(header, complete=True)
+    meta['sha256'] = file_hash.hexdigest()
+    meta['filesize'] = filesize
+    return meta
+
+def parse_header(data, complete=False):
+    '''
+    Parse the RIFF chunks preceding the `data` chunk.
+
+    Returns None if `data` doesn't contain the full header yet, unless
+    `complete` is set, then UnsupportedFormat is raised.
+    '''
+    if len(data) < 12:
+        if complete:
+            raise UnsupportedFormat('File is too short for a RIFF header')
+        return None
+    riff, _, wave = struct.unpack_from('<4sI4s', data, 0)
+    if riff != b'RIFF' or wave != b'WAVE':
+        raise UnsupportedFormat('File is not a RIFF/WAVE file')
+
+    fmt = None
+    comment = None
+    pos = 12
+    while pos + 8 <= len(data):
+        chunk_id, chunk_size = struct.unpack_from('<4sI', data, pos)
+        body = pos + 8
+        if chunk_id == b'data':
+            if fmt is None:
+                raise UnsupportedFormat('Missing fmt chunk before data chunk')
+            audio_format, channels, sample_rate, byte_rate, block_align, bit_depth = fmt
+            return {
+                'audio_format': audio_format,
+                'bit_depth': bit_depth,
+                'channels': channels,
+                'duration': chunk_size / block_align / sample_rate,
+                'sample_rate': sample_rate,
+                'comment': comment
+            }
+        if body + chunk_size > len(data):
+            break # chunk incomplete, read more
+        if chunk_id == b'fmt ':
+            fmt = struct.unpack_from('<HHIIHH', data, body)
+        elif chunk_id == b'LIST' and data[body:body+4] == b'INFO':
+            comment = parse_info(data[body+4:body+chunk_size], comment)
+        pos = body + chunk_size + (chunk_size & 1) # chunks are word aligned
+
+    if complete:
+        raise UnsupportedFormat('Missing data chunk')
+    return None
+
+def parse_info(data, comment=None):
+    'Read the comment (`ICMT`) from the subchunks of a `LIST`/`INFO` chunk'
+    pos = 0
+    while pos + 8 <= len(data):
+        chunk_id, chunk_size = struct.unpack_from('<4sI', data, pos)
+        if chunk_id == b'ICMT':
+            text = bytes(data[pos+8:pos+8+chunk_size])
+            comment = text.split(b'\x00', 1)[0].decode('utf-8', 'replace')
+        pos += 8 + chunk_size + (chunk_size & 1)
+    return comment
+
+rec_nok_str = {
+    'microphone change': 'MICROPHONE_CHANGED',
+    'change of switch position': 'SWITCH_CHANGED',
+    'switch position change': 'SWITCH_CHANGED',
+    'low voltage': 'SUPPLY_VOLTAGE_LOW',
+    'magnetic switch': 'MAGNETIC_SWITCH',
+    'file size limit': 'FILE_SIZE_LIMITED'
+}
+
+# the recording status is appended when a recording ends prematurely,
+# the syntax differs between firmware versions
+# (see import_existing/test_rec_stat_parser.py):
+# - [old]     Recording cancelled before completion due to
+# - [...]     Recording stopped due to
+# - [current] Recording stopped
+REC_NOK = r'Recording (?:cancelled before completion|stopped) (?:by|due to) (?P<rec_nok>magnetic switch|microphone change|change of switch position|switch position change|low voltage|file size limit)\.'
+
+COMMENT_HEAD = (
+    r'Recorded at (?P<hour>\d\d):(?P<minute>\d\d):(?P<second>\d\d) (?P<day>\d\d)/(?P<month>\d\d)/(?P<year>\d{{4}}) '
+    r'\(UTC(?:(?P<tz_hours>[-+]\d+)(?::(?P<tz_minutes>\d\d))?)?\) '
+    r'by AudioMoth (?P<serial_number>[^ ]+)(?P<external> using external microphone)? '
+    r'at (?P<gain>[a-z-]+) {gain} while {battery} (?:less than |greater than )?(?P<battery>\d\.\d)V '
+    r'and temperature was (?P<temperature>-?\d+\.\d)C\.'
+)
+
+# optional sentences following the head, in any order
+COMMENT_TAIL = (
+    r'(?: Amplitude threshold was (?P<amp_thresh>[^ ]+) with (?P<amp_trig>[^ ]+)s minimum trigger duration\.'
+    r'| Band-pass filter with frequencies of (?P<bpf_low>\d+\.\d+)kHz and (?P<bpf_high>\d+\.\d+)kHz applied\.'
+    r'| Low-pass filter with frequency of (?P<lpf>\d+\.\d+)kHz applied\.'
+    r'| High-pass filter with frequency of (?P<hpf>\d+\.\d+)kHz applied\.'
+    r'| ' + REC_NOK + r')*\s*'
+)
+
+firmware_formats = {}
+'''AudioMoth comment grammars by firmware variant, detected in order of insertion'''
+
+# Recorded at 21:00:00 24/05/2021 (UTC+2) by AudioMoth 24E144085F256C1B at medium gain setting
+# while battery state was 4.2V and temperature was 17.3C.
+firmware_formats['legacy'] = {
+    'marker': ' gain setting while battery state was ',
+    'grammar': re.compile(COMMENT_HEAD.format(gain='gain setting', battery='battery state was') + COMMENT_TAIL)
+}
+
+# Recorded at 21:00:00 24/05/2021 (UTC+2) by AudioMoth 24E144085F256C1B at medium gain
+# while battery was 4.2V and temperature was 17.3C.
+firmware_formats['current'] = {
+    'marker': None,
+    'grammar': re.compile(COMMENT_HEAD.format(gain='gain', battery='battery was') + COMMENT_TAIL)
+}
+
+def detect_firmware(comment):
+    'Name of the entry in `firmware_formats` matching the comment'
+    for name, fmt in firmware_formats.items():
+        if fmt['marker'] is None or fmt['marker'] in comment:
+            return name
+
+def match_comment(comment):
+    'Match the comment against the grammar of its firmware variant, None if it does not match'
+    return firmware_formats[detect_firmware(comment)]['grammar'].fullmatch(comment)
+
+@lru_cache(maxsize=None)
+def utc_offset(hrs, mins):
+    return timezone(timedelta(hours=hrs, minutes=mins))
+
+def parse_comment(comment):
+    '''
+    Extract the recording metadata from an AudioMoth comment in one pass.
+
+    Comments not matching any of the grammars in `firmware_formats` are parsed
+    field by field with `parse_comment_fields`. Raises UnsupportedFormat if
+    the comment is missing (None) or not written by AudioMoth.
+    '''
+    if comment is None:
+        raise UnsupportedFormat('Missing comment (ICMT chunk)')
+    match = match_comment(comment)
+    if match is None:
+        return parse_comment_fields(comment)
+    m = match.groupdict()
+    info = {}
+
+    hrs = 0 if m['tz_hours'] is None else int(m['tz_hours'])
+    mins = 0 if m['tz_minutes'] is None else -int(m['tz_minutes']) if hrs < 0 else int(m['tz_minutes'])
+    info['time_start'] = datetime(int(m['year']), int(m['month']), int(m['day']),
+        int(m['hour']), int(m['minute']), int(m['second']), tzinfo=utc_offset(hrs, mins))
+
+    info['serial_number'] = m['serial_number']
+    info['source'] = 'internal' if m['external'] is None else 'external'
+    info['gain'] = m['gain']
+
+    if m['bpf_low'] is not None:
+        info['filter'] = f"BAND_PASS_FILTER {m['bpf_low']} {m['bpf_high']}"
+    elif m['lpf'] is not None:
+        info['filter'] = f"LOW_PASS_FILTER {m['lpf']}"
+    elif m['hpf'] is not None:
+        info['filter'] = f"HIGH_PASS_FILTER {m['hpf']}"
+    else:
+        info['filter'] = 'NO_FILTER'
+
+    info['amp_thresh'], info['amp_trig'] = m['amp_thresh'], m['amp_trig'] # None for postgres if missing
+    info['battery'] = m['battery']
+    info['temperature'] = m['temperature']
+    info['rec_end_status'] = 'RECORDING_OKAY' if m['rec_nok'] is None else rec_nok_str[m['rec_nok']]
+    return info
+
+field_patterns = {
+    'time': re.compile(r'(\d\d:\d\d:\d\d \d\d/\d\d/\d\d\d\d)'),
+    'tz': re.compile(r'\(UTC([-|+]\d+)?:?(\d\d)?\)'),
+    'serial_number': re.compile(r'by AudioMoth ([^ ]+)'),
+    'external': re.compile(r'using external microphone'),
+    'gain': re.compile(r'at ([a-z-]+) gain'),
+    'bpf': re.compile(r'Band-pass filter with frequencies of (\d+\.\d+)kHz and (\d+\.\d+)kHz applied\.'),
+    'lpf': re.compile(r'Low-pass filter with frequency of (\d+\.\d+)kHz applied\.'),
+    'hpf': re.compile(r'High-pass filter with frequency of (\d+\.\d+)kHz applied\.'),
+    'amp': re.compile(r'Amplitude threshold was ([^ ]+) with ([^ ]+)s minimum trigger duration\.'),
+    'battery': re.compile(r'(\d\.\d)V'),
+    'temperature': re.compile(r'(-?\d+\.\d)C'),
+    'rec_nok': re.compile(' ' + REC_NOK),
+}
+
+def parse_comment_fields(comment):
+    '''
+    Extract the recording metadata by searching for each field separately.
+
+    Tolerates unknown sentences and orderings, raises UnsupportedFormat if the
+    comment is None or a required field (time, timezone, serial number, gain,
+    battery, temperature) is missing.
+    '''
+    if comment is None:
+        raise UnsupportedFormat('Missing comment (ICMT chunk)')
+    required = {}
+    for field in ('time', 'tz', 'serial_number', 'gain', 'battery', 'temperature'):
+        required[field] = field_patterns[field].search(comment)
+        if required[field] is None:
+            raise UnsupportedFormat(f'Comment is not an AudioMoth comment, missing {field}')
+    info = {}
+
+    # Read the time and timezone from the header
+    ts = required['time'][1]
+    tz = required['tz']
+    hrs = 0 if tz[1] is None else int(tz[1])
+    mins = 0 if tz[2] is None else -int(tz[2]) if hrs < 0 else int(tz[2])
+    timestamp = datetime.strptime(ts, '%H:%M:%S %d/%m/%Y')
+    info['time_start'] = timestamp.replace(tzinfo=utc_offset(hrs, mins))
+
+    info['serial_number'] = required['serial_number'][1]
+    info['source'] = 'internal' if field_patterns['external'].search(comment) is None else 'external'
+    info['gain'] = required['gain'][1]
+
+    # - Band-pass filter with frequencies of 1.0kHz and 192.0kHz applied.
+    # LOW_PASS_FILTER x, BAND_PASS_FILTER x y, HIGH_PASS_FILTER x
+    bpf = field_patterns['bpf'].search(comment)
+    lpf = field_patterns['lpf'].search(comment)
+    hpf = field_patterns['hpf'].search(comment)
+    if bpf != None:
+        info['filter'] = f'BAND_PASS_FILTER {bpf[1]} {bpf[2]}'
+    elif lpf != None:
+        info['filter'] = f'LOW_PASS_FILTER {lpf[1]}'
+    elif hpf != None:
+        info['filter'] = f'HIGH_PASS_FILTER {hpf[1]}'
+    else:
+        info['filter'] = 'NO_FILTER'
+
+    amp_res = field_patterns['amp'].search(comment)
+    if amp_res != None:
+        info['amp_thresh'], info['amp_trig'] = amp_res.groups()
+    else:
+        info['amp_thresh'], info['amp_trig'] = None, None # for postgres
+
+    # Read the battery voltage and temperature from the header
+    info['battery'] = required['battery'][1]
+    info['temperature'] = required['temperature'][1]
+
+    rec_nok = field_patterns['rec_nok'].search(comment)
+    info['rec_end_status'] = 'RECORDING_OKAY' if rec_nok is None else rec_nok_str[rec_nok['rec_nok']]
+    return info
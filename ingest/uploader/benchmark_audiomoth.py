@@ -0,0 +1,134 @@
+'''
+Benchmark metadata extraction of AudioMoth WAV files
+
+`read`: Compares the two-pass approach (SHA256 over the file, then
+`audio_metadata.load`) to the single-pass `audiomoth.read_wav` and reports the
+throughput in MB/s.
+
+The second pass over a file is served from the page cache if it fits into
+memory, so either use a set of files larger than RAM or drop the caches between
+runs (`sync; echo 3 > /proc/sys/vm/drop_caches` on linux, `purge` on macOS).
+
+`parse`: Compares the field by field comment parser to the per-firmware grammars
+on a corpus of comments (text file with one comment per line, or a directory of
+WAV files of which only the headers are read) and reports comments/s and how
+many comments each grammar matched.
+'''
+
+import argparse
+import hashlib
+import os
+import time
+
+import audio_metadata
+
+import audiomoth
+
+BS = 65536
+
+def two_pass(path):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        fb = f.read(BS)
+        while len(fb) > 0:
+            file_hash.update(fb)
+            fb = f.read(BS)
+    meta = audio_metadata.load(path)
+    return file_hash.hexdigest(), meta.tags.comment[0]
+
+def single_pass(path):
+    meta = audiomoth.read_wav(path)
+    return meta['sha256'], meta['comment']
+
+def run(method, files):
+    size = 0
+    start = time.perf_counter()
+    for path in files:
+        method(path)
+        size += os.path.getsize(path)
+    elapsed = time.perf_counter() - start
+    return size / 1e6 / elapsed, elapsed
+
+def list_wav_files(path, limit=None):
+    files = []
+    for root, dirs, names in os.walk(path):
+        files.extend(os.path.join(root, n) for n in names if n.lower().endswith('.wav') and not n.startswith('.'))
+    files = sorted(files)[:limit]
+    if len(files) == 0:
+        raise SystemExit(f'no WAV files found in {path}')
+    return files
+
+def read_corpus(path, limit=None):
+    if os.path.isdir(path):
+        comments = []
+        for file in list_wav_files(path, limit):
+            with open(file, 'rb') as f:
+                meta = audiomoth.parse_header(f.read(65536), complete=True)
+            if meta['comment']:
+                comments.append(meta['comment'])
+        return comments
+    with open(path, 'r') as f:
+        return [line.rstrip('\n') for line in f if line.strip()][:limit]
+
+def benchmark_parse(args):
+    comments = read_corpus(args.path, args.limit)
+    if len(comments) == 0:
+        raise SystemExit(f'no comments found in {args.path}')
+
+    matched = {}
+    for comment in comments:
+        if audiomoth.parse_comment(comment) != audiomoth.parse_comment_fields(comment):
+            raise SystemExit(f'results differ for comment: {comment}')
+        firmware = audiomoth.detect_firmware(comment)
+        key = firmware if audiomoth.match_comment(comment) else f'{firmware} (fallback)'
+        matched[key] = matched.get(key, 0) + 1
+
+    print(f'parsing {len(comments)} comments, {args.repeat} times')
+    print('method', 'comments/s', 'seconds', sep='\t')
+    for name, method in (('fields', audiomoth.parse_comment_fields), ('grammar', audiomoth.parse_comment)):
+        start = time.perf_counter()
+        for i in range(args.repeat):
+            for comment in comments:
+                method(comment)
+        elapsed = time.perf_counter() - start
+        print(name, f'{len(comments) * args.repeat / elapsed:.0f}', f'{elapsed:.2f}', sep='\t')
+    print('---')
+    print('comments', 'firmware', sep='\t')
+    for key, count in sorted(matched.items()):
+        print(count, key, sep='\t')
+
+def benchmark_read(args):
+    files = list_wav_files(args.path, args.limit)
+
+    # make sure both methods agree before timing them
+    for path in files[:10]:
+        if two_pass(path) != single_pass(path):
+            raise SystemExit(f'results differ for {path}')
+
+    print(f'reading {len(files)} files, {sum(os.path.getsize(f) for f in files) / 1e6:.1f} MB')
+    print('method', 'MB/s', 'seconds', sep='\t')
+    for name, method in (('two-pass', two_pass), ('single-pass', single_pass)):
+        throughput, elapsed = run(method, files)
+        print(name, f'{throughput:.1f}', f'{elapsed:.2f}', sep='\t')
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark metadata extraction of AudioMoth WAV files')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p_read = subparsers.add_parser('read', help='compare two-pass and single-pass reading of WAV files')
+    p_read.add_argument('path', help='directory containing WAV files')
+    p_read.add_argument('--limit', type=int, help='maximum number of files to read')
+
+    p_parse = subparsers.add_parser('parse', help='compare comment parsers on a corpus')
+    p_parse.add_argument('path', help='text file with one comment per line, or directory containing WAV files')
+    p_parse.add_argument('--limit', type=int, help='maximum number of comments to read')
+    p_parse.add_argument('--repeat', type=int, default=100, help='number of passes over the corpus')
+
+    args = parser.parse_args()
+    if args.command == 'read':
+        benchmark_read(args)
+    else:
+        benchmark_parse(args)
+
+if __name__ == '__main__':
+    main()
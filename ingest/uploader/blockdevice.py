@@ -0,0 +1,85 @@
+'''
+Properties of the storage device files are read from.
+
+Reading many files concurrently from a rotational disk (HDD) makes the heads
+seek back and forth, which is a lot slower than reading the files one after
+the other in the order they are laid out on the disk. Solid state devices
+(SSD, most SD cards) don't care about the order and profit from reading
+concurrently.
+'''
+
+import os
+import plistlib
+import platform
+import struct
+import subprocess
+
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = '=QQIIII' # fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count, fm_reserved
+FIEMAP_EXTENT = '=QQQQQIIII' # fe_logical, fe_physical, fe_length, 2x fe_reserved64, fe_flags, 3x fe_reserved
+
+def mount_point(path):
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+def is_rotational(path):
+    '''
+    Check if `path` is stored on a rotational device.
+
+    Returns True or False, None if the device type can't be determined.
+    '''
+    system = platform.system()
+    try:
+        if system == 'Linux':
+            dev = os.stat(path).st_dev
+            sysfs = os.path.realpath(f'/sys/dev/block/{os.major(dev)}:{os.minor(dev)}')
+            # partitions don't have a queue, the disk they're on has
+            for device in (sysfs, os.path.dirname(sysfs)):
+                queue = os.path.join(device, 'queue', 'rotational')
+                if os.path.exists(queue):
+                    with open(queue, 'r') as f:
+                        return f.read().strip() == '1'
+        elif system == 'Darwin':
+            info = subprocess.run(['diskutil', 'info', '-plist', mount_point(path)],
+                capture_output=True, check=True).stdout
+            solid_state = plistlib.loads(info).get('SolidState')
+            if solid_state is not None:
+                return not solid_state
+    except (OSError, subprocess.SubprocessError, plistlib.InvalidFileException):
+        pass
+    return None
+
+def physical_offset(path):
+    '''
+    Offset of the first block of `path` on its device, None if unknown.
+    '''
+    import fcntl # linux only
+    request = struct.pack(FIEMAP_HEADER, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(struct.calcsize(FIEMAP_EXTENT))
+    try:
+        with open(path, 'rb') as f:
+            result = fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+    mapped_extents = struct.unpack_from(FIEMAP_HEADER, result)[3]
+    if mapped_extents == 0:
+        return None
+    return struct.unpack_from(FIEMAP_EXTENT, result, struct.calcsize(FIEMAP_HEADER))[1]
+
+def physical_order(paths):
+    '''
+    Sort `paths` by their location on disk.
+
+    Uses the offset of the first extent where the file system reports it
+    (FIEMAP, linux), otherwise the inode number, which follows the allocation
+    order on most file systems (and the directory entry order on FAT/exFAT).
+    '''
+    def key(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return (True, 0, True, 0, 0) # missing files last
+        offset = physical_offset(path) if platform.system() == 'Linux' else None
+        return (False, stat.st_dev, offset is None, offset or 0, stat.st_ino)
+    return sorted(paths, key=key)
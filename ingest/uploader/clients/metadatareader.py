@@ -1,35 +1,31 @@
 import os
 import re
-import hashlib
-import audio_metadata
 
-from datetime import datetime, timezone, timedelta
 from os.path import basename, dirname
+from time import monotonic
 
 import mimetypes
 from PyQt6.QtCore import QThread, pyqtSignal
 from concurrent.futures import ThreadPoolExecutor
+from psycopg2.extras import execute_values
 
 import credentials as crd
+import audiomoth
+import blockdevice
 
-BS = 65536
+BATCHSIZE = 1024 # number of files to check for duplicates per query
+CHECK_INTERVAL = 2 # seconds, maximum delay before a (partial) batch is checked for duplicates
+SIGNAL_INTERVAL = 0.2 # seconds between progress signals to the GUI
 
-rec_nok_str = {
-    'microphone change': 'MICROPHONE_CHANGED',
-    'change of switch position': 'SWITCH_CHANGED',
-    'switch position change': 'SWITCH_CHANGED',
-    'low voltage': 'SUPPLY_VOLTAGE_LOW',
-    'magnetic switch': 'MAGNETIC_SWITCH',
-    'file size limit': 'FILE_SIZE_LIMITED'
-}
 class MetaDataReader(QThread):
 
     indexChanged = pyqtSignal(int)
     countChanged = pyqtSignal(int, str)
     totalChanged = pyqtSignal(int)
+    rowsExtracted = pyqtSignal(list)
     extractFinished = pyqtSignal(list)
 
-    def __init__(self, dbConnectionPool, path, node_label, ssd=False):
+    def __init__(self, dbConnectionPool, path, node_label, ssd=None):
         QThread.__init__(self)
         self.dbConnectionPool = dbConnectionPool
         self.path = path
@@ -40,6 +36,7 @@ class MetaDataReader(QThread):
         audiofiles = []
         textfiles = []
         count = 0
+        signal_timer = monotonic()
         for root, dirs, files in os.walk(os.fspath(self.path)):
             for file in files:
                 filepath = os.path.abspath(os.path.join(root, file))
@@ -57,7 +54,9 @@ class MetaDataReader(QThread):
                     elif file_type[0] == 'audio/x-wav' or file_type[0] == 'audio/wav':
                         audiofiles.append(filepath)
                         count += 1
-                        self.indexChanged.emit(count)
+                        if monotonic() - signal_timer > SIGNAL_INTERVAL:
+                            self.indexChanged.emit(count)
+                            signal_timer = monotonic()
                     else:
                         raise Exception('File format not compatible', file, file_type[0])
                 except Exception as e:
@@ -66,25 +65,52 @@ class MetaDataReader(QThread):
                     else:
                         print(e)
         # signal main thread: count of files
+        self.indexChanged.emit(count)
         self.totalChanged.emit(len(audiofiles))
 
+        # random read is very slow on hdd, multithreading is actually worse:
+        # read the files one by one, in the order they are stored on disk
+        ssd = self.ssd
+        if ssd is None:
+            ssd = blockdevice.is_rotational(self.path) == False
+        if not ssd:
+            audiofiles = blockdevice.physical_order(audiofiles)
+
         db = self.dbConnectionPool.getconn()
         cursor = db.cursor()
         audiofiles_meta = []
+        batch = []
+        checks = []
         count = 0
 
-        # random read is very slow on hdd, multithreading is actually worse
-        # making checkDuplicate multithreaded would probably help a bit
-        with ThreadPoolExecutor(os.cpu_count() if self.ssd else 1) as executor:
+        check_timer = monotonic()
+        signal_timer = monotonic()
+
+        # the duplicate check of a batch runs while the next batch is read,
+        # checked batches are passed on to the GUI as they complete
+        with ThreadPoolExecutor(os.cpu_count() if ssd else 1) as executor, ThreadPoolExecutor(1) as db_executor:
             for meta in executor.map(self.extract_meta, audiofiles):
                 meta['node_label'] = self.node_label
                 meta['comment'] = None
-                meta['duplicate_check'] = self.checkDuplicate(cursor, meta) # TODO: inline
                 meta['row_state'] = -1 # for GUI: -1=no state, 0=OK, 1=error
                 meta['row_id'] = count # this is used to identify rows in GUI
                 count += 1
                 audiofiles_meta.append(meta)
-                self.countChanged.emit(count+1, meta['original_file_path'])
+                batch.append(meta)
+                if len(batch) == BATCHSIZE or monotonic() - check_timer > CHECK_INTERVAL:
+                    checks.append(db_executor.submit(self.checkBatch, cursor, batch))
+                    batch = []
+                    check_timer = monotonic()
+                while len(checks) > 0 and checks[0].done():
+                    self.rowsExtracted.emit(checks.pop(0).result())
+                if monotonic() - signal_timer > SIGNAL_INTERVAL:
+                    self.countChanged.emit(count, meta['original_file_path'])
+                    signal_timer = monotonic()
+            if len(batch) > 0:
+                checks.append(db_executor.submit(self.checkBatch, cursor, batch))
+            for check in checks:
+                self.rowsExtracted.emit(check.result()) # raises exceptions from the db thread
+            self.countChanged.emit(count, audiofiles_meta[-1]['original_file_path'] if count > 0 else '')
 
         cursor.close()
         self.dbConnectionPool.putconn(db)
@@ -108,132 +134,62 @@ class MetaDataReader(QThread):
         except Exception as e:
             raise ValueError(f'Can\'t read directory/file {arg}')
 
-    def checkDuplicate(self, cursor, item):
+    def checkBatch(self, cursor, items):
+        duplicates = self.checkDuplicates(cursor, items)
+        for item in items:
+            item['duplicate_check'] = duplicates.get(item['row_id'], (False, False))
+        return items
+
+    def checkDuplicates(self, cursor, items):
+        '''
+        Check a list of files for duplicate hashes and object name collisions in the database.
+
+        Returns a dict mapping `row_id` to (duplicate hash, path/file name collision),
+        files without any match are not contained.
+        '''
+        if len(items) == 0:
+            return {}
+        # match hashes and object names separately, so both joins can use an index
         query = '''
         WITH n AS (
-            SELECT %s as sha256,
-            %s||'/'||to_char(%s at time zone 'UTC', 'YYYY-mm-DD/HH24/') -- file_path (node_label, time_start)
-            || %s||'_'||to_char(%s at time zone 'UTC', 'YYYY-mm-DD"T"HH24-MI-SS"Z"')||%s -- file_name (node_label, time_start, extension)
+            SELECT row_id, sha256,
+            node_label||'/'||to_char(time_start at time zone 'UTC', 'YYYY-mm-DD/HH24/') -- file_path (node_label, time_start)
+            || node_label||'_'||to_char(time_start at time zone 'UTC', 'YYYY-mm-DD"T"HH24-MI-SS"Z"')||'.wav' -- file_name (node_label, time_start, extension)
             as object_name
+            FROM (VALUES %s) AS v (row_id, sha256, node_label, time_start)
+        ),
+        m AS (
+            SELECT n.row_id, true as hash_match, f.object_name = n.object_name as object_name_match
+            FROM n JOIN {schema}.files_audio f ON f.sha256 = n.sha256
+            UNION ALL
+            SELECT n.row_id, f.sha256 = n.sha256 as hash_match, true as object_name_match
+            FROM n JOIN {schema}.files_audio f ON f.object_name = n.object_name
         )
-        SELECT f.sha256 = n.sha256 as hash_match,
-            f.object_name = n.object_name as object_name_match
-        from {schema}.files_audio f, n
-        where (f.sha256 = n.sha256 or f.object_name = n.object_name)
+        SELECT row_id, bool_or(hash_match), bool_or(object_name_match)
+        FROM m GROUP BY row_id
         '''.format(schema=crd.db.schema)
-        cursor.execute(query, (item['sha256'], item['node_label'], item['time_start'], item['node_label'], item['time_start'], '.wav'))
-        result = cursor.fetchone()
-        if result is None:
-            result = (False, False)
-        return result # duplicate hash, path/file name collision
+        data = [(item['row_id'], item['sha256'], item['node_label'], item['time_start']) for item in items]
+        result = execute_values(cursor, query, data, template='(%s, %s, %s, %s::timestamptz)', page_size=len(data), fetch=True)
+        return {row_id: (hash_match, object_name_match) for row_id, hash_match, object_name_match in result}
 
     def extract_meta(self, path):
         info = {}
 
-        # create SHA256 hash
-        file_hash = hashlib.sha256()
-        with open(path, 'rb') as f:
-            fb = f.read(BS)
-            while len(fb) > 0:
-                file_hash.update(fb)
-                fb = f.read(BS)
-        info['sha256'] = file_hash.hexdigest()
-
+        # create SHA256 hash and read the RIFF header in one sequential pass
         # TODO: find sensible defaults if audiofile doesn't contain AudioMoth Data
-        meta = audio_metadata.load(path)
-        comment = meta.tags.comment[0]
+        meta = audiomoth.read_wav(path)
+        comment = meta['comment']
 
+        info['sha256'] = meta['sha256']
         info['original_file_path'] = path
-        info['filesize'] = meta.filesize
-        info['audio_format'] = meta.streaminfo.audio_format
-        info['bit_depth'] = meta.streaminfo.bit_depth
-        info['channels'] = meta.streaminfo.channels
-        info['duration'] = meta.streaminfo.duration
-        info['sample_rate'] = meta.streaminfo.sample_rate
-
-        if 'text' in comment:
-            comment = comment['text']
-        # Read the time and timezone from the header
-        ts = re.search(r"(\d\d:\d\d:\d\d \d\d/\d\d/\d\d\d\d)", comment)[1]
-        tz = re.search(r"\(UTC([-|+]\d+)?:?(\d\d)?\)", comment)
-        hrs = 0 if tz[1] is None else int(tz[1])
-        mins = 0 if tz[2] is None else -int(tz[2]) if hrs < 0 else int(tz[2])
-
-        info['serial_number'] = re.search(r"by AudioMoth ([^ ]+)", comment)[1]
-
-        extmic = re.search(r'using external microphone', comment)
-        if extmic != None:
-            info['source'] = 'external'
-        else:
-            info['source'] = 'internal'
-
-        info['gain'] = re.search(r"at ([a-z-]+) gain", comment)[1]
-
-        # - Band-pass filter with frequencies of 1.0kHz and 192.0kHz applied.
-        # LOW_PASS_FILTER x, BAND_PASS_FILTER x y, HIGH_PASS_FILTER x
-        bpf = re.search(r"Band-pass filter with frequencies of (\d+\.\d+)kHz and (\d+\.\d+)kHz applied\.", comment)
-        lpf = re.search(r"Low-pass filter with frequency of (\d+\.\d+)kHz applied\.", comment)
-        hpf = re.search(r"High-pass filter with frequency of (\d+\.\d+)kHz applied\.", comment)
-
-        if bpf != None:
-            info['filter'] = f'BAND_PASS_FILTER {bpf[1]} {bpf[2]}'
-        elif lpf != None:
-            info['filter'] = f'LOW_PASS_FILTER {lpf[1]}'
-        elif hpf != None:
-            info['filter'] = f'HIGH_PASS_FILTER {hpf[1]}'
-        else:
-            info['filter'] = 'NO_FILTER'
-
-        timestamp = datetime.strptime(ts, "%H:%M:%S %d/%m/%Y")
-        info['time_start'] = timestamp.replace(tzinfo=timezone(timedelta(hours=hrs, minutes=mins)))
-
-        amp_res = re.search(r'Amplitude threshold was ([^ ]+) with ([^ ]+)s minimum trigger duration\.', comment)
-        if amp_res != None:
-            info['amp_thresh'], info['amp_trig'] = amp_res.groups()
-        else:
-            info['amp_thresh'], info['amp_trig'] = None, None # for postgres
-
-        # Read the battery voltage and temperature from the header
-        info['battery'] = re.search(r"(\d\.\d)V", comment)[1]
-        info['temperature'] = re.search(r"(-?\d+\.\d)C", comment)[1]
-
-        # read the remaining comment:
-        #
-        # !RECORDING_OKAY and ever only one more condition
-        #
-        # the AM recordings contain comments from several firmware versions!
-        # the syntax differs (see test.py for unit tests of the expression):
-        # - [old]     Recording cancelled before completion due to
-        # - [...]     Recording stopped due to
-        # - [current] Recording stopped
-        #
-        # MICROPHONE_CHANGED
-        # - microphone change.
-        # - due to microphone change.
-        #
-        # SWITCH_CHANGED
-        # - change of switch position.
-        # - switch position change.
-        # - due to switch position change.
-        #
-        # MAGNETIC_SWITCH
-        # - by magnetic switch.
-        #
-        # SUPPLY_VOLTAGE_LOW
-        # - low voltage.
-        # - due to low voltage.
-        #
-        # FILE_SIZE_LIMITED
-        # - file size limit.
-        # - due to file size limit.
-        #
-        # - Recording stopped due to switch position change.
-        # - Recording cancelled before completion due to low voltage.
-        #
-        rec_nok = re.search(r" Recording (?:cancelled before completion|stopped) (?:by|due to) (magnetic switch|microphone change|change of switch position|switch position change|low voltage|file size limit)\.", comment)
-        if rec_nok != None:
-            info['rec_end_status'] = rec_nok_str[rec_nok[1]]
-        else:
-            info['rec_end_status'] = 'RECORDING_OKAY'
+        info['filesize'] = meta['filesize']
+        info['audio_format'] = meta['audio_format']
+        info['bit_depth'] = meta['bit_depth']
+        info['channels'] = meta['channels']
+        info['duration'] = meta['duration']
+        info['sample_rate'] = meta['sample_rate']
+
+        # parse the AudioMoth comment (time, timezone, device settings, recording status)
+        info.update(audiomoth.parse_comment(comment))
 
         return info
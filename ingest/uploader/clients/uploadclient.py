@@ -1,8 +1,10 @@
 from PyQt6.QtCore import QThread, pyqtSignal
 import os
+from time import monotonic
 
 import psycopg2 as pg
 from psycopg2 import pool
+from psycopg2.extras import execute_values
 
 from minio import Minio
 from minio.commonconfig import Tags
@@ -11,14 +13,18 @@ from concurrent.futures import ThreadPoolExecutor
 
 import credentials as crd
 
+BATCHSIZE = 128 # number of files to register / confirm per transaction
+SIGNAL_INTERVAL = 0.2 # seconds between progress signals to the GUI
+
 class UploadClient(QThread):
 
-    countChanged = pyqtSignal(int, int, str)
+    countChanged = pyqtSignal(int, list) # count, [(row_id, error), ...]
     uploadFinished = pyqtSignal(int)
 
-    def __init__(self, dbConnectionPool, fileset):
+    def __init__(self, dbConnectionPool, deploymentIndex, fileset):
         QThread.__init__(self)
         self.dbConnectionPool = dbConnectionPool
+        self.deploymentIndex = deploymentIndex
         self.fileset = fileset
 
     def run(self):
@@ -34,107 +40,10 @@ class UploadClient(QThread):
             print(f'Bucket {crd.minio.bucket} does not exist.')
             # logger.error(f'Bucket {crd.minio.bucket} does not exist.')
             self.uploadFinished.emit(count)
+            return
 
-        def upload_worker(item):
-
-            db = self.dbConnectionPool.getconn()
-            cursor = db.cursor()
-
-            # 1. insert record into db
-            # 2. get file_id and object_name from insert
-            file_id  = None
-            object_name  = None
-            # 3. upload
-            error = None
-            # 4. confirm in db
-
-            try:
-                query = '''
-                INSERT INTO {schema}.files_audio (
-                    object_name,
-                    sha256,
-                    time,
-                    file_size,
-                    format,
-                    sample_rate,
-                    bit_depth,
-                    channels,
-                    deployment_id,
-                    serial_number,
-                    battery,
-                    temperature,
-                    duration,
-                    gain,
-                    filter,
-                    source,
-                    rec_end_status,
-                    comment,
-                    created_at,
-                    updated_at)
-                VALUES (
-                    %s||'/'||to_char(%s at time zone 'UTC', 'YYYY-mm-DD/HH24/') -- file_path (node_label, timestamp)
-                    || %s||'_'||to_char(%s at time zone 'UTC', 'YYYY-mm-DD"T"HH24-MI-SS"Z"')||%s, -- file_name (node_label, timestamp, extension)
-                    %s, -- sha256
-                    %s, -- time
-                    %s, -- file_size
-                    %s, -- format
-                    %s, -- sample_rate
-                    %s, -- bit_depth
-                    %s, -- channels
-                    (SELECT deployment_id from {schema}.deployments where node_id = (SELECT node_id from {schema}.nodes WHERE node_label = %s) and (%s at time zone 'UTC')::timestamptz <@ period), -- deployment_id
-                    %s, -- serial_number
-                    %s, -- battery
-                    %s, -- temperature
-                    %s, -- duration
-                    %s, -- gain
-                    %s, -- filter
-                    %s, -- source,
-                    %s, -- rec_end_status
-                    %s, -- comment
-                    CURRENT_TIMESTAMP, -- created_at
-                    CURRENT_TIMESTAMP) -- updated_at
-                RETURNING file_id, object_name
-                '''.format(schema=crd.db.schema)
-
-                cursor.execute(query, (
-                    item['node_label'], item['time_start'],
-                    item['node_label'], item['time_start'], '.wav',
-                    item['sha256'],
-                    item['time_start'],
-                    item['filesize'],
-                    item['audio_format'],
-                    item['sample_rate'],
-                    item['bit_depth'],
-                    item['channels'],
-                    item['node_label'],
-                    item['time_start'],
-                    item['serial_number'],
-                    item['battery'],
-                    item['temperature'],
-                    item['duration'],
-                    item['gain'],
-                    item['filter'],
-                    item['source'],
-                    item['rec_end_status'],
-                    item['comment']
-                ))
-                db.commit()
-                file_id, object_name = cursor.fetchone()
-            except Exception as e:
-                error = 'database error'
-                msg = 'Error occurred while inserting record for file {}: {}'
-                if isinstance(e, pg.Error):
-                    if e.diag.column_name == 'deployment_id':
-                        msg += ' -> node deployment missing.'
-                        error = 'deployment missing'
-                    print(msg.format(item['original_file_path'], e.diag.message_primary))
-                else:
-                    print(msg.format(item['original_file_path'], e))
-                # logger.error(f"error occurred for file_id: {file_id}: {exc}")
-                db.rollback()
-                self.dbConnectionPool.putconn(db)
-                return item['row_id'], error
-
+        def upload_worker(record):
+            item, file_id, object_name = record
             try:
                 metadata = { 'file_id': file_id }
 
@@ -149,28 +58,154 @@ class UploadClient(QThread):
                 # upload file
                 result = storage.fput_object(crd.minio.bucket, object_name, source,
                     content_type='audio/x-wav', metadata=metadata, tags=tags)
-                # set upload timestamp
-                query = 'UPDATE {schema}.files_audio SET updated_at = CURRENT_TIMESTAMP WHERE file_id = %s'.format(schema=crd.db.schema)
-                cursor.execute(query, (file_id,))
-                db.commit()
                 # report
                 # logger.info(f'created {result.object_name}; file_id: {file_id}, etag: {result.etag}')
             except Exception as exc:
-                # delete record from db
-                query = 'DELETE FROM {schema}.files_audio WHERE file_id = %s'.format(schema=crd.db.schema)
-                cursor.execute(query, (file_id,))
-                db.commit()
-                error = 'upload error'
                 # report
                 # logger.error(f"error occurred for file_id: {file_id}: {exc}")
-            finally:
-                cursor.close()
-                self.dbConnectionPool.putconn(db)
-                return item['row_id'], error
+                return item['row_id'], file_id, 'upload error'
+            return item['row_id'], file_id, None
+
+        db = self.dbConnectionPool.getconn()
+        cursor = db.cursor()
+
+        # the node label is the same for all files of a card, load its deployments once
+        self.deploymentIndex.load({item['node_label'] for item in self.fileset})
 
+        # 1. insert records of a batch into db, get file_id and object_name
+        # 2. upload
+        # 3. confirm uploaded / delete failed records in db
         with ThreadPoolExecutor(CPU_THREADS) as executor:
-            count = 0
-            for row_id, error in executor.map(upload_worker, self.fileset):
-                count += 1
-                self.countChanged.emit(count, row_id, error)
-            self.uploadFinished.emit(count)
+            signal_timer = monotonic()
+            for i in range(0, len(self.fileset), BATCHSIZE):
+                batch = self.fileset[i:i + BATCHSIZE]
+                results = []
+                insert = []
+                for item in batch:
+                    item['deployment_id'] = self.deploymentIndex.lookup(item['node_label'], item['time_start'])
+                    if item['deployment_id'] is None:
+                        print(f"Error occurred while inserting record for file {item['original_file_path']}: -> node deployment missing.")
+                        results.append((item['row_id'], 'deployment missing'))
+                    else:
+                        insert.append(item)
+                registered = self.insertRecords(db, cursor, insert, results)
+
+                uploaded = []
+                failed = []
+                for row_id, file_id, error in executor.map(upload_worker, registered):
+                    results.append((row_id, error))
+                    if error is None:
+                        uploaded.append(file_id)
+                    else:
+                        failed.append(file_id)
+                    if monotonic() - signal_timer > SIGNAL_INTERVAL:
+                        self.countChanged.emit(count + len(results), [])
+                        signal_timer = monotonic()
+
+                # set upload timestamp, delete records of failed uploads
+                query = 'UPDATE {schema}.files_audio SET updated_at = CURRENT_TIMESTAMP WHERE file_id = ANY(%s)'.format(schema=crd.db.schema)
+                cursor.execute(query, (uploaded,))
+                query = 'DELETE FROM {schema}.files_audio WHERE file_id = ANY(%s)'.format(schema=crd.db.schema)
+                cursor.execute(query, (failed,))
+                db.commit()
+
+                count += len(results)
+                self.countChanged.emit(count, results)
+                signal_timer = monotonic()
+
+        cursor.close()
+        self.dbConnectionPool.putconn(db)
+        self.uploadFinished.emit(count)
+
+    def insertRecords(self, db, cursor, items, results):
+        '''
+        Insert the records of `items` in one transaction.
+
+        Returns a list of (item, file_id, object_name) of the inserted records,
+        files that failed are appended to `results` as (row_id, error). If the
+        transaction fails, the records are inserted one by one to find the
+        offending files.
+        '''
+        if len(items) == 0:
+            return []
+        query = '''
+        INSERT INTO {schema}.files_audio (
+            object_name,
+            sha256,
+            time,
+            file_size,
+            format,
+            sample_rate,
+            bit_depth,
+            channels,
+            deployment_id,
+            serial_number,
+            battery,
+            temperature,
+            duration,
+            gain,
+            filter,
+            source,
+            rec_end_status,
+            comment,
+            created_at,
+            updated_at)
+        VALUES %s
+        ON CONFLICT (sha256) DO NOTHING
+        RETURNING file_id, object_name, sha256
+        '''.format(schema=crd.db.schema)
+        template = '''(
+            %(node_label)s||'/'||to_char(%(time_start)s at time zone 'UTC', 'YYYY-mm-DD/HH24/') -- file_path (node_label, timestamp)
+            || %(node_label)s||'_'||to_char(%(time_start)s at time zone 'UTC', 'YYYY-mm-DD"T"HH24-MI-SS"Z"')||'.wav', -- file_name (node_label, timestamp, extension)
+            %(sha256)s,
+            %(time_start)s,
+            %(filesize)s,
+            %(audio_format)s,
+            %(sample_rate)s,
+            %(bit_depth)s,
+            %(channels)s,
+            %(deployment_id)s,
+            %(serial_number)s,
+            %(battery)s,
+            %(temperature)s,
+            %(duration)s,
+            %(gain)s,
+            %(filter)s,
+            %(source)s,
+            %(rec_end_status)s,
+            %(comment)s,
+            CURRENT_TIMESTAMP, -- created_at
+            CURRENT_TIMESTAMP) -- updated_at
+        '''
+        try:
+            records = execute_values(cursor, query, items, template=template, page_size=len(items), fetch=True)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            if len(items) > 1:
+                registered = []
+                for item in items:
+                    registered.extend(self.insertRecords(db, cursor, [item], results))
+                return registered
+            error = 'database error'
+            msg = 'Error occurred while inserting record for file {}: {}'
+            if isinstance(e, pg.Error):
+                print(msg.format(items[0]['original_file_path'], e.diag.message_primary))
+            else:
+                print(msg.format(items[0]['original_file_path'], e))
+            # logger.error(f"error occurred for file_id: {file_id}: {exc}")
+            results.append((items[0]['row_id'], error))
+            return []
+
+        # records of files already registered (same sha256) are skipped, other
+        # conflicts (object_name) fail the batch and are reported by the retry
+        file_ids = {sha256: (file_id, object_name) for file_id, object_name, sha256 in records}
+        registered = []
+        for item in items:
+            if item['sha256'] in file_ids:
+                file_id, object_name = file_ids.pop(item['sha256'])
+                registered.append((item, file_id, object_name))
+            else:
+                print(f"Error occurred while inserting record for file {item['original_file_path']}: duplicate")
+                results.append((item['row_id'], 'duplicate'))
+        return registered
@@ -0,0 +1,83 @@
+'''
+In-memory index of node deployments.
+
+Resolving the deployment of a file (node label and timestamp) used to take one
+query per file. The index loads all deployments of the involved nodes at once
+and keeps their periods sorted by start time per node, so resolving a file is
+a bisection in memory.
+
+Entries older than `max_age` seconds are reloaded on the next lookup, call
+`invalidate` after deployments have been changed.
+'''
+
+import threading
+from bisect import bisect_right
+from datetime import datetime, timezone
+from time import monotonic
+
+import credentials as crd
+
+MIN_TIME = datetime.min.replace(tzinfo=timezone.utc) # start of periods with an unbounded lower end
+
+class DeploymentIndex:
+
+    def __init__(self, dbConnectionPool, max_age=300):
+        self.dbConnectionPool = dbConnectionPool
+        self.max_age = max_age
+        self.nodes = {} # node_label -> (loaded at, [start of period, ...], [(period, deployment_id), ...])
+        self.lock = threading.Lock()
+
+    def load(self, node_labels):
+        '''
+        Load the deployments of all nodes in `node_labels` that are not loaded yet, or expired.
+
+        Returns a dict mapping node label to its index entry.
+        '''
+        node_labels = set(node_labels)
+        now = monotonic()
+        with self.lock:
+            missing = [n for n in node_labels if n not in self.nodes or now - self.nodes[n][0] > self.max_age]
+            if len(missing) == 0:
+                return {n: self.nodes[n] for n in node_labels}
+            query = '''
+            SELECT n.node_label, d.deployment_id, d.period
+            FROM {schema}.deployments d
+            JOIN {schema}.nodes n ON d.node_id = n.node_id
+            WHERE n.node_label = ANY(%s)
+            '''.format(schema=crd.db.schema)
+            db = self.dbConnectionPool.getconn()
+            try:
+                cursor = db.cursor()
+                cursor.execute(query, (missing,))
+                records = cursor.fetchall()
+                cursor.close()
+                db.rollback() # end the read-only transaction
+            finally:
+                self.dbConnectionPool.putconn(db)
+            periods = {node_label: [] for node_label in missing}
+            for node_label, deployment_id, period in records:
+                periods[node_label].append((period, deployment_id))
+            for node_label, entries in periods.items():
+                entries.sort(key=lambda e: MIN_TIME if e[0].lower is None else e[0].lower)
+                starts = [MIN_TIME if period.lower is None else period.lower for period, deployment_id in entries]
+                self.nodes[node_label] = (now, starts, entries)
+            return {n: self.nodes[n] for n in node_labels}
+
+    def invalidate(self, node_label=None):
+        '''Drop the deployments of `node_label`, or of all nodes'''
+        with self.lock:
+            if node_label is None:
+                self.nodes.clear()
+            else:
+                self.nodes.pop(node_label, None)
+
+    def lookup(self, node_label, timestamp):
+        '''Return the id of the deployment of `node_label` covering `timestamp`, None if there is none'''
+        loaded_at, starts, entries = self.load([node_label])[node_label]
+        i = bisect_right(starts, timestamp)
+        # periods don't overlap: the candidate is the last period starting before timestamp,
+        # or the one before if timestamp is its exclusive lower bound
+        for period, deployment_id in reversed(entries[max(0, i - 2):i]):
+            if timestamp in period:
+                return deployment_id
+        return None
@@ -7,11 +7,36 @@ class CustomTableModel(QAbstractTableModel):
         self.row_count = 0
         self.column_count = 8
         self.files = []
+        self.rows = [] # display strings and background color per file, see display_row
+        self.row_index = {} # row_id -> row
 
     def load_data(self, data):
-        self.removeRows(0, len(self.files))
-        self.files = data
-        self.insertRows(0, len(self.files))
+        self.beginResetModel()
+        self.files = []
+        self.rows = []
+        self.row_index = {}
+        self.endResetModel()
+        self.append_data(data)
+
+    def append_data(self, data):
+        if len(data) == 0:
+            return
+        first = len(self.files)
+        self.beginInsertRows(QModelIndex(), first, first + len(data) - 1)
+        for item in data:
+            self.row_index[item['row_id']] = len(self.files)
+            self.files.append(item)
+            self.rows.append(self.display_row(item))
+        self.endInsertRows()
+
+    def update_rows(self, row_ids):
+        '''Recompute the display values of files that have changed'''
+        rows = [self.row_index[row_id] for row_id in row_ids if row_id in self.row_index]
+        if len(rows) == 0:
+            return
+        for row in rows:
+            self.rows[row] = self.display_row(self.files[row])
+        self.dataChanged.emit(self.index(min(rows), 0), self.index(max(rows), self.column_count - 1))
 
     def rowCount(self, parent):
         return parent.isValid() if 0 else len(self.files)
@@ -27,66 +52,56 @@ class CustomTableModel(QAbstractTableModel):
         else:
             return f"{section}"
 
-    def insertRows(self, row, count, parent=QModelIndex()):
-        self.beginInsertRows(parent, row, count-1)
-        self.endInsertRows()
-        return True
-
-    def removeRows(self, row, count, parent=QModelIndex()):
-        self.beginRemoveRows(parent, row, count-1)
-        self.endRemoveRows()
-        return True
+    def display_row(self, data):
+        if 'error' in data:
+            action = f"check: {data['error']}"
+        elif data['duplicate_check'][0] or data['duplicate_check'][1]:
+            state = []
+            if data['duplicate_check'][0]:
+                state.append('duplicate')
+            if data['duplicate_check'][1]:
+                state.append('name collision')
+            action = f"skip ({', '.join(state)})"
+        else:
+            action = 'upload'
+        columns = (
+            action,
+            str(data['time_start']),
+            '{:02d}:{:02d}'.format(int(data['duration'] // 60), int(data['duration'] % 60)),
+            f"{data['filesize'] / (1024**2):.2f} MiB",
+            str(data['sample_rate']),
+            str(data['rec_end_status']),
+            '' if data['comment'] == None else str(data['comment']),
+            str(data['original_file_path']),
+        )
+        background = None
+        if data['row_state'] == 1:
+            background = QColor(Qt.GlobalColor.darkGreen)
+        elif data['duplicate_check'][0] or data['duplicate_check'][1] or data['row_state'] == 0:
+            background = QColor(Qt.GlobalColor.darkRed)
+        return columns, background
 
     def data(self, index, role=Qt.ItemDataRole.DisplayRole):
-        column = index.column()
-        row = index.row()
-        data = self.files[row]
-        if role == Qt.ItemDataRole.DisplayRole or role == Qt.EditRole:
-            if column == 0:
-                if 'error' in data:
-                    return f"check: {data['error']}"
-                if data['duplicate_check'][0] or data['duplicate_check'][1]:
-                    state = []
-                    if data['duplicate_check'][0]:
-                        state.append('duplicate')
-                    if data['duplicate_check'][1]:
-                        state.append('name collision')
-                    return f"skip ({', '.join(state)})"
-                else:
-                    return 'upload'
-            elif column == 1:
-                return str(data['time_start'])
-            elif column == 2:
-                duration = '{:02d}:{:02d}'.format(int(data['duration'] // 60), int(data['duration'] % 60))
-                return duration
-            elif column == 3:
-                filesize = data['filesize'] / (1024**2)
-                return f'{filesize:.2f} MiB'
-            elif column == 4:
-                return str(data['sample_rate'])
-            elif column == 5:
-                return str(data['rec_end_status'])
-            elif column == 6:
-                return '' if data['comment'] == None else str(data['comment'])
-            elif column == 7:
-                return str(data['original_file_path'])
-        elif role == Qt.BackgroundRole:
-            if data['row_state'] == 1:
-                return QColor(Qt.darkGreen)
-            if data['duplicate_check'][0] or data['duplicate_check'][1] or data['row_state'] == 0:
-                return QColor(Qt.darkRed)
+        columns, background = self.rows[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole or role == Qt.ItemDataRole.EditRole:
+            return columns[index.column()]
+        elif role == Qt.ItemDataRole.BackgroundRole:
+            return background
         # elif role == Qt.TextAlignmentRole:
         #     return Qt.AlignLeft
         return None
 
     def setData(self, index, value, role):
-        if role == Qt.EditRole:
+        if role == Qt.ItemDataRole.EditRole:
             self.files[index.row()]['comment'] = value if value != '' else None
+            self.rows[index.row()] = self.display_row(self.files[index.row()])
+            self.dataChanged.emit(index, index)
             return True
+        return False
 
     def flags(self, index):
         column = index.column()
         if column == 6:
-            return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+            return Qt.ItemFlag.ItemIsEnabled | Qt.ItemFlag.ItemIsSelectable | Qt.ItemFlag.ItemIsEditable
         else:
-            return Qt.ItemIsEnabled | Qt.ItemIsSelectable
+            return Qt.ItemFlag.ItemIsEnabled | Qt.ItemFlag.ItemIsSelectable
@@ -5,13 +5,13 @@ from PyQt6.QtWidgets import (QHBoxLayout, QComboBox, QDialogButtonBox,
     QPushButton, QHeaderView, QSizePolicy, QTableView, QWidget)
 
 import re
-from time import time
 from datetime import timedelta
 import psycopg2 as pg
 from psycopg2 import pool
 
 import credentials as crd
 from clients import MetaDataReader, UploadClient
+from deployments import DeploymentIndex
 from . import CustomTableModel
 
 node_labels = [
@@ -37,9 +37,10 @@ class Widget(QWidget):
         QWidget.__init__(self)
 
         self.dbPool = None
+        self.deploymentIndex = None
         self.source = ''
         self.node_label = '0000-0000'
-        self.redraw_timer = time()
+        self.to_upload = {} # row_id -> file
 
         # Getting the Model
         self.model = CustomTableModel()
@@ -51,8 +52,10 @@ class Widget(QWidget):
         # QTableView Headers
         self.horizontal_header = self.table_view.horizontalHeader()
         self.vertical_header = self.table_view.verticalHeader()
-        self.horizontal_header.setSectionResizeMode(QHeaderView.ResizeMode.ResizeToContents)
-        self.vertical_header.setSectionResizeMode(QHeaderView.ResizeMode.ResizeToContents)
+        # measuring every row on every change is too slow for large imports,
+        # columns are resized to contents once the import is finished
+        self.horizontal_header.setSectionResizeMode(QHeaderView.ResizeMode.Interactive)
+        self.vertical_header.setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
         self.horizontal_header.setStretchLastSection(True)
 
         # QWidget Layout
@@ -126,10 +129,10 @@ class Widget(QWidget):
         self.source = '' # clear the selected source
         self.statusLabel.setText(f'Built file list of {len(audiofiles)} audiofiles')
 
-        self.model.load_data(audiofiles)
+        # rows have been added to the model while extracting (onRowsExtracted)
         self.table_view.resizeColumnsToContents()
 
-        self.to_upload = [af for af in audiofiles if af['duplicate_check'][0] == False and af['duplicate_check'][1] == False]
+        self.to_upload = {af['row_id']: af for af in audiofiles if af['duplicate_check'][0] == False and af['duplicate_check'][1] == False}
         if len(self.to_upload) > 0:
             self.uploadButton.setEnabled(True)
             self.statusLabel.setText(f'Metadata imported. Next, check if everything is fine and upload the files.')
@@ -137,27 +140,26 @@ class Widget(QWidget):
             self.uploadButton.setEnabled(False)
             self.statusLabel.setText(f'No valid audiofiles found. Maybe try another folder?')
 
+    def onRowsExtracted(self, audiofiles):
+        self.model.append_data(audiofiles)
+
     def onIndexIteration(self, count):
         self.statusLabel.setText(f'Indexing paths: {count}')
 
-    def onUploadIteration(self, count, row_id, error):
+    def onUploadIteration(self, count, results):
         # setting value to progress bar
         self.pbar.setValue(count)
-        for r in self.to_upload:
-            if r['row_id'] == row_id:
-                if error == '': # pyqtSignal coerces None to ''
-                    r['row_state'] = 1
-                else:
-                    r['error'] = error
-                    r['row_state'] = 0
-                break
+        for row_id, error in results:
+            r = self.to_upload[row_id]
+            if error is None:
+                r['row_state'] = 1
+            else:
+                r['error'] = error
+                r['row_state'] = 0
         # update the table
-        if (time() - self.redraw_timer) > (max(1, min(60, self.pbar.maximum() / 1000))):
-            self.model.layoutChanged.emit()
-            self.redraw_timer = time()
+        self.model.update_rows([row_id for row_id, error in results])
 
     def onUploadFinished(self, count):
-        self.model.layoutChanged.emit()
         self.statusLabel.setText(f'Upload finished: {count}')
 
     def browseForSource(self):
@@ -173,10 +175,12 @@ class Widget(QWidget):
             return # browse was cancelled
 
         self.pbar.setValue(0)
+        self.model.load_data([])
         self.metareader = MetaDataReader(self.dbPool, self.source, self.node_label)
         self.metareader.indexChanged.connect(self.onIndexIteration)
         self.metareader.totalChanged.connect(lambda total: self.pbar.setMaximum(total))
         self.metareader.countChanged.connect(self.onExtractIteration)
+        self.metareader.rowsExtracted.connect(self.onRowsExtracted)
         self.metareader.extractFinished.connect(self.onExtractFinished)
         self.metareader.start()
         self.statusLabel.setText(f'Importing metadata...')
@@ -189,7 +193,7 @@ class Widget(QWidget):
         self.pbar.setMaximum(len(self.to_upload))
         self.pbar.setValue(0)
         self.statusLabel.setText(f'Uploading audiofiles...')
-        self.uploader = UploadClient(self.dbPool, self.to_upload)
+        self.uploader = UploadClient(self.dbPool, self.deploymentIndex, list(self.to_upload.values()))
         self.uploader.countChanged.connect(self.onUploadIteration)
         self.uploader.uploadFinished.connect(self.onUploadFinished)
         self.uploader.start()
@@ -209,6 +213,7 @@ class Widget(QWidget):
         nodes = cursor.fetchall()
         cursor.close()
         self.dbPool.putconn(db)
+        self.deploymentIndex.invalidate() # deployments might have been updated
         node_labels = []
         for n in nodes:
             start = '-inf' if n[0].lower == None else n[0].lower.strftime('%Y-%m-%d')
@@ -235,6 +240,7 @@ class Widget(QWidget):
             else:
                 self.statusLabel.setText(f'Connected to database server.')
                 self.dbPool = pool.ThreadedConnectionPool(5, 10, **credentials)
+                self.deploymentIndex = DeploymentIndex(self.dbPool)
                 return True
         else:
             return True
@@ -0,0 +1,120 @@
+import hashlib
+import struct
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import audiomoth
+
+HEAD_LEGACY = 'Recorded at 21:00:00 24/05/2021 (UTC+2) by AudioMoth 24E144085F256C1B at medium gain setting while battery state was 4.2V and temperature was 17.3C.'
+HEAD_CURRENT = 'Recorded at 21:00:00 24/05/2021 (UTC+2) by AudioMoth 24E144085F256C1B at medium gain while battery was 4.2V and temperature was 17.3C.'
+
+comments = {
+    # firmware variants and settings
+    'legacy': (HEAD_LEGACY, {}),
+    'legacy-low-battery': (HEAD_LEGACY.replace('was 4.2V', 'was less than 3.6V'), {'battery': '3.6'}),
+    'current': (HEAD_CURRENT, {}),
+    'current-utc': (HEAD_CURRENT.replace('(UTC+2)', '(UTC)'), {'time_start': datetime(2021, 5, 24, 21, tzinfo=timezone.utc)}),
+    'current-utc-negative-minutes': (HEAD_CURRENT.replace('(UTC+2)', '(UTC-3:30)'), {'time_start': datetime(2021, 5, 24, 21, tzinfo=timezone(-timedelta(hours=3, minutes=30)))}),
+    'current-external-mic': (HEAD_CURRENT.replace('24E144085F256C1B', '24E144085F256C1B using external microphone'), {'source': 'external'}),
+    'current-negative-temperature': (HEAD_CURRENT.replace('17.3C', '-2.5C'), {'temperature': '-2.5'}),
+    'current-amplitude-threshold': (HEAD_CURRENT + ' Amplitude threshold was 0.1% with 1s minimum trigger duration.', {'amp_thresh': '0.1%', 'amp_trig': '1'}),
+    'current-band-pass': (HEAD_CURRENT + ' Band-pass filter with frequencies of 1.0kHz and 192.0kHz applied.', {'filter': 'BAND_PASS_FILTER 1.0 192.0'}),
+    'current-low-pass': (HEAD_CURRENT + ' Low-pass filter with frequency of 12.0kHz applied.', {'filter': 'LOW_PASS_FILTER 12.0'}),
+    'current-high-pass': (HEAD_CURRENT + ' High-pass filter with frequency of 8.0kHz applied.', {'filter': 'HIGH_PASS_FILTER 8.0'}),
+    'current-filter-and-threshold': (
+        HEAD_CURRENT + ' Band-pass filter with frequencies of 1.0kHz and 24.0kHz applied. Amplitude threshold was 10 with 5s minimum trigger duration. Recording stopped due to low voltage.',
+        {'filter': 'BAND_PASS_FILTER 1.0 24.0', 'amp_thresh': '10', 'amp_trig': '5', 'rec_end_status': 'SUPPLY_VOLTAGE_LOW'}),
+    # recording end status (see import_existing/test_rec_stat_parser.py)
+    'MICROPHONE_CHANGED-old': (HEAD_LEGACY + ' Recording cancelled before completion due to microphone change.', {'rec_end_status': 'MICROPHONE_CHANGED'}),
+    'MICROPHONE_CHANGED-1.6': (HEAD_CURRENT + ' Recording stopped due to microphone change.', {'rec_end_status': 'MICROPHONE_CHANGED'}),
+    'SWITCH_CHANGED-old': (HEAD_LEGACY + ' Recording cancelled before completion due to change of switch position.', {'rec_end_status': 'SWITCH_CHANGED'}),
+    'SWITCH_CHANGED-1.6': (HEAD_CURRENT + ' Recording stopped due to switch position change.', {'rec_end_status': 'SWITCH_CHANGED'}),
+    'SUPPLY_VOLTAGE_LOW-old': (HEAD_LEGACY + ' Recording cancelled before completion due to low voltage.', {'rec_end_status': 'SUPPLY_VOLTAGE_LOW'}),
+    'SUPPLY_VOLTAGE_LOW-1.6': (HEAD_CURRENT + ' Recording stopped due to low voltage.', {'rec_end_status': 'SUPPLY_VOLTAGE_LOW'}),
+    'MAGNETIC_SWITCH-1.7': (HEAD_CURRENT + ' Recording stopped by magnetic switch.', {'rec_end_status': 'MAGNETIC_SWITCH'}),
+    'FILE_SIZE_LIMITED-old': (HEAD_LEGACY + ' Recording cancelled before completion due to file size limit.', {'rec_end_status': 'FILE_SIZE_LIMITED'}),
+    'FILE_SIZE_LIMITED-1.6': (HEAD_CURRENT + ' Recording stopped due to file size limit.', {'rec_end_status': 'FILE_SIZE_LIMITED'}),
+}
+
+defaults = {
+    'time_start': datetime(2021, 5, 24, 21, tzinfo=timezone(timedelta(hours=2))),
+    'serial_number': '24E144085F256C1B',
+    'source': 'internal',
+    'gain': 'medium',
+    'filter': 'NO_FILTER',
+    'amp_thresh': None,
+    'amp_trig': None,
+    'battery': '4.2',
+    'temperature': '17.3',
+    'rec_end_status': 'RECORDING_OKAY',
+}
+
+@pytest.mark.parametrize('key', comments.keys())
+def test_parse_comment(key):
+    comment, expected = comments[key]
+    assert audiomoth.match_comment(comment) is not None
+    assert audiomoth.detect_firmware(comment) == ('legacy' if key.startswith('legacy') or key.endswith('-old') else 'current')
+    info = audiomoth.parse_comment(comment)
+    assert info == {**defaults, **expected}
+    assert info == audiomoth.parse_comment_fields(comment)
+
+def test_parse_comment_unknown_sentence():
+    # unknown sentences fall back to searching field by field
+    comment = HEAD_CURRENT + ' Frequency trigger (48.0kHz and window length of 16 samples) threshold was 10% with 1s minimum trigger duration. Recording stopped due to low voltage.'
+    assert audiomoth.match_comment(comment) is None
+    info = audiomoth.parse_comment(comment)
+    assert info['rec_end_status'] == 'SUPPLY_VOLTAGE_LOW'
+    assert info == audiomoth.parse_comment_fields(comment)
+
+@pytest.mark.parametrize('comment', [None, '', 'Recorded with Zoom F3 at 48kHz.'])
+def test_parse_comment_unsupported(comment):
+    # WAV files without comment or from other recorders
+    with pytest.raises(audiomoth.UnsupportedFormat):
+        audiomoth.parse_comment(comment)
+    with pytest.raises(audiomoth.UnsupportedFormat):
+        audiomoth.parse_comment_fields(comment)
+
+def wav_bytes(comment, frames=4800):
+    icmt = comment.encode().ljust(384, b'\x00')
+    info = b'INFO' + b'ICMT' + struct.pack('<I', len(icmt)) + icmt
+    fmt = struct.pack('<HHIIHH', 1, 1, 48000, 96000, 2, 16)
+    data = bytes(range(256)) * (frames * 2 // 256)
+    body = (b'WAVE' + b'fmt ' + struct.pack('<I', len(fmt)) + fmt
+        + b'LIST' + struct.pack('<I', len(info)) + info
+        + b'data' + struct.pack('<I', len(data)) + data)
+    return b'RIFF' + struct.pack('<I', len(body)) + body
+
+@pytest.mark.parametrize('block_size', [16, 1000, audiomoth.BS])
+def test_read_wav(tmp_path, block_size):
+    content = wav_bytes(HEAD_CURRENT, frames=48000)
+    path = tmp_path / 'test.wav'
+    path.write_bytes(content)
+    meta = audiomoth.read_wav(path, block_size)
+    assert meta == {
+        'sha256': hashlib.sha256(content).hexdigest(),
+        'filesize': len(content),
+        'audio_format': 1,
+        'bit_depth': 16,
+        'channels': 1,
+        'duration': 1.0,
+        'sample_rate': 48000,
+        'comment': HEAD_CURRENT,
+    }
+
+def test_read_wav_unsupported(tmp_path):
+    path = tmp_path / 'test.wav'
+    path.write_bytes(b'ID3' + bytes(1000))
+    with pytest.raises(audiomoth.UnsupportedFormat):
+        audiomoth.read_wav(path)
+
+def test_read_wav_header_limit(tmp_path):
+    # chunk size pointing past the end of the file: the header is not buffered to the end
+    content = bytearray(wav_bytes(HEAD_CURRENT, frames=48000))
+    struct.pack_into('<I', content, 16, 0x7fffffff) # size of the fmt chunk
+    path = tmp_path / 'test.wav'
+    path.write_bytes(content)
+    with pytest.raises(audiomoth.UnsupportedFormat):
+        audiomoth.read_wav(path, 1000, header_limit=4000)
+    with pytest.raises(audiomoth.UnsupportedFormat):
+        audiomoth.read_wav(path, 1000)
@@ -19,8 +19,10 @@ from tqdm.contrib.concurrent import thread_map
 
 sys.path.append('../../')
 import credentials as crd
+from deployments import DeploymentIndex
 
 dbConnectionPool = None
+deployment_index = None
 storage = None
 logger = None
 
@@ -71,6 +73,11 @@ def image_meta_worker(path):
     return meta
 
 def image_upload_worker(file):
+    deployment_id = deployment_index.lookup(file['node_label'], file['timestamp'])
+    if deployment_id is None:
+        print(f"DB error for file {file['path']}: no deployment covering the timestamp -> node deployment missing.")
+        return
+
     db = dbConnectionPool.getconn()
     cursor = db.cursor()
 
@@ -91,7 +98,7 @@ def image_upload_worker(file):
         || %s||'_'||to_char(%s at time zone 'UTC', 'YYYY-mm-DD"T"HH24-MI-SS"Z"')||%s, -- file_name (node_label, timestamp, extension)
         %s, -- sha256
         %s, -- time
-        (SELECT deployment_id from {schema}.deployments WHERE node_id = (SELECT node_id from {schema}.nodes WHERE node_label = %s) and (%s at time zone 'UTC')::timestamptz <@ period), -- deployment_id
+        %s, -- deployment_id
         %s, -- file_size
         %s, -- resolution
         CURRENT_TIMESTAMP, -- created_at
@@ -108,8 +115,7 @@ def image_upload_worker(file):
             '.jpg',
             file['sha256'],
             file['timestamp'],
-            file['node_label'],
-            file['timestamp'],
+            deployment_id,
             file['file_size'],
             [int(px) for px in file['resolution']],
         ))
@@ -195,34 +201,48 @@ def extract_image_meta(imagefiles):
     print(f'extracted metadata, found {len(hashtable)} unique image files')
     return hashtable
 
-def check_image_duplicates(imagefiles):
-    print('checking for duplicate image files in database...')
-    db = dbConnectionPool.getconn()
-    cursor = db.cursor()
+def find_image_duplicates(cursor, imagefiles):
+    '''
+    Check a list of image files for duplicate hashes and object name collisions in the database.
+
+    Returns a dict mapping sha256 to (duplicate hash, path/file name collision),
+    files without any match are not contained.
+    '''
+    if len(imagefiles) == 0:
+        return {}
+    # match hashes and object names separately, so both joins can use an index
     query = '''
     WITH n AS (
-        SELECT %s as sha256,
-        %s||'/'||to_char(%s at time zone 'UTC', 'YYYY-mm-DD/HH24/') -- file_path (node_label, time_start)
-        || %s||'_'||to_char(%s at time zone 'UTC', 'YYYY-mm-DD"T"HH24-MI-SS"Z"')||%s -- file_name (node_label, time_start, extension)
+        SELECT sha256,
+        node_label||'/'||to_char(file_time at time zone 'UTC', 'YYYY-mm-DD/HH24/') -- file_path (node_label, timestamp)
+        || node_label||'_'||to_char(file_time at time zone 'UTC', 'YYYY-mm-DD"T"HH24-MI-SS"Z"')||'.jpg' -- file_name (node_label, timestamp, extension)
         as object_name
+        FROM (VALUES %s) AS v (sha256, node_label, file_time)
+    ),
+    m AS (
+        SELECT n.sha256, true as hash_match, f.object_name = n.object_name as object_name_match
+        FROM n JOIN {schema}.files_image f ON f.sha256 = n.sha256
+        UNION ALL
+        SELECT n.sha256, f.sha256 = n.sha256 as hash_match, true as object_name_match
+        FROM n JOIN {schema}.files_image f ON f.object_name = n.object_name
     )
-    SELECT f.sha256 = n.sha256 as hash_match,
-        f.object_name = n.object_name as object_name_match
-    from {schema}.files_image f, n
-    where (f.sha256 = n.sha256 or f.object_name = n.object_name)
+    SELECT sha256, bool_or(hash_match), bool_or(object_name_match)
+    FROM m GROUP BY sha256
     '''.format(schema=crd.db.schema)
+    data = [(file['sha256'], file['node_label'], file['timestamp']) for file in imagefiles]
+    result = execute_values(cursor, query, data, template='(%s, %s, %s::timestamptz)', page_size=len(data), fetch=True)
+    return {sha256: (hash_match, object_name_match) for sha256, hash_match, object_name_match in result}
+
+def check_image_duplicates(imagefiles):
+    print('checking for duplicate image files in database...')
+    db = dbConnectionPool.getconn()
+    cursor = db.cursor()
+    duplicates = find_image_duplicates(cursor, list(imagefiles.values()))
+    cursor.close()
+    dbConnectionPool.putconn(db)
     upload_list = []
-    progress = tqdm(total=len(imagefiles))
     for file in imagefiles.values():
-        cursor.execute(query, (
-            file['sha256'],
-            file['node_label'],
-            file['timestamp'],
-            file['node_label'],
-            file['timestamp'],
-            '.jpg'
-            ))
-        result = cursor.fetchone()
+        result = duplicates.get(file['sha256'])
         if result is None:
             upload_list.append(file)
         else:
@@ -231,11 +251,7 @@ def check_image_duplicates(imagefiles):
                 state.append('duplicate')
             if result[1]:
                 state.append('name collision')
-            progress.write(f"skipping {file['path']}: {', '.join(state)}")
-        progress.update(1)
-    progress.close()
-    cursor.close()
-    dbConnectionPool.putconn(db)
+            print(f"skipping {file['path']}: {', '.join(state)}")
     print(f'found {len(upload_list)} image files that don\'t exist in db/storage')
     return upload_list
 
@@ -246,22 +262,17 @@ def check_deployed(imagefiles: dict):
             timestamps_by_node_label[file['node_label']].append(file['timestamp'])
         else:
             timestamps_by_node_label[file['node_label']] = [file['timestamp']]
-    db = dbConnectionPool.getconn()
-    cursor = db.cursor()
-    query = 'SELECT deployment_id, period FROM {schema}.deployments WHERE node_id = (SELECT node_id FROM {schema}.nodes WHERE node_label = %s) AND %s::timestamptz <@ period'.format(schema=crd.db.schema)
+    deployment_index.load(timestamps_by_node_label.keys())
     deployment_issues = []
     for node_label in timestamps_by_node_label.keys():
         check = []
         for i in (0, -1):
-            cursor.execute(query, (node_label, timestamps_by_node_label[node_label][i]))
-            result = cursor.fetchone()
-            if result == None: check.append(timestamps_by_node_label[node_label][i].isoformat())
+            if deployment_index.lookup(node_label, timestamps_by_node_label[node_label][i]) is None:
+                check.append(timestamps_by_node_label[node_label][i].isoformat())
         if len(check) == 1:
             deployment_issues.append(f'Node {node_label} is only partially covered by a deployment, please update to cover {check[0]}.')
         if len(check) == 2:
             deployment_issues.append(f'Node {node_label} is not covered by a deployment, please update or add a one to cover from {check[0]} to {check[1]}.')
-    cursor.close()
-    dbConnectionPool.putconn(db)
     if len(deployment_issues) > 0:
         raise Exception('Errors occured when checking nodes for matching deployments:\n' + '\n'.join(deployment_issues))
 
@@ -304,6 +315,8 @@ def main():
     )
     if not dbConnectionPool:
         raise Exception(f'Connection to DB failed (ConnectionPool).')
+    global deployment_index
+    deployment_index = DeploymentIndex(dbConnectionPool)
 
     # connect to S3 storage
     global storage